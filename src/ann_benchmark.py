@@ -0,0 +1,167 @@
+# Import libraries
+import os # For the dataset paths
+import json # For the machine-readable output
+import time # For build and query timings
+import argparse # For the command line
+import numpy as np # For the synthetic vectors
+
+from ann_index import IVFPQIndex
+from gallery_index import load_gallery_index
+from signature_utils import prepare_signature
+from pipeline_benchmark import prepare_dataset, DATA_DIR
+
+# Define constants
+DEFAULT_SIZES = (1000, 10000)
+SYNTHETIC_SIZES = (1000, 10000, 100000, 1000000) # --synthetic scales past what can be rendered
+DESCRIPTOR_DIM = 2178 # Length of signature_utils.global_descriptor
+CHUNK_SIZE = 20000 # Vectors generated / inserted / scanned at a time
+
+
+def synthetic_chunk(start, count, dim, n_people, seed):
+    """
+    Deterministic synthetic signature descriptors: every vector is the
+    template of one "person" plus noise, scaled to unit length.
+    Chunk i always holds the same vectors, whatever the gallery size.
+    """
+    templates = np.random.default_rng(seed).standard_normal((n_people, dim)).astype(np.float32)
+    rng = np.random.default_rng([seed, start])
+    people = rng.integers(0, n_people, size=count)
+    vectors = templates[people] + 0.8 * rng.standard_normal((count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def exact_top_k(queries, size, dim, n_people, seed, k):
+    """Brute-force ground truth, scanning the gallery chunk by chunk."""
+    best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    best_ids = np.zeros((len(queries), k), dtype=np.int64)
+
+    for start in range(0, size, CHUNK_SIZE):
+        block = synthetic_chunk(start, min(CHUNK_SIZE, size - start), dim, n_people, seed)
+        scores = np.concatenate([best_scores, queries @ block.T], axis=1)
+        ids = np.concatenate([best_ids, np.broadcast_to(np.arange(start, start + len(block)), (len(queries), len(block)))], axis=1)
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        best_scores = np.take_along_axis(scores, top, axis=1)
+        best_ids = np.take_along_axis(ids, top, axis=1)
+
+    return best_ids
+
+
+def _measure(index, queries, truth, k):
+    # QPS and recall@k of the ANN top k against the exact top k
+    start = time.perf_counter()
+    found = [index.search(q, k) for q in queries]
+    search_s = time.perf_counter() - start
+
+    recall = np.mean([
+        len(set(key for key, _ in hits) & set(expected.tolist())) / k
+        for hits, expected in zip(found, truth)
+    ])
+    return found, round(len(queries) / search_s, 1), round(float(recall), 4)
+
+
+def benchmark_signatures(size, n_queries, k, n_lists, n_subvectors, n_probe, seed, font_path=None, workers=1,
+                         data_dir=DATA_DIR):
+    """
+    Measures the index on the global descriptors of a generated signature
+    gallery (see pipeline_benchmark.prepare_dataset), queried with the
+    descriptors of held-out probes. Besides recall@k against the exact
+    descriptor top k, reports how often the probe's own gallery signature
+    is in the ANN / exact top k, i.e. the recall of the shortlist handed to
+    the precise comparators.
+    """
+    dataset = prepare_dataset(size, n_queries, seed, font_path, workers, data_dir)
+    gallery = load_gallery_index(dataset["gallery_dir"], os.path.join(dataset["dir"], "gallery_index.pkl"))
+    vectors = gallery.descriptor_matrix()
+    probes = list(dataset["truth"])
+    queries = np.stack([prepare_signature(p)["descriptor"] for p in probes])
+    expected = [gallery.rows_of([dataset["truth"][p]["filename"]]) for p in probes]
+
+    start = time.perf_counter()
+    index = IVFPQIndex(vectors.shape[1], n_lists, n_subvectors, n_probe)
+    index.train(vectors)
+    index.add(range(len(vectors)), vectors)
+    build_s = time.perf_counter() - start
+
+    truth = np.argsort(-(queries @ vectors.T), axis=1, kind="stable")[:, :k]
+    found, qps, recall = _measure(index, queries, truth, k)
+
+    return {
+        "data": "signatures",
+        "size": len(vectors),
+        "build_s": round(build_s, 3),
+        "qps": qps,
+        "recall_at_k": recall,
+        "k": k,
+        "true_match_ann": round(float(np.mean([bool(rows) and rows[0] in {key for key, _ in hits}
+                                               for rows, hits in zip(expected, found)])), 4),
+        "true_match_exact": round(float(np.mean([bool(rows) and rows[0] in top.tolist()
+                                                 for rows, top in zip(expected, truth)])), 4),
+    }
+
+
+def benchmark_size(size, dim, n_queries, k, n_lists, n_subvectors, n_probe, seed):
+    """Builds an index of synthetic vectors of the given size and measures build time, QPS and recall@k."""
+    n_people = max(size // 10, 1)
+
+    start = time.perf_counter()
+    index = IVFPQIndex(dim, n_lists, n_subvectors, n_probe)
+    index.train(synthetic_chunk(0, min(size, CHUNK_SIZE), dim, n_people, seed))
+    for chunk_start in range(0, size, CHUNK_SIZE):
+        count = min(CHUNK_SIZE, size - chunk_start)
+        index.add(range(chunk_start, chunk_start + count), synthetic_chunk(chunk_start, count, dim, n_people, seed))
+    build_s = time.perf_counter() - start
+
+    # Queries: noisy copies of gallery members, like a new scan of a known person
+    rng = np.random.default_rng([seed, size])
+    picked = rng.integers(0, size, size=n_queries)
+    queries = np.stack([synthetic_chunk(i, 1, dim, n_people, seed)[0] for i in picked])
+    queries += 0.3 * rng.standard_normal(queries.shape).astype(np.float32) / np.sqrt(dim)
+    truth = exact_top_k(queries, size, dim, n_people, seed, k)
+    _, qps, recall = _measure(index, queries, truth, k)
+
+    return {
+        "data": "synthetic",
+        "size": size,
+        "build_s": round(build_s, 3),
+        "qps": qps,
+        "recall_at_k": recall,
+        "k": k,
+    }
+
+
+# Run the benchmark when this script is executed directly
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="QPS and recall of the ANN index versus gallery size.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=None,
+                        help=f"gallery sizes (default: {DEFAULT_SIZES}, or {SYNTHETIC_SIZES} with --synthetic)")
+    parser.add_argument("--synthetic", action="store_true", help="random person-template vectors instead of signature descriptors")
+    parser.add_argument("--dim", type=int, default=DESCRIPTOR_DIM, help="vector length of the synthetic vectors")
+    parser.add_argument("--queries", type=int, default=100, help="queries per size")
+    parser.add_argument("--k", type=int, default=10, help="neighbours per query")
+    parser.add_argument("--lists", type=int, default=256, help="number of inverted lists")
+    parser.add_argument("--subvectors", type=int, default=64, help="PQ bytes per vector")
+    parser.add_argument("--probe", type=int, default=16, help="lists visited per search")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--font", default=None, help="font for the generated signatures")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="processes generating the signatures")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="where generated datasets are kept (shared with pipeline_benchmark.py)")
+    parser.add_argument("--json", default=None, help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes or (SYNTHETIC_SIZES if args.synthetic else DEFAULT_SIZES):
+        if args.synthetic:
+            row = benchmark_size(size, args.dim, args.queries, args.k, args.lists, args.subvectors, args.probe, args.seed)
+        else:
+            row = benchmark_signatures(size, args.queries, args.k, args.lists, args.subvectors, args.probe, args.seed,
+                                       args.font, args.workers, args.data_dir)
+        results.append(row)
+        line = (f"N={row['size']:>8} | build {row['build_s']:8.1f} s | "
+                f"{row['qps']:8.1f} QPS | recall@{row['k']} = {row['recall_at_k']:.3f}")
+        if "true_match_ann" in row:
+            line += f" | true match in top {row['k']}: ANN {row['true_match_ann']:.3f}, exact {row['true_match_exact']:.3f}"
+        print(line)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
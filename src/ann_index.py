@@ -0,0 +1,304 @@
+# Import libraries
+import os # For file handling
+import pickle # For saving the index to disk
+import argparse # For the build command line
+import numpy as np # For all vector operations
+
+# Define constants
+ANN_INDEX_FILE = "../ann_index.pkl" # File where the built ANN index is stored
+COMPACT_FRACTION = 0.25 # Internal ids are renumbered once this share of them is deleted
+
+
+def _kmeans(data, k, iterations, rng, chunk_size=4096):
+    """
+    Plain Lloyd k-means (squared L2). Starts from k random rows and keeps
+    the previous centroid for clusters that end up empty.
+    """
+    centroids = data[rng.choice(len(data), size=k, replace=False)].copy()
+
+    for _ in range(iterations):
+        labels = _nearest(data, centroids, chunk_size)
+
+        order = np.argsort(labels, kind="stable")
+        used, starts, counts = np.unique(labels[order], return_index=True, return_counts=True)
+        sums = np.add.reduceat(data[order], starts, axis=0)
+        centroids[used] = sums / counts[:, None]
+
+    return centroids
+
+
+def _nearest(data, centroids, chunk_size=4096):
+    """Index of the closest centroid (squared L2) for every row of data."""
+    centroid_norms = np.einsum("ij,ij->i", centroids, centroids)
+    labels = np.empty(len(data), dtype=np.int64)
+
+    for start in range(0, len(data), chunk_size):
+        block = data[start:start + chunk_size]
+        # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, and |x|^2 does not change the argmin
+        labels[start:start + len(block)] = np.argmin(centroid_norms - 2 * block @ centroids.T, axis=1)
+
+    return labels
+
+
+class IVFPQIndex:
+    """
+    Approximate nearest-neighbour index over fixed-length vectors
+    (IVF-PQ, inner-product similarity), in plain NumPy.
+
+    - a k-means coarse quantizer splits the vectors in n_lists inverted lists
+    - the residual of each vector to its list centroid is compressed by
+      product quantization into n_subvectors bytes
+    - a search only visits the n_probe lists whose centroids score best
+      and estimates q.x from per-query lookup tables
+
+    Vectors are stored under a key (e.g. the gallery filename); insert and
+    delete are incremental and never retrain the quantizers.
+    """
+
+    def __init__(self, dim, n_lists=64, n_subvectors=64, n_probe=8):
+        self.dim = dim
+        self.n_subvectors = n_subvectors
+        self.sub_dim = -(-dim // n_subvectors) # ceil division
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+
+        self.centroids = None # n_lists x padded dim
+        self.codebooks = None # n_subvectors x codes x sub_dim
+
+        self.keys = [] # internal id -> key (None once deleted)
+        self.key_to_id = {}
+        self.hashes = {} # key -> content hash, kept by sync_ann_index
+        self.id_list = np.empty(0, dtype=np.int64) # internal id -> list
+        self.id_pos = np.empty(0, dtype=np.int64) # internal id -> position in list
+
+        self.list_codes = [] # per list, a growable (capacity x n_subvectors) uint8 array
+        self.list_ids = [] # per list, a growable array of internal ids
+        self.list_sizes = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.key_to_id)
+
+    def _pad(self, vectors):
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected vectors of length {self.dim}, got {vectors.shape[1]}")
+
+        padded = np.zeros((len(vectors), self.n_subvectors * self.sub_dim), dtype=np.float32)
+        padded[:, :self.dim] = vectors
+        return padded
+
+    def train(self, vectors, iterations=10, sample_size=20000, seed=0):
+        """Learns the coarse centroids and the PQ codebooks from sample vectors."""
+        rng = np.random.default_rng(seed)
+        data = self._pad(vectors)
+        if len(data) > sample_size:
+            data = data[rng.choice(len(data), size=sample_size, replace=False)]
+
+        self.centroids = _kmeans(data, min(self.n_lists, len(data)), iterations, rng)
+        self.n_lists = len(self.centroids)
+
+        residuals = data - self.centroids[_nearest(data, self.centroids)]
+        n_codes = min(256, len(data))
+        self.codebooks = np.stack([
+            _kmeans(np.ascontiguousarray(residuals[:, j * self.sub_dim:(j + 1) * self.sub_dim]), n_codes, iterations, rng)
+            for j in range(self.n_subvectors)
+        ])
+
+        self.list_codes = [np.empty((0, self.n_subvectors), dtype=np.uint8) for _ in range(self.n_lists)]
+        self.list_ids = [np.empty(0, dtype=np.int64) for _ in range(self.n_lists)]
+        self.list_sizes = np.zeros(self.n_lists, dtype=np.int64)
+
+    def _encode(self, residuals, chunk_size=4096):
+        codes = np.empty((len(residuals), self.n_subvectors), dtype=np.uint8)
+        for j in range(self.n_subvectors):
+            sub = residuals[:, j * self.sub_dim:(j + 1) * self.sub_dim]
+            codes[:, j] = _nearest(sub, self.codebooks[j], chunk_size)
+        return codes
+
+    def add(self, keys, vectors):
+        """
+        Inserts vectors under the given keys.
+        A key that is already present (or repeated in keys) is replaced,
+        the last vector given for it wins.
+        """
+        if self.centroids is None:
+            raise RuntimeError("The index must be trained before adding vectors.")
+
+        keys = list(keys)
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        last = {key: i for i, key in enumerate(keys)}
+        if len(last) < len(keys):
+            rows = sorted(last.values())
+            keys, vectors = [keys[i] for i in rows], vectors[rows]
+        self.remove([key for key in keys if key in self.key_to_id])
+
+        data = self._pad(vectors)
+        lists = _nearest(data, self.centroids)
+        codes = self._encode(data - self.centroids[lists])
+
+        first_id = len(self.keys)
+        ids = np.arange(first_id, first_id + len(keys), dtype=np.int64)
+        self.keys.extend(keys)
+        for key, internal_id in zip(keys, ids.tolist()):
+            self.key_to_id[key] = internal_id
+        self.id_list = np.concatenate([self.id_list, lists])
+        self.id_pos = np.concatenate([self.id_pos, np.zeros(len(keys), dtype=np.int64)])
+
+        # Append every list's new rows in one go, growing its buffers by doubling
+        order = np.argsort(lists, kind="stable")
+        used, starts, counts = np.unique(lists[order], return_index=True, return_counts=True)
+        for l, start, count in zip(used.tolist(), starts.tolist(), counts.tolist()):
+            rows = order[start:start + count]
+            size = self.list_sizes[l]
+            needed = size + count
+
+            if needed > len(self.list_ids[l]):
+                capacity = max(needed, 2 * len(self.list_ids[l]), 16)
+                grown_codes = np.empty((capacity, self.n_subvectors), dtype=np.uint8)
+                grown_ids = np.empty(capacity, dtype=np.int64)
+                grown_codes[:size] = self.list_codes[l][:size]
+                grown_ids[:size] = self.list_ids[l][:size]
+                self.list_codes[l], self.list_ids[l] = grown_codes, grown_ids
+
+            self.list_codes[l][size:needed] = codes[rows]
+            self.list_ids[l][size:needed] = ids[rows]
+            self.id_pos[ids[rows]] = np.arange(size, needed)
+            self.list_sizes[l] = needed
+
+    def remove(self, keys):
+        """Deletes the given keys (unknown keys are ignored)."""
+        for key in keys:
+            internal_id = self.key_to_id.pop(key, None)
+            self.hashes.pop(key, None)
+            if internal_id is None:
+                continue
+
+            l, pos = self.id_list[internal_id], self.id_pos[internal_id]
+            last = self.list_sizes[l] - 1
+
+            # Move the list's last row into the hole
+            moved = self.list_ids[l][last]
+            self.list_codes[l][pos] = self.list_codes[l][last]
+            self.list_ids[l][pos] = moved
+            self.id_pos[moved] = pos
+            self.list_sizes[l] = last
+
+            self.keys[internal_id] = None
+            self.id_list[internal_id] = -1
+
+        if len(self.keys) - len(self.key_to_id) > COMPACT_FRACTION * len(self.keys):
+            self.compact()
+
+    def compact(self):
+        """Renumbers the internal ids of the live keys, dropping the deleted ones."""
+        live = np.flatnonzero(self.id_list >= 0)
+        new_id = np.full(len(self.keys), -1, dtype=np.int64)
+        new_id[live] = np.arange(len(live))
+
+        for l in range(self.n_lists):
+            size = self.list_sizes[l]
+            self.list_ids[l][:size] = new_id[self.list_ids[l][:size]]
+        self.keys = [self.keys[i] for i in live.tolist()]
+        self.key_to_id = {key: i for i, key in enumerate(self.keys)}
+        self.id_list = self.id_list[live]
+        self.id_pos = self.id_pos[live]
+
+    def search(self, probe, k):
+        """
+        Approximate top k keys by inner product with the probe vector.
+        Returns (key, score) pairs, best first.
+        """
+        if self.centroids is None or len(self) == 0:
+            return []
+
+        q = self._pad(probe)[0]
+        list_scores = self.centroids @ q
+        n_probe = min(self.n_probe, self.n_lists)
+        probed = np.argpartition(-list_scores, n_probe - 1)[:n_probe]
+
+        # q.x = q.centroid + sum over subvectors of q_j.codeword_j
+        tables = np.einsum("mcs,ms->mc", self.codebooks, q.reshape(self.n_subvectors, self.sub_dim))
+        columns = np.arange(self.n_subvectors)
+
+        scores, ids = [], []
+        for l in probed.tolist():
+            size = self.list_sizes[l]
+            if size == 0:
+                continue
+            codes = self.list_codes[l][:size]
+            scores.append(list_scores[l] + tables[columns, codes].sum(axis=1))
+            ids.append(self.list_ids[l][:size])
+
+        if not scores:
+            return []
+
+        scores = np.concatenate(scores)
+        ids = np.concatenate(ids)
+        if k < len(scores):
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+
+        return [(self.keys[i], float(scores[j])) for i, j in zip(ids[top].tolist(), top.tolist())]
+
+    def save(self, index_path=ANN_INDEX_FILE):
+        """Writes the index to disk (atomically, through a temporary file of this process)."""
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, index_path)
+
+    @staticmethod
+    def load(index_path=ANN_INDEX_FILE):
+        """Reads an index written by save()."""
+        with open(index_path, "rb") as f:
+            return pickle.load(f)
+
+
+def build_ann_index(gallery, n_lists=64, n_subvectors=64, n_probe=8):
+    """Trains an IVF-PQ index on the gallery's global descriptors and fills it."""
+    descriptors = gallery.descriptor_matrix()
+    index = IVFPQIndex(descriptors.shape[1], n_lists, n_subvectors, n_probe)
+    index.train(descriptors)
+    sync_ann_index(index, gallery)
+    return index
+
+
+def sync_ann_index(index, gallery):
+    """
+    Incrementally aligns the ANN index with a refreshed gallery index:
+    removed files are deleted, new or changed files (by content hash) are
+    inserted. Returns the number of keys touched.
+    """
+    current = {e["filename"]: e for e in gallery.entries}
+
+    stale = [key for key in index.key_to_id if key not in current]
+    fresh = [f for f, e in current.items() if index.hashes.get(f) != e["sha1"]]
+
+    index.remove(stale)
+    if fresh:
+        index.add(fresh, np.array([current[f]["descriptor"] for f in fresh], dtype=np.float32))
+        for f in fresh:
+            index.hashes[f] = current[f]["sha1"]
+
+    return len(stale) + len(fresh)
+
+
+# Build the ANN index when this script is executed directly
+if __name__ == "__main__":
+    from gallery_index import load_gallery_index, DATABASE_DIR, INDEX_FILE
+
+    parser = argparse.ArgumentParser(description="Build the approximate nearest-neighbour index.")
+    parser.add_argument("--database", default=DATABASE_DIR, help="gallery image directory")
+    parser.add_argument("--index", default=INDEX_FILE, help="gallery index file")
+    parser.add_argument("--output", default=ANN_INDEX_FILE, help="output ANN index file")
+    parser.add_argument("--lists", type=int, default=64, help="number of inverted lists")
+    parser.add_argument("--subvectors", type=int, default=64, help="PQ bytes per vector")
+    parser.add_argument("--probe", type=int, default=8, help="lists visited per search")
+    args = parser.parse_args()
+
+    gallery = load_gallery_index(args.database, args.index)
+    index = build_ann_index(gallery, args.lists, args.subvectors, args.probe)
+    index.save(args.output)
+    print(f"Indexed {len(index)} descriptors into {args.output}")
@@ -1,7 +1,11 @@
 import streamlit as st
 import cv2
+import time
+import threading
 import numpy as np
-from signature_utils import compare_all_signatures, extract_text_from_image
+from signature_utils import compare_all_signatures, extract_text_from_image, to_grayscale, result_cache
+from gallery_index import load_gallery_index
+import profiling
 
 # ---------------------------------------------------------
 # Page configuration
@@ -23,6 +27,24 @@ hide_streamlit_style = """
 """
 st.markdown(hide_streamlit_style, unsafe_allow_html=True)
 
+# ---------------------------------------------------------
+# Gallery index (loaded once, shared by every session, refreshed at most
+# every GALLERY_REFRESH_SECONDS under its lock; queries take the same lock,
+# so none runs against a half-refreshed index)
+# ---------------------------------------------------------
+GALLERY_REFRESH_SECONDS = 30
+
+@st.cache_resource
+def get_gallery():
+    return {"index": load_gallery_index(), "lock": threading.Lock(), "refreshed_at": time.monotonic()}
+
+shared_gallery = get_gallery()
+gallery = shared_gallery["index"]
+with shared_gallery["lock"]:
+    if time.monotonic() - shared_gallery["refreshed_at"] >= GALLERY_REFRESH_SECONDS:
+        gallery.refresh()
+        shared_gallery["refreshed_at"] = time.monotonic()
+
 # ---------------------------------------------------------
 # Sidebar
 # ---------------------------------------------------------
@@ -69,9 +91,9 @@ if uploaded_file is not None:
     # Display uploaded image
     st.image(img, channels="BGR", caption="Uploaded Signature", use_column_width=True)
 
-    # Save temporarily for processing
-    temp_path = "temp_signature.png"
-    cv2.imwrite(temp_path, img)
+    # Grayscale once, shared by OCR and matching (no temporary file,
+    # so concurrent sessions cannot overwrite each other's upload)
+    gray = to_grayscale(img)
 
     # ---------------------------------------------------------
     # OCR Section
@@ -79,7 +101,7 @@ if uploaded_file is not None:
     st.subheader("📘 Extracted Text (OCR)")
 
     with st.spinner("Running OCR..."):
-        text = extract_text_from_image(temp_path)
+        text = extract_text_from_image(gray)
 
     if text:
         st.success(f"Detected text: **{text}**")
@@ -91,8 +113,8 @@ if uploaded_file is not None:
     # ---------------------------------------------------------
     st.subheader("📊 Signature Identification Results")
 
-    with st.spinner("Analyzing signature..."):
-        result = compare_all_signatures(temp_path)
+    with st.spinner("Analyzing signature..."), shared_gallery["lock"]:
+        result = compare_all_signatures(gray, gallery=gallery, trace=debug, use_cache=True) # Reruns of the same upload are cached
 
     # Display top matches
     for name, score in result["top_3_matches"]:
@@ -109,4 +131,12 @@ if uploaded_file is not None:
             st.write("OCR Raw Output:", text)
             st.write("Recognition Mode:", mode)
             st.write("Threshold:", threshold)
+            query_trace = result.pop("trace", None)
             st.write("Raw Result Object:", result)
+            if query_trace:
+                st.write("Time per stage (ms):")
+                st.table({stage: v for stage, v in query_trace["stages"].items()})
+                st.write("Events:", query_trace["counters"])
+            st.write("Result cache:", result_cache.stats())
+            if profiling.is_enabled():
+                st.code(profiling.metrics.prometheus_text(), language="text")
@@ -0,0 +1,279 @@
+# Import libraries
+import os # For file handling
+import sys # For progress output
+import csv # For CSV input / output
+import glob # For glob patterns of probe images
+import json # For JSONL input / output
+import time # For throughput and ETA
+import queue # Between the OCR stage and the matching workers
+import argparse # For the command line
+import threading # For the OCR prefetch stage
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from signature_utils import compare_all_signatures, extract_texts_from_images, result_cache, OCR_CACHE_SIZE, REJECTION_BOUNDS
+from gallery_index import load_gallery_index, DATABASE_DIR, INDEX_FILE
+from packed_gallery import open_packed_gallery
+import profiling
+
+# Define constants
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+CSV_FIELDS = ["path", "status", "match_1", "score_1", "match_2", "score_2", "match_3", "score_3", "message", "elapsed_ms"]
+
+
+def list_probes(source):
+    """
+    Probe image paths from a directory, a glob pattern, or a manifest file
+    (.txt with one path per line, .csv with a 'path' column, or .jsonl with
+    a 'path' field). Relative manifest paths are relative to the manifest.
+    """
+    if os.path.isdir(source):
+        return [
+            os.path.join(source, f) for f in sorted(os.listdir(source))
+            if f.lower().endswith(IMAGE_EXTENSIONS)
+        ]
+
+    if os.path.isfile(source) and not source.lower().endswith(IMAGE_EXTENSIONS):
+        base = os.path.dirname(source)
+        with open(source, "r", encoding="utf-8") as f:
+            if source.lower().endswith(".csv"):
+                paths = [row["path"] for row in csv.DictReader(f)]
+            elif source.lower().endswith(".jsonl"):
+                paths = [json.loads(line)["path"] for line in f if line.strip()]
+            else:
+                paths = [line.strip() for line in f if line.strip()]
+        return [p if os.path.isabs(p) else os.path.join(base, p) for p in paths]
+
+    return sorted(glob.glob(source))
+
+
+def _complete_records(output_path):
+    # Records of the complete (newline-terminated) lines / CSV rows of an
+    # output file, and the byte size they span: anything after them is a
+    # record cut by an interruption
+    with open(output_path, "rb") as f:
+        data = f.read()
+    lines = data.splitlines(keepends=True)
+    records = []
+    good_size = 0
+
+    if output_path.lower().endswith(".csv"):
+        consumed = 0
+        def read_lines():
+            nonlocal consumed
+            for line in lines:
+                consumed += len(line)
+                yield line.decode("utf-8", errors="replace")
+
+        # The reader pulls lines until a row is complete (quoted fields may
+        # span lines), so consumed ends where the row it returns ends
+        rows = csv.reader(read_lines())
+        try:
+            header = next(rows, None)
+            if header is not None and data[consumed - 1:consumed] == b"\n":
+                good_size = consumed
+                for row in rows:
+                    if data[consumed - 1:consumed] != b"\n":
+                        break
+                    records.append(dict(zip(header, row)))
+                    good_size = consumed
+        except csv.Error:
+            pass
+        return records, good_size
+
+    for line in lines:
+        try:
+            record = json.loads(line)
+            record["path"]
+        except (ValueError, KeyError, TypeError):
+            break
+        if not line.endswith(b"\n"):
+            break
+        records.append(record)
+        good_size += len(line)
+    return records, good_size
+
+
+def completed_paths(output_path, retry_errors=False):
+    """
+    Paths already written by an earlier (possibly interrupted) run.
+    A JSONL or CSV file cut in the middle of a record is truncated back to
+    its last complete record, so appending continues from a clean state.
+
+    With retry_errors, paths whose latest record has status "error" are not
+    counted as done: they are processed again and their new record is
+    appended after the old one.
+    """
+    if not os.path.exists(output_path):
+        return set()
+
+    records, good_size = _complete_records(output_path)
+    if good_size < os.path.getsize(output_path):
+        with open(output_path, "r+b") as f:
+            f.truncate(good_size)
+
+    latest_status = {r["path"]: r.get("status") for r in records if r.get("path")}
+    return {
+        path for path, status in latest_status.items()
+        if not (retry_errors and status == "error")
+    }
+
+
+class ResultWriter:
+    """Appends one record per probe to a JSONL or CSV file, flushing each one."""
+
+    def __init__(self, output_path):
+        self.is_csv = output_path.lower().endswith(".csv")
+        new_file = not os.path.exists(output_path) or os.path.getsize(output_path) == 0
+        self.file = open(output_path, "a", encoding="utf-8", newline="")
+        if self.is_csv:
+            self.writer = csv.DictWriter(self.file, fieldnames=CSV_FIELDS)
+            if new_file:
+                self.writer.writeheader()
+
+    def write(self, record):
+        if self.is_csv:
+            row = {key: record.get(key, "") for key in ("path", "status", "message", "elapsed_ms")}
+            for i, (name, score) in enumerate(record.get("top_3_matches", [])[:3], start=1):
+                row[f"match_{i}"] = name
+                row[f"score_{i}"] = score
+            self.writer.writerow(row)
+        else:
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def identify_one(path, gallery, **options):
+    """Runs compare_all_signatures on one probe and returns a JSON-friendly record."""
+    start = time.perf_counter()
+    try:
+        result = compare_all_signatures(path, gallery=gallery, **options)
+        record = {
+            "path": path,
+            "status": result.get("status", "ok"),
+            "top_3_matches": [(name, round(float(score), 2)) for name, score in result.get("top_3_matches", [])],
+        }
+        if "message" in result:
+            record["message"] = result["message"]
+    except Exception as e:
+        record = {"path": path, "status": "error", "message": f"{type(e).__name__}: {e}"}
+
+    record["elapsed_ms"] = round(1000 * (time.perf_counter() - start), 1)
+    return record
+
+
+def _ocr_prefetch(paths, ready, batch_size):
+    # OCR stage: text is computed in batches ahead of the matching workers,
+    # which then find it in the OCR cache. A failed batch is still queued,
+    # so every probe gets its own record (an error from its own OCR call),
+    # and the end marker is always sent so the consumer never waits forever
+    try:
+        for start in range(0, len(paths), batch_size):
+            chunk = paths[start:start + batch_size]
+            try:
+                extract_texts_from_images(chunk)
+            except Exception as e:
+                print(f"OCR batch failed ({type(e).__name__}: {e}), matching its probes without prefetch", file=sys.stderr)
+            for path in chunk:
+                ready.put(path)
+    finally:
+        ready.put(None)
+
+
+def identify_batch(paths, gallery, workers=4, ocr_batch_size=16, **options):
+    """
+    Identifies every probe and yields records as they complete.
+
+    OCR runs in a prefetch thread in batches of ocr_batch_size, while up to
+    workers probes are decoded and matched concurrently (OpenCV and NumPy
+    release the GIL). The number of probes between the two stages is kept
+    well under the OCR cache size so prefetched text is not evicted.
+    """
+    max_ahead = max(1, min(OCR_CACHE_SIZE // 2 - ocr_batch_size, 4 * workers))
+    ready = queue.Queue(maxsize=max_ahead)
+    threading.Thread(target=_ocr_prefetch, args=(paths, ready, ocr_batch_size), daemon=True).start()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = set()
+        finished = False
+        while not finished or running:
+            while not finished and len(running) < workers:
+                path = ready.get()
+                if path is None:
+                    finished = True
+                    break
+                running.add(executor.submit(identify_one, path, gallery, **options))
+
+            if running:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+
+def run_batch(source, output_path, workers=4, ocr_batch_size=16, database_path=DATABASE_DIR,
+              index_path=INDEX_FILE, report_every=50, pack_path=None, retry_errors=False, **options):
+    """
+    Processes every probe of source into output_path (.jsonl or .csv),
+    skipping probes already present in it (except failed ones with
+    retry_errors), and reports throughput and ETA.
+    Returns the number of probes processed in this run.
+    """
+    paths = list_probes(source)
+    done = completed_paths(output_path, retry_errors)
+    todo = [p for p in paths if p not in done]
+    print(f"{len(paths)} probes, {len(done)} already done, {len(todo)} to process.", file=sys.stderr)
+
+    # Loaded once for the whole batch
+    if pack_path:
+        gallery = open_packed_gallery(pack_path)
+    else:
+        gallery = load_gallery_index(database_path, index_path)
+
+    writer = ResultWriter(output_path)
+    start = time.perf_counter()
+    count = 0
+    try:
+        for record in identify_batch(todo, gallery, workers, ocr_batch_size, **options):
+            writer.write(record)
+            count += 1
+            if count % report_every == 0 or count == len(todo):
+                elapsed = time.perf_counter() - start
+                rate = count / max(elapsed, 1e-9)
+                eta = (len(todo) - count) / max(rate, 1e-9)
+                print(f"{count}/{len(todo)} | {rate:.1f} probes/s | ETA {eta:.0f} s", file=sys.stderr)
+    finally:
+        writer.close()
+
+    return count
+
+
+# Run the batch when this script is executed directly
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Identify a batch of signature images.")
+    parser.add_argument("source", help="directory, glob pattern or manifest (.txt/.csv/.jsonl) of probes")
+    parser.add_argument("output", help="results file (.jsonl or .csv), appended to and resumed")
+    parser.add_argument("--workers", type=int, default=4, help="probes matched concurrently")
+    parser.add_argument("--ocr-batch", type=int, default=16, help="images per OCR batch")
+    parser.add_argument("--database", default=DATABASE_DIR, help="gallery image directory")
+    parser.add_argument("--index", default=INDEX_FILE, help="gallery index file")
+    parser.add_argument("--pack", default=None, help="packed gallery file (used instead of the index)")
+    parser.add_argument("--shortlist", type=int, default=None, help="coarse-to-fine shortlist size")
+    parser.add_argument("--reject", action="store_true", help="skip candidates failing the cheap ink / aspect / letter tests")
+    parser.add_argument("--retry-errors", action="store_true", help="process again the probes whose last record is an error")
+    parser.add_argument("--cache", action="store_true", help="reuse results of duplicate and near-duplicate probes (re-scans)")
+    parser.add_argument("--profile", action="store_true", help="print per-stage timings and counters at the end")
+    args = parser.parse_args()
+
+    if args.profile:
+        profiling.enable()
+
+    run_batch(args.source, args.output, args.workers, args.ocr_batch, args.database, args.index,
+              pack_path=args.pack, shortlist_k=args.shortlist, rejection_bounds=REJECTION_BOUNDS if args.reject else None,
+              retry_errors=args.retry_errors, use_cache=args.cache)
+
+    if args.profile:
+        print(profiling.metrics.prometheus_text(), file=sys.stderr)
+        if args.cache:
+            print(f"Result cache: {result_cache.stats()}", file=sys.stderr)
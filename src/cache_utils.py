@@ -0,0 +1,194 @@
+# Import libraries
+import time # For entry expiry
+import hashlib # For content hashes
+import threading # Caches are shared by every thread (e.g. Streamlit sessions)
+from collections import OrderedDict # Keeps entries in least-recently-used order
+
+
+def content_hash(data):
+    """SHA-1 of raw bytes, used as a cache key for image content."""
+    return hashlib.sha1(data).hexdigest()
+
+
+class LRUCache:
+    """
+    Small thread-safe mapping with least-recently-used eviction:
+    once maxsize entries are stored, adding one drops the oldest.
+    Counts hits and misses so the size can be tuned.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TTLCache(LRUCache):
+    """
+    LRUCache whose entries also expire ttl seconds after they were stored
+    (expired entries count as misses, and in expired).
+    """
+
+    def __init__(self, maxsize=256, ttl=600):
+        super().__init__(maxsize)
+        self.ttl = ttl
+        self.expired = 0
+
+    def _live(self, key, now):
+        # Stored value of key if present and not expired (caller holds the lock)
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[1] <= now:
+            del self._data[key]
+            self.expired += 1
+            return None
+        return item
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._live(key, time.monotonic())
+            if item is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value):
+        super().put(key, (value, time.monotonic() + self.ttl))
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._live(key, time.monotonic()) is not None
+
+
+class NearDuplicateCache(TTLCache):
+    """
+    TTL + LRU cache for near-duplicate inputs. Keys are (group, exact key)
+    pairs, e.g. (query options, content hash), and every entry also has an
+    integer fingerprint (e.g. a perceptual hash): when the exact key is
+    missing, lookup() falls back to the entry of the same group whose
+    fingerprint is closest, within max_distance differing bits. Entries
+    stored without a fingerprint are only found by their exact key.
+
+    A group is invalidated as a whole when its version stamp changes
+    (see validate); stamps of groups without entries are forgotten.
+    """
+
+    def __init__(self, maxsize=256, ttl=600, max_distance=0):
+        super().__init__(maxsize, ttl)
+        self.max_distance = max_distance
+        self.near_hits = 0
+        self.invalidations = 0
+        self._stamps = {} # group -> stamp of its entries
+
+    def get(self, key, default=None):
+        """Value stored for exactly key (no near-duplicate fallback, see lookup), else default."""
+        item = super().get(key)
+        return default if item is None else item[0]
+
+    def validate(self, group, stamp):
+        """Drops the group's entries if they were stored under another stamp."""
+        with self._lock:
+            if group in self._stamps and self._stamps[group] != stamp:
+                for key in [key for key in self._data if key[0] == group]:
+                    del self._data[key]
+                self.invalidations += 1
+            # Groups whose entries were all evicted (e.g. of a freed gallery) need no stamp
+            live = {key[0] for key in self._data}
+            for other in [other for other in self._stamps if other not in live]:
+                del self._stamps[other]
+            self._stamps[group] = stamp
+
+    def lookup(self, key, fingerprint=None):
+        """
+        Value stored for key, else the value of the closest fingerprint of
+        the same group (within max_distance), else None. fingerprint may be
+        a function, only called when the exact key is missing; if it returns
+        None, the lookup is a miss.
+        """
+        now = time.monotonic()
+        with self._lock:
+            item = self._live(key, now)
+            if item is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[0][0]
+
+        if callable(fingerprint):
+            fingerprint = fingerprint()
+        with self._lock:
+            best_key, best_distance = None, self.max_distance + 1
+            if fingerprint is not None:
+                for other in list(self._data):
+                    if other[0] != key[0] or self._live(other, now) is None or self._data[other][0][1] is None:
+                        continue
+                    distance = (self._data[other][0][1] ^ fingerprint).bit_count()
+                    if distance < best_distance:
+                        best_key, best_distance = other, distance
+            if best_key is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(best_key)
+            self.near_hits += 1
+            return self._data[best_key][0][0]
+
+    def put(self, key, value, fingerprint=None, stamp=None):
+        """
+        Stores value under key; without a fingerprint, only an exact lookup
+        finds it. With a stamp, the value is only stored if its group is
+        still at that stamp (not invalidated while the value was computed).
+        """
+        with self._lock:
+            if stamp is not None and self._stamps.get(key[0]) != stamp:
+                return
+            self._data[key] = ((value, fingerprint), time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def stats(self):
+        """Lookups, exact / near hits and misses, with hit ratios, for sizing the cache."""
+        with self._lock:
+            lookups = self.hits + self.near_hits + self.misses
+            return {
+                "size": len(self._data),
+                "lookups": lookups,
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "invalidations": self.invalidations,
+                "hit_ratio": round((self.hits + self.near_hits) / lookups, 4) if lookups else 0.0,
+                "near_hit_ratio": round(self.near_hits / lookups, 4) if lookups else 0.0,
+            }
@@ -1,89 +1,213 @@
 # Importing necessary libraries
 from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageEnhance # For image creation and drawing
 from faker import Faker # For generating random names
-import numpy as np # For numerical operations
-import random # For generating random positions and font sizes
+import numpy as np # For numerical operations and the seeded random generators
 import os # For file path operations
 import json # For saving metadata
-
-fake = Faker() # generates random names
-name_map = {} # Dictionary to map filenames to names
+import argparse # For the command line
+from concurrent.futures import ProcessPoolExecutor # For generating large galleries in parallel
 
 # Directory to save generated signatures
 OUTPUT_DIR = "generated_signatures"
-os.makedirs(OUTPUT_DIR, exist_ok=True) # Create directory if it doesn't exist
+NAME_MAP_PATH = "signature_names.json"
+CHUNK_SIZE = 500 # Images generated per worker task
+PNG_COMPRESS_LEVEL = 1 # Noisy images compress poorly, fast compression saves most of the time
+
+# Fonts tried in order when no font is given (SIGNATURE_FONT or --font):
+# the original Windows cursive font, then common Linux italic / script fonts
+FONT_CANDIDATES = [
+    "C:/Windows/Fonts/seguisbi.ttf",
+    "/usr/share/fonts/urw-base35/Z003-MediumItalic.otf",
+    "/usr/share/fonts/opentype/urw-base35/Z003-MediumItalic.otf",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSerif-Italic.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSerif-Italic.ttf",
+    "/usr/share/fonts/truetype/liberation/LiberationSerif-Italic.ttf",
+    "/usr/share/fonts/liberation/LiberationSerif-Italic.ttf",
+]
+
+
+def find_font(font_path=None):
+    """
+    Font used to draw the signatures: font_path, the SIGNATURE_FONT
+    environment variable, or the first FONT_CANDIDATES entry that exists.
+    Returns None if there is none (Pillow's built-in font is used then).
+    """
+    configured = font_path or os.getenv("SIGNATURE_FONT")
+    if configured:
+        if not os.path.exists(configured):
+            raise FileNotFoundError(f"Font not found: {configured}")
+        return configured
+
+    for candidate in FONT_CANDIDATES:
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def load_font(font_path, font_size):
+    if font_path is None:
+        return ImageFont.load_default(font_size) # Scalable built-in font (Pillow >= 10.1)
+    return ImageFont.truetype(font_path, font_size)
+
+
+def image_rng(seed, index, variant=0):
+    """
+    Random generator of one image: the same (seed, index, variant) always
+    gives the same image, whatever the number of workers or the gallery
+    size. variant 0 is the gallery image, 1, 2, ... are probes.
+    """
+    return np.random.default_rng([seed, index, variant])
+
+
+_fake = None # One Faker per process, re-seeded for every name (creating one is slow)
+
+def person_name(seed, index):
+    """Random name of person index (deterministic for a given seed)."""
+    global _fake
+    if _fake is None:
+        _fake = Faker() # generates random names
+    _fake.seed_instance(f"{seed}-{index}")
+    return _fake.name()
 
-# Choose a cursive font from Windows
-FONT_PATH = "C:/Windows/Fonts/seguisbi.ttf" 
 
 # Function to add noise and distortions to the image
-def add_noise(img):
+def add_noise(img, rng):
     # Convert to numpy array to manipulate pixels
-    arr = np.asarray(img, dtype=np.int16) 
-    
+    arr = np.asarray(img, dtype=np.int16)
+
     # Gaussian noise  is added with 70% probability
-    if random.random() < 0.7:
-        noise = np.random.normal(0, 15, arr.shape) # Mean 0, stddev 15
+    if rng.random() < 0.7:
+        noise = rng.normal(0, 15, arr.shape) # Mean 0, stddev 15
         arr = arr + noise # Add noise to the image array
     # Speckle noise is added with 50% probability
-    if random.random() < 0.5:
+    if rng.random() < 0.5:
         # Speckle noise is multiplicative of the image
-        speckle = arr * (1 + np.random.randn(*arr.shape) * 0.1)
-        arr = speckle 
-    
-    # Clip values back to valid range 
+        speckle = arr * (1 + rng.standard_normal(arr.shape) * 0.1)
+        arr = speckle
+
+    # Clip values back to valid range
     arr = np.clip(arr, 0, 255).astype(np.uint8) # Convert back to uint8 to form an image
     noisy_img = Image.fromarray(arr) # Convert back to PIL Image
-    
-    # Random blur 
-    if random.random() < 0.5:
+
+    # Random blur
+    if rng.random() < 0.5:
         # Apply Gaussian blur to simulate pen smudges
-        noisy_img = noisy_img.filter(ImageFilter.GaussianBlur(radius=random.uniform(0.5, 1.5))) 
+        noisy_img = noisy_img.filter(ImageFilter.GaussianBlur(radius=rng.uniform(0.5, 1.5)))
         # Random contrast change to simulate ink variations
-    if random.random() < 0.5: 
+    if rng.random() < 0.5:
         enhancer = ImageEnhance.Contrast(noisy_img) # Create contrast enhancer to adjust contrast
-        noisy_img = enhancer.enhance(random.uniform(0.7, 1.3)) # Random contrast factor 
-    
+        noisy_img = enhancer.enhance(rng.uniform(0.7, 1.3)) # Random contrast factor
+
     return noisy_img
 
 
 # Function to generate a signature image
-def generate_signature(text, filename): 
+def generate_signature(text, rng, font_path=None):
     img = Image.new("RGB", (600, 200), "white") # Create a blank white image
     draw = ImageDraw.Draw(img) # Prepare to draw on the image
-    
-    font_size = random.randint(40, 70) # Random font size between 40 and 70
-    font = ImageFont.truetype(FONT_PATH, font_size)  # Load the font
-    
-    x = random.randint(10, 50) # Random x position
-    y = random.randint(20, 80) # Random y position
-    
+
+    font_size = int(rng.integers(40, 71)) # Random font size between 40 and 70
+    font = load_font(font_path, font_size)  # Load the font
+
+    x = int(rng.integers(10, 51)) # Random x position
+    y = int(rng.integers(20, 81)) # Random y position
+
     draw.text((x, y), text, font=font, fill="black") # Draw the text on the image
-    
-    img = img.rotate(random.randint(-10, 10), expand=1, fillcolor="white") 
+
+    img = img.rotate(int(rng.integers(-10, 11)), expand=1, fillcolor="white")
     # Slightly rotate the image for realism
     # Random angle between -10 and 10 degrees
     # Expand=1 to adjust the image size after rotation
-    
-    img.save(os.path.join(OUTPUT_DIR, filename)) # Save the image
 
-    # Add noise 
-    img = add_noise(img)
-    img.save(os.path.join(OUTPUT_DIR, filename)) # Save the noisy image in the same file
+    # Add noise
+    return add_noise(img, rng)
+
+
+# Function to distort a signature into a probe (another "scan" of the same person)
+def distort_signature(img, rng):
+    # Random shear and horizontal stretch, like a different writing slant
+    shear = rng.uniform(-0.15, 0.15)
+    stretch = rng.uniform(0.9, 1.1)
+    width, height = img.size
+    img = img.transform(
+        (int(width * stretch), height), Image.AFFINE,
+        (1 / stretch, shear, -shear * height / 2, 0, 1, 0),
+        resample=Image.BILINEAR, fillcolor=(255, 255, 255),
+    )
+    return add_noise(img, rng)
+
+
+def _generate_chunk(output_dir, start, stop, seed, font_path, variant):
+    # Worker task: images start..stop-1 of the gallery (variant 0) or their probes
+    names = {}
+    for index in range(start, stop):
+        rng = image_rng(seed, index, variant)
+        name = person_name(seed, index)
+        img = generate_signature(name, rng, font_path)
+        if variant == 0:
+            filename = f"signature_{index + 1}.png"
+        else:
+            img = distort_signature(img, rng)
+            filename = f"probe_{index + 1}_{variant}.png"
+        img.save(os.path.join(output_dir, filename), compress_level=PNG_COMPRESS_LEVEL)
+        names[filename] = name
+    return names
+
+
+def generate_gallery(output_dir, indices, seed=0, font_path=None, workers=1, variant=0):
+    """
+    Generates the signature of every person index in indices (gallery
+    images with variant 0, distorted probes otherwise) into output_dir,
+    in parallel with workers processes. Returns {filename: name}.
+    """
+    os.makedirs(output_dir, exist_ok=True) # Create directory if it doesn't exist
+    font_path = find_font(font_path)
+    indices = sorted(indices)
+
+    # Consecutive indices are grouped into chunks of at most CHUNK_SIZE
+    chunks = []
+    for index in indices:
+        if chunks and index == chunks[-1][1] and index - chunks[-1][0] < CHUNK_SIZE:
+            chunks[-1][1] = index + 1
+        else:
+            chunks.append([index, index + 1])
+
+    name_map = {}
+    if workers <= 1:
+        for start, stop in chunks:
+            name_map.update(_generate_chunk(output_dir, start, stop, seed, font_path, variant))
+        return name_map
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_generate_chunk, output_dir, start, stop, seed, font_path, variant)
+            for start, stop in chunks
+        ]
+        for future in futures:
+            name_map.update(future.result())
+    return name_map
+
+
+# Generate the gallery when this script is executed directly
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic signature images with random names.")
+    parser.add_argument("--count", type=int, default=200, help="number of signatures")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (same seed = same images)")
+    parser.add_argument("--font", default=None, help="TrueType / OpenType font (default: SIGNATURE_FONT or a known system font)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="parallel processes")
+    parser.add_argument("--output", default=OUTPUT_DIR, help="output directory")
+    parser.add_argument("--names", default=NAME_MAP_PATH, help="output name mapping file")
+    args = parser.parse_args()
 
-# Generate 200 signatures with random names 
-for i in range(200): 
-    name = fake.name() # random name 
-    filename = f"signature_{i+1}.png" # Filename for the signature image
-    generate_signature(name, filename) # Generate and save the signature image
-    name_map[filename] = name # Map filename to the generated name
+    name_map = generate_gallery(args.output, range(args.count), args.seed, args.font, args.workers)
 
-# Save the name mapping to a JSON file
-# Encoding to ensure UTF-8 support, mode w for writing
-with open("signature_names.json", "w", encoding="utf-8") as f:
-    # indent for readability, ensure_ascii for UTF-8 support
-    json.dump(name_map, f, indent=4, ensure_ascii=False) 
+    # Save the name mapping to a JSON file, in signature order
+    # Encoding to ensure UTF-8 support, mode w for writing
+    ordered = {f"signature_{i + 1}.png": name_map[f"signature_{i + 1}.png"] for i in range(args.count)}
+    with open(args.names, "w", encoding="utf-8") as f:
+        # indent for readability, ensure_ascii for UTF-8 support
+        json.dump(ordered, f, indent=4, ensure_ascii=False)
 
-print("Saved name mapping to signature_names.json")
+    print(f"Saved name mapping to {args.names}")
 
-print("200 random signatures generated successfully!")
+    print(f"{args.count} random signatures generated successfully!")
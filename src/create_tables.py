@@ -17,10 +17,15 @@ def create_tables():
             person_name VARCHAR(255) NOT NULL,
             image_path TEXT NOT NULL,
             descriptors BYTEA NOT NULL,
-            created_at TIMESTAMP DEFAULT NOW()
+            created_at TIMESTAMP DEFAULT NOW(),
             quality BOOLEAN DEFAULT TRUE
         );
     """)
+    # Index on image_path so resumable bulk loads can quickly skip loaded files
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS signatures_image_path_idx
+        ON signatures (image_path);
+    """)
 
     connection.commit() # Saves the changes to the database
     # Closes the cursor and connection
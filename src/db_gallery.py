@@ -0,0 +1,155 @@
+# Import libraries
+import time # For the minimum interval between refreshes
+import threading # The cache is shared by every thread of the process
+import numpy as np # For the descriptor arrays
+from db_utils import get_pool # Pooled PostgreSQL connections
+from orb_index import DescriptorLSH # Candidate search over ORB descriptors
+
+# Define constants
+FETCH_SIZE = 5000 # Rows fetched per round trip by the server-side cursor
+OVERLAP_SECONDS = 300 # Rows read again behind the watermark, for late-committing transactions
+REFRESH_INTERVAL = 5 # Minimum seconds between two refreshes triggered by get_db_gallery()
+
+# Only good-quality rows are ever matched, newest rows from the overlap
+# window behind the watermark on
+SELECT_ALL = """
+    SELECT id, person_name, image_path, descriptors, created_at
+    FROM signatures
+    WHERE quality
+    ORDER BY created_at, id
+"""
+SELECT_AFTER = """
+    SELECT id, person_name, image_path, descriptors, created_at
+    FROM signatures
+    WHERE quality AND created_at >= %s - %s * INTERVAL '1 second'
+    ORDER BY created_at, id
+"""
+
+
+class DBGallery:
+    """
+    In-memory copy of the ORB descriptors stored in the signatures table,
+    used as the matching backend instead of the image files.
+
+    - rows are streamed with a server-side (named) cursor, fetch_size at a time
+    - refresh() only fetches rows from overlap seconds before the newest
+      created_at seen on, skipping ids already loaded: a row whose
+      transaction commits after later rows were read (parallel writers) is
+      still picked up, as long as it commits within the overlap window
+    - low-quality rows are filtered out in SQL
+    - search() has the same shape as DescriptorLSH.search, but returns
+      person names straight from the database; refresh() adds the new
+      rows first and then inserts only their ids into the LSH tables
+      (DescriptorLSH.insert), so searches run concurrently with it
+    - refresh(max_age) skips the database when the last refresh is more
+      recent than max_age seconds, and only one thread refreshes at a time
+
+    Deleted or updated rows are not seen; call reload() after such changes.
+    """
+
+    def __init__(self, fetch_size=FETCH_SIZE, n_tables=8, key_bits=16, overlap=OVERLAP_SECONDS):
+        self.fetch_size = fetch_size
+        self.n_tables = n_tables
+        self.key_bits = key_bits
+        self.overlap = overlap
+        self.watermark = None # (created_at, id) of the newest row loaded
+        self.refreshed_at = None # time.monotonic() of the last refresh
+        # (id -> (person_name, image_path, descriptors), LSH tables), replaced as one by reload()
+        self._snapshot = ({}, DescriptorLSH(n_tables, key_bits))
+        self.lock = threading.Lock()
+
+    @property
+    def rows(self):
+        return self._snapshot[0]
+
+    @property
+    def lsh(self):
+        return self._snapshot[1]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _fresh(self, max_age):
+        return self.refreshed_at is not None and time.monotonic() - self.refreshed_at < max_age
+
+    def refresh(self, max_age=0):
+        """
+        Loads rows added since the last refresh, unless it ran less than
+        max_age seconds ago. Returns how many.
+        """
+        if self._fresh(max_age):
+            return 0
+
+        with self.lock:
+            if self._fresh(max_age):
+                return 0 # Another thread refreshed while this one waited
+
+            rows, lsh = self._snapshot
+            watermark = self.watermark
+            db_pool = get_pool()
+            connection = db_pool.getconn()
+            fetched = {} # Published only once the whole fetch succeeded
+            try:
+                cursor = connection.cursor(name="signature_descriptors")
+                cursor.itersize = self.fetch_size
+                if watermark is None:
+                    cursor.execute(SELECT_ALL)
+                else:
+                    cursor.execute(SELECT_AFTER, (watermark[0], self.overlap))
+
+                for row_id, person_name, image_path, descriptors, created_at in cursor:
+                    if watermark is None or (created_at, row_id) > watermark:
+                        watermark = (created_at, row_id)
+                    if row_id in rows or row_id in fetched:
+                        continue # already loaded, read again by the overlap window
+                    fetched[row_id] = (
+                        person_name,
+                        image_path,
+                        np.frombuffer(bytes(descriptors), dtype=np.uint8).reshape(-1, 32),
+                    )
+
+                cursor.close()
+                connection.commit() # Ends the transaction holding the named cursor
+            finally:
+                db_pool.putconn(connection)
+
+            # Rows before their LSH entries: any id a search finds has its row
+            rows.update(fetched)
+            lsh.insert(list(fetched), [row[2] for row in fetched.values()])
+            self.watermark = watermark
+            self.refreshed_at = time.monotonic()
+
+            return len(fetched)
+
+    def reload(self):
+        """Drops the cache and loads every row again."""
+        with self.lock:
+            self._snapshot = ({}, DescriptorLSH(self.n_tables, self.key_bits))
+            self.watermark = None
+            self.refreshed_at = None
+        return self.refresh()
+
+    def search(self, query_img, k=3, n_candidates=20):
+        """Best (person_name, similarity) pairs for a normalized query canvas."""
+        rows, lsh = self._snapshot
+        return [
+            (rows[row_id][0], score)
+            for row_id, score in lsh.search(query_img, k, n_candidates)
+        ]
+
+
+_gallery = None # Process-wide cache
+_gallery_lock = threading.Lock()
+
+def get_db_gallery():
+    """
+    Returns the process-wide DBGallery, loading it on first use and
+    fetching only new rows on later calls, at most every REFRESH_INTERVAL
+    seconds (the refresh itself runs under the gallery's lock).
+    """
+    global _gallery
+    with _gallery_lock:
+        if _gallery is None:
+            _gallery = DBGallery()
+    _gallery.refresh(max_age=REFRESH_INTERVAL)
+    return _gallery
@@ -1,15 +1,58 @@
 import psycopg2
+from psycopg2 import pool
 import os
+import threading
 from dotenv import load_dotenv
 
 # Load environment variables from .env
 load_dotenv()
 
-def get_connection():
-    return psycopg2.connect(
+def _connection_params():
+    return dict(
         host=os.getenv("DB_HOST"),
         database=os.getenv("DB_NAME"),
         user=os.getenv("DB_USER"),
         password=os.getenv("DB_PASSWORD"),
         port=os.getenv("DB_PORT")
     )
+
+def get_connection():
+    return psycopg2.connect(**_connection_params())
+
+class _CountingPool(pool.ThreadedConnectionPool):
+    # Counts the connections currently borrowed, so get_pool can tell
+    # whether the pool may be replaced
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self.in_use = 0
+        self._count_lock = threading.Lock()
+
+    def getconn(self, key=None):
+        connection = super().getconn(key)
+        with self._count_lock:
+            self.in_use += 1
+        return connection
+
+    def putconn(self, conn=None, key=None, close=False):
+        super().putconn(conn, key, close)
+        with self._count_lock:
+            self.in_use -= 1
+
+_pool = None # Process-wide connection pool, created on first use
+
+def get_pool(minconn=1, maxconn=4):
+    """
+    Returns a thread-safe connection pool shared by the whole process,
+    so bulk jobs reuse a few open connections instead of one per row.
+    Use getconn() / putconn() to borrow and return connections.
+    An existing pool smaller than maxconn is recreated, or a ValueError is
+    raised if its connections are still in use.
+    """
+    global _pool
+    if _pool is not None and not _pool.closed and _pool.maxconn < maxconn:
+        if _pool.in_use:
+            raise ValueError(f"Connection pool already open with maxconn={_pool.maxconn} < {maxconn} and in use")
+        _pool.closeall()
+    if _pool is None or _pool.closed:
+        _pool = _CountingPool(minconn, maxconn, **_connection_params())
+    return _pool
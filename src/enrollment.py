@@ -0,0 +1,434 @@
+# Import libraries
+import os # For file handling
+import sys # For the enrollment log lines
+import time # For the enrollment latency
+import pickle # Journal records are pickled gallery entries, like the gallery index
+import shutil # For copying intake images into the gallery
+import struct # For the journal record lengths
+import asyncio # For the watcher, the enrollment queue and the metrics endpoint
+import argparse # For the command line
+from concurrent.futures import ProcessPoolExecutor # Feature extraction outside the event loop
+
+import profiling # Enrollment latency, queue depth and counters
+from signature_utils import prepare_signature
+from gallery_index import load_gallery_index, file_hash, DATABASE_DIR, INDEX_FILE, IMAGE_EXTENSIONS
+from name_index import append_names, compact_names, NAME_MAP_FILE, NAME_LOG_SUFFIX
+from ann_index import sync_ann_index
+
+# Define constants
+INTAKE_DIR = "../intake" # New signatures are dropped here as <stem>.png + <stem>.txt (the name)
+JOURNAL_FILE = "../enrollments.journal" # Enrolled entries, replayed by running query processes
+POLL_INTERVAL = 1.0 # Seconds between two scans of the intake directory
+SETTLE_SECONDS = 1.0 # A pair must stay unchanged this long before it is taken (half-written files)
+SAVE_INTERVAL = 60.0 # Seconds between two gallery index saves, once the queue is empty
+SAVE_EVERY = 1000 # Enrollments after which the index is saved even while busy
+JOURNAL_ROTATE_BYTES = 64 * 1024 * 1024 # The journal restarts past this size, once the index is saved
+COMPACT_LOG_BYTES = 1024 * 1024 # The name log is folded into the JSON file past this size
+METRICS_PORT = 9109
+
+# Only the ORB descriptors of good-quality rows are matched (see db_gallery.py);
+# the row is skipped if the image is already loaded, so a retried enrollment is harmless
+INSERT_SIGNATURE = """
+    INSERT INTO signatures (person_name, image_path, descriptors, quality)
+    SELECT %s, %s, %s, %s
+    WHERE NOT EXISTS (SELECT 1 FROM signatures WHERE image_path = %s)
+"""
+
+
+# ---------------------------------------------------------
+# Enrollment journal: how running processes learn about new entries
+# ---------------------------------------------------------
+# Append-only file: a random 16-byte file id, then length-prefixed
+# pickled gallery entries. The daemon appends, every query process reads
+# from where it stopped. When it grows past JOURNAL_ROTATE_BYTES (and the
+# gallery index holding its entries is saved), it is renamed to
+# <journal>.old and restarted with a new id.
+JOURNAL_ID_SIZE = 16
+
+class EnrollmentJournal:
+    """Reader / writer of the enrollment journal."""
+
+    def __init__(self, journal_path=JOURNAL_FILE):
+        self.path = journal_path
+        self.file_id = None # id of the file being read
+        self.offset = 0 # bytes of it already read
+        self.missed = False # set when entries were rotated away before being read
+
+    def _create(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(os.urandom(JOURNAL_ID_SIZE))
+        os.replace(tmp_path, path)
+
+    def append(self, entries):
+        """Appends entries, as one write of complete records."""
+        if not os.path.exists(self.path):
+            self._create(self.path)
+        records = [pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL) for entry in entries]
+        data = b"".join(struct.pack("<Q", len(record)) + record for record in records)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def rotate(self):
+        """Restarts the journal (its entries must already be in the saved gallery index)."""
+        if os.path.exists(self.path):
+            os.replace(self.path, self.path + ".old")
+        self._create(self.path)
+
+    def size(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def _read(self, f, offset):
+        # Complete records from offset on, and the offset after the last one
+        f.seek(offset)
+        data = f.read()
+        entries, position = [], 0
+        while position + 8 <= len(data):
+            (length,) = struct.unpack_from("<Q", data, position)
+            if position + 8 + length > len(data):
+                break # still being written
+            entries.append(pickle.loads(data[position + 8:position + 8 + length]))
+            position += 8 + length
+        return entries, offset + position
+
+    def read_new(self):
+        """Entries appended since the last call (all of them on the first call)."""
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return []
+
+        entries = []
+        with f:
+            file_id = f.read(JOURNAL_ID_SIZE)
+            if len(file_id) < JOURNAL_ID_SIZE:
+                return [] # being created
+            if self.file_id != file_id:
+                if self.file_id is not None:
+                    # Rotated: finish the previous file first, if it is still there
+                    try:
+                        with open(self.path + ".old", "rb") as old:
+                            if old.read(JOURNAL_ID_SIZE) == self.file_id:
+                                entries, _ = self._read(old, self.offset)
+                            else:
+                                self.missed = True
+                    except FileNotFoundError:
+                        self.missed = True
+                self.file_id = file_id
+                self.offset = JOURNAL_ID_SIZE
+
+            new_entries, self.offset = self._read(f, self.offset)
+        return entries + new_entries
+
+
+def apply_enrollments(gallery, journal, ann_index=None, orb_index=None):
+    """
+    Adds the entries enrolled since the last call to a running process's
+    GalleryIndex (see GalleryIndex.add_entries); names come from the name
+    log, through load_names. Falls back to a directory refresh if the
+    journal was rotated before this process read it. An IVF-PQ index
+    (ann_index.py) built over the gallery is updated incrementally, and so
+    are ORB LSH tables (orb_index.py), which are only rebuilt when entries
+    were replaced or removed. Returns the number of entries added.
+
+    A PackedGallery is read-only: rebuild the pack to publish enrollments.
+    """
+    entries = journal.read_new()
+    fresh = None # the entries new to the gallery, when nothing else changed
+    if journal.missed:
+        journal.missed = False
+        added = gallery.refresh()
+    elif entries:
+        fresh = {e["filename"]: e for e in entries if e["filename"] not in gallery.by_filename}
+        added = gallery.add_entries(entries)
+        if added != len(fresh):
+            fresh = None
+    else:
+        return 0
+    if added and ann_index is not None:
+        sync_ann_index(ann_index, gallery)
+    if added and orb_index is not None:
+        if fresh is not None:
+            orb_index.insert(list(fresh), [e["orb_descriptors"] for e in fresh.values()])
+        else:
+            orb_index.build([e["filename"] for e in gallery.entries], [e["orb_descriptors"] for e in gallery.entries])
+    profiling.count("enrollments_applied", added)
+    return added
+
+
+# ---------------------------------------------------------
+# Enrollment daemon
+# ---------------------------------------------------------
+def _prepare(image_path, fast):
+    # Worker process: the features, extracted once for every consumer
+    entry = prepare_signature(image_path, fast)
+    entry["sha1"] = file_hash(image_path)
+    return entry
+
+class EnrollmentDaemon:
+    """
+    Watches the intake directory and enrolls every <stem>.<image> +
+    <stem>.txt pair (name on the first line; write it last):
+
+    1. features extracted once, in a worker process
+    2. image copied into the gallery directory (as enrolled_<sha1>.<ext>)
+    3. optionally, the ORB descriptors inserted into PostgreSQL
+    4. name appended to the name log (see name_index.append_names)
+    5. entry added to the daemon's gallery index and appended to the
+       journal, which running query processes replay (apply_enrollments)
+    6. intake pair removed
+
+    Steps 2-6 run one enrollment at a time and are idempotent, so a pair
+    interrupted half-way is simply enrolled again. Pairs that fail go to
+    <intake>/failed with a .error.txt. The gallery index is saved at most
+    every SAVE_INTERVAL seconds when the queue is empty, after SAVE_EVERY
+    enrollments, and on exit; the journal holds the entries in between,
+    and is replayed into the index on startup.
+    """
+
+    def __init__(self, intake_dir=INTAKE_DIR, database_path=DATABASE_DIR, index_path=INDEX_FILE,
+                 names_path=NAME_MAP_FILE, journal_path=JOURNAL_FILE, workers=1, use_db=False, fast=False,
+                 poll_interval=POLL_INTERVAL):
+        self.intake_dir = intake_dir
+        self.database_path = database_path
+        self.index_path = index_path
+        self.names_path = names_path
+        self.journal = EnrollmentJournal(journal_path)
+        self.workers = workers
+        self.use_db = use_db
+        self.fast = fast
+        self.poll_interval = poll_interval
+
+        self.gallery = None
+        self.queue = None
+        self.lock = None # one commit (or index save) at a time
+        self.executor = None
+        self.db_pool = None
+        self.seen = {} # stem -> (file stats, first time seen unchanged)
+        self.pending = set() # stems queued or being enrolled
+        self.in_progress = 0
+        self.unsaved = 0 # enrollments since the gallery index was saved
+        self.saved_at = 0.0
+
+    # 1. Intake scan
+    def _ready_pairs(self, now):
+        ready = []
+        present = set() # stems with both files, to forget pairs removed from the intake
+        files = set(os.listdir(self.intake_dir))
+        for filename in sorted(files):
+            stem, ext = os.path.splitext(filename)
+            if ext.lower() not in IMAGE_EXTENSIONS or stem in self.pending or stem + ".txt" not in files:
+                continue
+            try:
+                stats = tuple((s.st_mtime_ns, s.st_size) for s in (
+                    os.stat(os.path.join(self.intake_dir, filename)),
+                    os.stat(os.path.join(self.intake_dir, stem + ".txt"))))
+            except FileNotFoundError:
+                continue
+            present.add(stem)
+            previous = self.seen.get(stem)
+            if previous is None or previous[0] != stats:
+                self.seen[stem] = (stats, now)
+            elif now - previous[1] >= SETTLE_SECONDS:
+                ready.append((stem, filename))
+        for stem in set(self.seen) - present:
+            del self.seen[stem]
+        return ready
+
+    def _update_gauges(self):
+        profiling.gauge("enroll_queue_depth", self.queue.qsize())
+        profiling.gauge("enroll_in_progress", self.in_progress)
+
+    async def _watch(self, once=False):
+        while True:
+            for stem, filename in self._ready_pairs(time.monotonic()):
+                self.pending.add(stem)
+                self.seen.pop(stem, None)
+                await self.queue.put((stem, filename, time.monotonic()))
+                profiling.count("enroll_detected")
+            self._update_gauges()
+
+            idle = self.queue.empty() and not self.in_progress
+            finishing = once and idle and not self.seen
+            if self.unsaved and (finishing or self.unsaved >= SAVE_EVERY
+                                 or (idle and time.monotonic() - self.saved_at >= SAVE_INTERVAL)):
+                async with self.lock:
+                    await asyncio.get_running_loop().run_in_executor(None, self._save)
+            if finishing:
+                return
+            await asyncio.sleep(self.poll_interval)
+
+    # 2. Enrollment
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            stem, filename, detected = await self.queue.get()
+            self.in_progress += 1
+            self._update_gauges()
+            image_path = os.path.join(self.intake_dir, filename)
+            name_path = os.path.join(self.intake_dir, stem + ".txt")
+            try:
+                with open(name_path, "r", encoding="utf-8") as f:
+                    person_name = f.readline().strip()
+                if not person_name:
+                    raise ValueError("Empty name file")
+
+                entry = await loop.run_in_executor(self.executor, _prepare, image_path, self.fast)
+                async with self.lock:
+                    gallery_filename = await loop.run_in_executor(
+                        None, self._commit, entry, person_name, image_path, name_path)
+            except Exception as e:
+                profiling.count("enroll_failed")
+                print(f"Enrollment of {filename} failed: {type(e).__name__}: {e}", file=sys.stderr)
+                self._reject(stem, filename, f"{type(e).__name__}: {e}")
+            else:
+                latency = time.monotonic() - detected
+                profiling.count("enrolled")
+                profiling.record("enroll_latency", latency)
+                print(f"Enrolled {filename} -> {gallery_filename} ({person_name}) in {latency * 1000:.0f} ms", file=sys.stderr)
+            finally:
+                self.in_progress -= 1
+                self.pending.discard(stem)
+                self._update_gauges()
+                self.queue.task_done()
+
+    def _commit(self, entry, person_name, image_path, name_path):
+        # Steps 2-6 (runs in a thread, under the commit lock)
+        ext = os.path.splitext(image_path)[1].lower()
+        filename = f"enrolled_{entry['sha1'][:16]}{ext}"
+        target = os.path.join(self.database_path, filename)
+
+        # Copied then renamed, so directory scans never see half an image
+        # (the .tmp name does not end with an image extension)
+        tmp_path = target + ".tmp"
+        shutil.copyfile(image_path, tmp_path)
+        os.replace(tmp_path, target)
+        stat = os.stat(target)
+        entry.update({"filename": filename, "mtime_ns": stat.st_mtime_ns, "size": stat.st_size})
+
+        if self.db_pool is not None:
+            self._insert_db(entry, person_name)
+
+        append_names({filename: person_name}, self.names_path)
+        if self.gallery.add_entries([entry]):
+            self.journal.append([entry])
+            self.unsaved += 1
+
+        os.remove(image_path)
+        os.remove(name_path)
+        return filename
+
+    def _insert_db(self, entry, person_name):
+        import psycopg2 # Only needed with --db
+
+        image_path = os.path.join(os.path.basename(os.path.abspath(self.database_path)), entry["filename"])
+        descriptors = entry["orb_descriptors"]
+        connection = self.db_pool.getconn()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(INSERT_SIGNATURE, (person_name, image_path, psycopg2.Binary(descriptors.tobytes()),
+                                              len(descriptors) >= 20, image_path))
+            connection.commit()
+            cursor.close()
+        finally:
+            self.db_pool.putconn(connection)
+
+    def _reject(self, stem, filename, message):
+        failed_dir = os.path.join(self.intake_dir, "failed")
+        os.makedirs(failed_dir, exist_ok=True)
+        for name in (filename, stem + ".txt"):
+            try:
+                os.replace(os.path.join(self.intake_dir, name), os.path.join(failed_dir, name))
+            except FileNotFoundError:
+                pass
+        with open(os.path.join(failed_dir, stem + ".error.txt"), "w", encoding="utf-8") as f:
+            f.write(message + "\n")
+
+    # 3. Index load, save, journal rotation and name log compaction
+    def _load(self):
+        # The saved index plus the journal entries enrolled after it was
+        # saved, so their images are not processed again by the refresh
+        return load_gallery_index(self.database_path, self.index_path, entries=self.journal.read_new())
+
+    def _save(self):
+        self.gallery.save(self.index_path)
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
+        if self.journal.size() > JOURNAL_ROTATE_BYTES:
+            self.journal.rotate() # every journal entry is in the saved index
+        log_path = self.names_path + NAME_LOG_SUFFIX
+        if os.path.exists(log_path) and os.path.getsize(log_path) > COMPACT_LOG_BYTES:
+            compact_names(self.names_path)
+
+    # 4. Metrics endpoint (Prometheus text on GET /metrics)
+    async def _serve_metrics(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            while (await reader.readline()).strip(): # skip the headers
+                pass
+            if len(request_line) >= 2 and request_line[0] == "GET" and request_line[1] == "/metrics":
+                status, body = "200 OK", profiling.metrics.prometheus_text()
+            else:
+                status, body = "404 Not Found", "Not found\n"
+            body = body.encode("utf-8")
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def run(self, once=False, metrics_port=None):
+        """Runs the daemon (until cancelled, or until the intake is empty with once=True)."""
+        profiling.enable()
+        os.makedirs(self.intake_dir, exist_ok=True)
+        loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.lock = asyncio.Lock()
+        self.gallery = await loop.run_in_executor(None, self._load)
+        self.saved_at = time.monotonic()
+        if self.use_db:
+            from db_utils import get_pool # Only needed with --db
+            self.db_pool = get_pool()
+
+        server = None
+        if metrics_port:
+            server = await asyncio.start_server(self._serve_metrics, "127.0.0.1", metrics_port)
+
+        with ProcessPoolExecutor(max_workers=self.workers) as self.executor:
+            workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+            try:
+                await self._watch(once)
+            finally:
+                for task in workers:
+                    task.cancel()
+                if server is not None:
+                    server.close()
+                if self.unsaved:
+                    self._save()
+
+
+# Run the daemon when this script is executed directly
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Enroll new signatures dropped into an intake directory.")
+    parser.add_argument("--intake", default=INTAKE_DIR, help="directory watched for <stem>.png + <stem>.txt pairs")
+    parser.add_argument("--database", default=DATABASE_DIR, help="gallery image directory")
+    parser.add_argument("--index", default=INDEX_FILE, help="gallery index file")
+    parser.add_argument("--names", default=NAME_MAP_FILE, help="filename -> name mapping")
+    parser.add_argument("--journal", default=JOURNAL_FILE, help="journal replayed by running query processes")
+    parser.add_argument("--workers", type=int, default=1, help="feature extraction processes")
+    parser.add_argument("--db", action="store_true", help="also insert the ORB descriptors into PostgreSQL")
+    parser.add_argument("--fast", action="store_true", help="fast preprocessing (large scans)")
+    parser.add_argument("--poll", type=float, default=POLL_INTERVAL, help="seconds between intake scans")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="port of GET /metrics (0 disables it)")
+    parser.add_argument("--once", action="store_true", help="enroll what is in the intake and exit")
+    args = parser.parse_args()
+
+    daemon = EnrollmentDaemon(args.intake, args.database, args.index, args.names, args.journal,
+                              args.workers, args.db, args.fast, args.poll)
+    try:
+        asyncio.run(daemon.run(args.once, args.metrics_port))
+    except KeyboardInterrupt:
+        pass
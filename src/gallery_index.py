@@ -0,0 +1,362 @@
+# Import libraries
+import os # For file handling
+import hashlib # For content hashes of the gallery images
+import pickle # For saving the index to disk
+import argparse # For the build command line
+import numpy as np # For the stacked canvas array
+
+from signature_utils import prepare_signature, template_norms, ssim_stats, pack_canvas, chamfer_distance_maps, append_rows, LetterMatrix # Per-image preprocessing
+
+# Define constants
+DATABASE_DIR = "../generated_signatures" # Directory containing gallery images
+INDEX_FILE = "../gallery_index.pkl" # File where the built index is stored
+INDEX_VERSION = 4 # Bump when the stored features change, forces a full rebuild
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+
+def file_hash(path):
+    """Returns the SHA-1 of a file's content."""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _entry_columns(entries):
+    return {
+        "is_cursive": np.array([bool(e["is_cursive"]) for e in entries], dtype=bool),
+        "ink": np.array([e["ink"] for e in entries], dtype=np.int64),
+        "aspect": np.array([e["aspect"] for e in entries], dtype=np.float64),
+        "letter_count": np.array([len(e["letters"]) for e in entries], dtype=np.int64),
+    }
+
+
+class GalleryIndex:
+    """
+    Precomputed features for every image of the gallery directory.
+
+    Each entry stores the normalized 600x180 canvas, the quality and cursive
+    flags, the 40x60 letter crops, the global descriptor and the ORB
+    descriptors, plus the mtime, size and content hash of the file it was
+    built from.
+    """
+
+    def __init__(self, database_path=DATABASE_DIR):
+        self.database_path = database_path
+        self.version = INDEX_VERSION
+        self.by_filename = {} # filename -> entry
+        self.entries = [] # entries in directory listing order
+        self._stack = None # cached N x 180 x 600 canvas array
+        self._norms = None # cached centered norms of the canvases
+        self._descriptors = None # cached N x D global descriptor matrix
+        self._ssim = {} # cached SSIM statistics, by canvas size
+        self._packed = None # cached N x 180 x 75 bit-packed ink masks
+        self._chamfer = None # cached N x 180 x 600 truncated distance maps of the masks
+        self._letters = None # cached LetterMatrix of all gallery letters
+        self._rows = None # cached filename -> row mapping
+        self._columns = None # cached per-entry scalars as arrays (see entry_columns)
+        self.generation = 0 # incremented on every change, for result caches
+
+    def __getstate__(self):
+        # Derived arrays are rebuilt on demand, no need to store them twice
+        state = self.__dict__.copy()
+        state["_stack"] = None
+        state["_norms"] = None
+        state["_descriptors"] = None
+        state["_ssim"] = {}
+        state["_packed"] = None
+        state["_chamfer"] = None
+        state["_letters"] = None
+        state["_rows"] = None
+        state["_columns"] = None
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault("_stack", None)
+        state.setdefault("_norms", None)
+        state.setdefault("_descriptors", None)
+        state.setdefault("_ssim", {})
+        state.setdefault("_packed", None)
+        state.setdefault("_chamfer", None)
+        state.setdefault("_letters", None)
+        state.setdefault("_rows", None)
+        state.setdefault("_columns", None)
+        state.setdefault("generation", 0)
+        self.__dict__.update(state)
+
+    def refresh(self, verify_hashes=False):
+        """
+        Brings the index up to date with the gallery directory.
+
+        - new files are processed
+        - removed files are dropped
+        - files whose mtime or size changed are hashed, and processed again
+          if the content hash differs
+        - with verify_hashes=True every file is hashed, which also catches
+          content changes that kept the same mtime
+
+        Returns the number of entries that were added, rebuilt or removed.
+        """
+        changed = 0
+        by_filename = {}
+
+        for filename in os.listdir(self.database_path):
+            if not filename.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+
+            file_path = os.path.join(self.database_path, filename)
+            stat = os.stat(file_path)
+            entry = self.by_filename.get(filename)
+
+            if entry is not None:
+                same_stat = entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size
+
+                if same_stat and not verify_hashes:
+                    by_filename[filename] = entry
+                    continue
+
+                digest = file_hash(file_path)
+                if digest == entry["sha1"]:
+                    # Only the timestamp moved, the features are still valid
+                    entry["mtime_ns"] = stat.st_mtime_ns
+                    entry["size"] = stat.st_size
+                    by_filename[filename] = entry
+                    continue
+            else:
+                digest = file_hash(file_path)
+
+            entry = prepare_signature(file_path)
+            entry.update({
+                "filename": filename,
+                "mtime_ns": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "sha1": digest,
+            })
+            by_filename[filename] = entry
+            changed += 1
+
+        changed += len(set(self.by_filename) - set(by_filename))
+
+        self.by_filename = by_filename
+        self.entries = list(by_filename.values())
+        if changed:
+            self._stack = None
+            self._norms = None
+            self._descriptors = None
+            self._ssim = {}
+            self._packed = None
+            self._chamfer = None
+            self._letters = None
+            self._rows = None
+            self._columns = None
+            self.generation += 1
+
+        return changed
+
+    def add_entries(self, entries):
+        """
+        Adds prepared entries (prepare_signature output plus filename,
+        mtime_ns, size and sha1, as built by refresh) without rescanning the
+        directory. Entries already present with the same content are
+        skipped, changed ones replaced. When only new entries arrive, the
+        cached arrays grow in place (see append_rows) instead of being copied
+        whole. Returns the number added or replaced.
+        """
+        new, replaced = [], False
+        for entry in entries:
+            current = self.by_filename.get(entry["filename"])
+            if current is not None:
+                if current["sha1"] == entry["sha1"]:
+                    continue
+                replaced = True
+            self.by_filename[entry["filename"]] = entry
+            new.append(entry)
+        if not new:
+            return 0
+
+        if replaced:
+            self.entries = list(self.by_filename.values())
+            self._rows = None
+            self._stack = None
+            self._norms = None
+            self._descriptors = None
+            self._ssim = {}
+            self._packed = None
+            self._chamfer = None
+            self._letters = None
+            self._columns = None
+        else:
+            if self._rows is not None:
+                self._rows.update((e["filename"], len(self.entries) + i) for i, e in enumerate(new))
+            self.entries.extend(new)
+            canvases = np.stack([e["canvas"] for e in new])
+            if self._stack is not None:
+                self._stack = append_rows(self._stack, canvases)
+            if self._norms is not None:
+                self._norms = append_rows(self._norms, template_norms(canvases))
+            if self._descriptors is not None:
+                self._descriptors = append_rows(self._descriptors, [e["descriptor"] for e in new])
+            if self._packed is not None or self._chamfer is not None:
+                packed = np.array([pack_canvas(c) for c in canvases], dtype=np.uint8)
+                if self._packed is not None:
+                    self._packed = append_rows(self._packed, packed)
+                if self._chamfer is not None:
+                    self._chamfer = append_rows(self._chamfer, chamfer_distance_maps(packed))
+            if self._letters is not None:
+                self._letters.append([e["letters"] for e in new])
+            if self._columns is not None:
+                added = _entry_columns(new)
+                self._columns = {name: append_rows(self._columns[name], added[name]) for name in added}
+            self._ssim = {
+                size: tuple(append_rows(old, added) for old, added in zip(stats, ssim_stats(canvases, size)))
+                for size, stats in self._ssim.items()
+            }
+        self.generation += 1
+
+        return len(new)
+
+    def canvas_stack(self):
+        """All canvases as one N x 180 x 600 uint8 array, in entry order."""
+        if self._stack is None:
+            if self.entries:
+                self._stack = np.stack([e["canvas"] for e in self.entries])
+            else:
+                self._stack = np.empty((0, 180, 600), dtype=np.uint8)
+        return self._stack
+
+    def canvas_norms(self):
+        """Centered L2 norms of the canvases, for batch_template_scores."""
+        if self._norms is None:
+            self._norms = template_norms(self.canvas_stack())
+        return self._norms
+
+    def packed_masks(self):
+        """Bit-packed ink masks of all canvases (N x 180 x 75), for batch_binary_scores."""
+        if self._packed is None:
+            self._packed = np.array([pack_canvas(e["canvas"]) for e in self.entries], dtype=np.uint8).reshape(-1, 180, 75)
+        return self._packed
+
+    def chamfer_distance_maps(self):
+        """Truncated distance maps of the ink masks (N x 180 x 600 uint8), for the chamfer metric."""
+        if self._chamfer is None:
+            self._chamfer = chamfer_distance_maps(self.packed_masks())
+        return self._chamfer
+
+    def letter_matrix(self):
+        """All gallery letters as one LetterMatrix, for batched letter matching."""
+        if self._letters is None:
+            self._letters = LetterMatrix.from_letter_lists([e["letters"] for e in self.entries])
+        return self._letters
+
+    def ssim_stats(self, size=(400, 120)):
+        """
+        SSIM statistics of all canvases at the given size, for
+        batch_ssim_scores (three float32 arrays, about 0.6 MB per entry
+        at 400 x 120).
+        """
+        if size not in self._ssim:
+            self._ssim[size] = ssim_stats(self.canvas_stack(), size)
+        return self._ssim[size]
+
+    def descriptor_matrix(self):
+        """Global descriptors of all entries as one N x D float32 matrix."""
+        if self._descriptors is None:
+            self._descriptors = np.array([e["descriptor"] for e in self.entries], dtype=np.float32)
+        return self._descriptors
+
+    def entry_columns(self):
+        """
+        Per-entry scalars used to filter candidates, as arrays in entry order:
+        is_cursive, ink, aspect and letter_count. Lets a scan test every
+        candidate without touching the entry dicts.
+        """
+        if self._columns is None:
+            self._columns = _entry_columns(self.entries)
+        return self._columns
+
+    def filename(self, i):
+        return self.entries[i]["filename"]
+
+    def entry_letters(self, i):
+        return self.entries[i]["letters"]
+
+    def rows_of(self, filenames):
+        """Row numbers of the given filenames (unknown ones skipped), in index order."""
+        if self._rows is None:
+            self._rows = {e["filename"]: i for i, e in enumerate(self.entries)}
+        return sorted(self._rows[f] for f in filenames if f in self._rows)
+
+    def save_canvas_stack(self, npy_path):
+        """
+        Saves the canvas stack as a .npy file, rows in entry order,
+        so it can be opened with np.load(npy_path, mmap_mode="r").
+        """
+        np.save(npy_path, self.canvas_stack())
+
+    def save(self, index_path=INDEX_FILE):
+        """Writes the index to disk (atomically, through a temporary file of this process)."""
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, index_path)
+
+    @staticmethod
+    def load(index_path=INDEX_FILE):
+        """Reads an index written by save()."""
+        with open(index_path, "rb") as f:
+            return pickle.load(f)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def build_gallery_index(database_path=DATABASE_DIR, index_path=INDEX_FILE):
+    """Builds the index from scratch and saves it."""
+    index = GalleryIndex(database_path)
+    index.refresh()
+    index.save(index_path)
+    return index
+
+
+def load_gallery_index(database_path=DATABASE_DIR, index_path=INDEX_FILE, verify_hashes=False, entries=None):
+    """
+    Loads the saved index and refreshes stale entries.
+    Builds it if missing, or if it was made for another directory or version.
+    entries (prepared as by refresh, e.g. replayed from the enrollment
+    journal) are added to the saved index first, so that the refresh does
+    not process their images again.
+    The refreshed index is saved back when anything changed.
+    """
+    index = None
+    if os.path.exists(index_path):
+        index = GalleryIndex.load(index_path)
+
+        if (getattr(index, "version", None) != INDEX_VERSION
+                or os.path.abspath(index.database_path) != os.path.abspath(database_path)):
+            index = None
+
+    if index is None:
+        return build_gallery_index(database_path, index_path)
+
+    added = index.add_entries(entries) if entries else 0 # the refresh drops those whose image is gone
+    if index.refresh(verify_hashes=verify_hashes) or added:
+        index.save(index_path)
+
+    return index
+
+
+# Build the index when this script is executed directly
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the precomputed gallery index.")
+    parser.add_argument("--database", default=DATABASE_DIR, help="gallery image directory")
+    parser.add_argument("--index", default=INDEX_FILE, help="output index file")
+    parser.add_argument("--stack", default=None, help="also save the canvases as a .npy stack")
+    args = parser.parse_args()
+
+    index = build_gallery_index(args.database, args.index)
+    print(f"Indexed {len(index)} signatures into {args.index}")
+
+    if args.stack:
+        index.save_canvas_stack(args.stack)
+        print(f"Saved canvas stack to {args.stack}")
@@ -1,9 +1,16 @@
 # Import libraries
 import os # For file handling
 import json # For JSON handling
+import time # For throughput reporting
+import queue # Bounded queue between feature extraction and DB writers
+import threading # For the DB writer threads
+import argparse # For the command line
+from collections import deque # Sliding window of in-flight extraction jobs
+from concurrent.futures import ProcessPoolExecutor # Parallel feature extraction
 import psycopg2 # For PostgreSQL connection
-from db_utils import get_connection # Import DB connection utility
-from signature_utils import extract_features  # Import feature extraction function
+from psycopg2.extras import execute_values # Multi-row INSERTs
+from db_utils import get_connection, get_pool # Import DB connection utilities
+from signature_utils import extract_orb_features  # Import feature extraction function
 
 # Define constants
 SIGNATURE_DIR = "generated_signatures" # Directory containing signature images
@@ -38,9 +45,195 @@ def insert_signature(person_name, image_path, descriptors, quality):
     cursor.close()
     connection.close()
 
+# Function to insert many signature rows with one statement and one commit
+def insert_signatures_batch(connection, rows):
+    """Insert a batch of (person_name, image_path, descriptors, quality) rows."""
+    cursor = connection.cursor()
+
+    execute_values(
+        cursor,
+        """
+        INSERT INTO signatures (
+            person_name,
+            image_path,
+            descriptors,
+            quality)
+        VALUES %s
+        """,
+        [(name, path, psycopg2.Binary(descriptors), quality) for name, path, descriptors, quality in rows],
+        page_size=len(rows)
+    )
+
+    connection.commit()
+    cursor.close()
+
+# Function to list the images that a previous (interrupted) load already inserted
+def loaded_image_paths(connection):
+    """Return the set of image_path values already in the signatures table."""
+    cursor = connection.cursor()
+    cursor.execute("SELECT image_path FROM signatures")
+    paths = {row[0] for row in cursor.fetchall()}
+    cursor.close()
+    return paths
+
+# Worker function: runs in a separate process
+def _extract_row(job):
+    person_name, image_path = job
+    _, descriptors, quality = extract_orb_features(image_path)
+    return person_name, image_path, descriptors.tobytes(), quality
+
+# Writer thread: drains the queue in batches, one pooled connection each.
+# An error is recorded in errors for bulk_load_signatures to raise
+def _write_batches(rows_queue, db_pool, batch_size, progress, errors):
+    connection = db_pool.getconn()
+    failed = False
+    try:
+        done = False
+        while not done:
+            batch = []
+            row = rows_queue.get()
+            while row is not None:
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    break
+                try:
+                    row = rows_queue.get(timeout=0.5)
+                except queue.Empty:
+                    break
+            else:
+                done = True
+
+            if batch:
+                insert_signatures_batch(connection, batch)
+                progress.add(len(batch))
+    except Exception as e:
+        failed = True
+        errors.append(e)
+        print(f"DB writer stopped: {type(e).__name__}: {e}")
+    finally:
+        db_pool.putconn(connection, close=failed) # A failed connection is not reused
+
+# Put a row on the queue, failing instead of blocking forever if every writer died
+def _put_row(rows_queue, row, writer_threads):
+    while True:
+        try:
+            rows_queue.put(row, timeout=1)
+            return
+        except queue.Full:
+            if not any(thread.is_alive() for thread in writer_threads):
+                raise RuntimeError("All DB writer threads stopped, aborting the load.")
+
+# Queue an extracted row; an image that failed is reported and skipped
+def _queue_result(rows_queue, job, future, writer_threads, skipped):
+    try:
+        row = future.result()
+    except Exception as e:
+        skipped.append(job[1])
+        print(f"Skipped {job[1]}: {type(e).__name__}: {e}")
+        return
+    _put_row(rows_queue, row, writer_threads)
+
+class _Progress:
+    """Thread-safe row counter that prints rows/s every report_every rows."""
+
+    def __init__(self, total, report_every):
+        self.total = total
+        self.report_every = report_every
+        self.count = 0
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.next_report = report_every
+
+    def add(self, n):
+        with self.lock:
+            self.count += n
+            if self.count >= self.next_report or self.count == self.total:
+                self.next_report += self.report_every
+                print(f"Inserted {self.count}/{self.total} rows | {self.rate():.1f} rows/s")
+
+    def rate(self):
+        return self.count / max(time.perf_counter() - self.start, 1e-9)
+
+# Bulk mode: parallel extraction, bounded queue, batched inserts over a pool
+def bulk_load_signatures(workers=4, writers=2, batch_size=500, queue_size=2000):
+    """
+    Load all signatures with:
+    - feature extraction in a pool of worker processes
+    - a bounded queue between extraction and the DB writers (backpressure)
+    - writer threads inserting batches with execute_values over pooled connections
+    - resume: image paths already in the table are skipped, and every batch
+      is committed on its own, so an interrupted load can simply be re-run
+    - an image whose features cannot be extracted is reported and skipped
+
+    Raises RuntimeError if a writer failed or rows were not all inserted
+    (the committed batches stay, re-run to resume).
+    """
+    db_pool = get_pool(minconn=1, maxconn=writers + 1)
+
+    connection = db_pool.getconn()
+    try:
+        already_loaded = loaded_image_paths(connection)
+    finally:
+        db_pool.putconn(connection)
+
+    jobs = []
+    for filename in sorted(os.listdir(SIGNATURE_DIR)):
+        if not filename.lower().endswith(".png"): # Only process PNG files
+            continue
+        image_path = os.path.join(SIGNATURE_DIR, filename)
+        if image_path in already_loaded:
+            continue
+        jobs.append((name_map.get(filename, "Unknown"), image_path))
+
+    print(f"{len(already_loaded)} signatures already loaded, {len(jobs)} to insert.")
+    if not jobs:
+        return 0
+
+    rows_queue = queue.Queue(maxsize=queue_size)
+    progress = _Progress(len(jobs), report_every=batch_size)
+    errors = [] # exceptions of failed writers
+    skipped = [] # images whose features could not be extracted
+
+    writer_threads = [
+        threading.Thread(target=_write_batches, args=(rows_queue, db_pool, batch_size, progress, errors), daemon=True)
+        for _ in range(writers)
+    ]
+    for thread in writer_threads:
+        thread.start()
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Keep at most queue_size extraction jobs in flight
+            pending = deque()
+            for job in jobs:
+                pending.append((job, executor.submit(_extract_row, job)))
+                if len(pending) >= queue_size:
+                    _queue_result(rows_queue, *pending.popleft(), writer_threads, skipped)
+            while pending:
+                _queue_result(rows_queue, *pending.popleft(), writer_threads, skipped)
+    finally:
+        for _ in writer_threads:
+            if any(thread.is_alive() for thread in writer_threads):
+                _put_row(rows_queue, None, writer_threads) # One stop signal per writer
+        for thread in writer_threads:
+            thread.join()
+
+    if errors:
+        raise RuntimeError(f"{len(errors)} DB writer(s) failed, {progress.count}/{len(jobs)} rows inserted") from errors[0]
+    if progress.count != len(jobs) - len(skipped):
+        raise RuntimeError(f"Only {progress.count}/{len(jobs) - len(skipped)} rows inserted")
+
+    print(f"Bulk load finished: {progress.count} rows in "
+          f"{time.perf_counter() - progress.start:.1f} s ({progress.rate():.1f} rows/s), "
+          f"{len(skipped)} unreadable images skipped")
+    return progress.count
+
 # Function to load all signatures from the directory and insert into DB
-def load_all_signatures():
+def load_all_signatures(bulk=False, workers=4, writers=2, batch_size=500):
     """Load all signatures from folder and insert into DB."""
+    if bulk:
+        return bulk_load_signatures(workers, writers, batch_size)
+
     files = os.listdir(SIGNATURE_DIR) # List all files in the signature directory
 
     for filename in files:
@@ -56,10 +249,10 @@ def load_all_signatures():
         # Extract ORB descriptors + quality flag
         # _ as we don't need keypoints here since we only store descriptors because 
         # they are sufficient for matching
-        _, descriptors, quality = extract_features(image_path)
+        _, descriptors, quality = extract_orb_features(image_path)
 
-        # Insert into DB
-        insert_signature(person_name, image_path, descriptors, quality)
+        # Insert into DB (N x 32 uint8 array stored as raw bytes)
+        insert_signature(person_name, image_path, descriptors.tobytes(), quality)
 
         print(f"Inserted: {filename} → {person_name} | Quality: {quality}")
 
@@ -67,4 +260,11 @@ def load_all_signatures():
 
 # Run the loading function when this script is executed directly
 if __name__ == "__main__":
-    load_all_signatures()
+    parser = argparse.ArgumentParser(description="Load the generated signatures into PostgreSQL.")
+    parser.add_argument("--bulk", action="store_true", help="parallel, batched and resumable load")
+    parser.add_argument("--workers", type=int, default=4, help="feature extraction processes (bulk mode)")
+    parser.add_argument("--writers", type=int, default=2, help="DB writer threads (bulk mode)")
+    parser.add_argument("--batch-size", type=int, default=500, help="rows per INSERT (bulk mode)")
+    args = parser.parse_args()
+
+    load_all_signatures(args.bulk, args.workers, args.writers, args.batch_size)
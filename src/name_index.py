@@ -0,0 +1,266 @@
+# Import libraries
+import os # For file handling
+import json # For loading the name mapping
+import difflib # Same similarity as the original linear scan
+import threading # The cached index is shared by every thread
+from collections import defaultdict # For the inverted index
+import numpy as np # For counting shared trigrams
+
+import profiling # Times the JSON loading
+
+# Define constants
+NAME_MAP_FILE = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "signature_names.json"))
+OCR_MATCH_THRESHOLD = 0.6 # Minimum SequenceMatcher ratio accepted as a name match
+NAME_LOG_SUFFIX = ".log" # Append-only log of names enrolled since the JSON file was written
+
+
+ALPHABET = "abcdefghijklmnopqrstuvwxyz0123456789 .-'" # any other character shares one slot
+_SLOTS = np.full(128, len(ALPHABET), dtype=np.int64) # ASCII code -> histogram slot
+_SLOTS[[ord(c) for c in ALPHABET]] = np.arange(len(ALPHABET))
+
+
+def _char_count_matrix(texts):
+    # Character histogram per text (uint16: no overflow below 65536
+    # repeats); counting all unknown characters together can only
+    # overestimate the overlap, so the bound built from it stays an upper bound
+    codes = np.frombuffer("".join(texts).encode("utf-32-le"), dtype=np.uint32)
+    slots = _SLOTS[np.minimum(codes, 127)]
+    slots[codes > 127] = len(ALPHABET)
+    rows = np.repeat(np.arange(len(texts)), [len(text) for text in texts])
+    counts = np.bincount(rows * (len(ALPHABET) + 1) + slots, minlength=len(texts) * (len(ALPHABET) + 1))
+    return counts.reshape(len(texts), len(ALPHABET) + 1).astype(np.uint16)
+
+
+def _char_counts(text):
+    return _char_count_matrix([text])[0]
+
+
+def _trigrams(text):
+    # Padded so that short names and word starts / ends still produce trigrams
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    """
+    Index over the enrolled names, for matching OCR text without computing
+    the full ratio against every name.
+
+    Candidates come from a trigram inverted index: only the names sharing
+    at least one (padded) character trigram with the text are considered,
+    so a lookup touches the postings of the text's trigrams instead of
+    every name. Among them, names are visited by decreasing upper bound of
+    the ratio (length and character counts, computed for all candidates at
+    once, then quick_ratio) and scored with the same
+    difflib.SequenceMatcher ratio as the original linear scan; the visit
+    stops once no remaining bound can beat the best score.
+
+    The answer equals the linear scan's unless the best name shares no
+    trigram with the text: its matching characters would then all come in
+    runs of at most two, which a ratio above OCR_MATCH_THRESHOLD allows only
+    for heavily garbled text (e.g. "aem lkawgen" against "James Lawrence",
+    0.64), where a near-equal name sharing trigrams is usually found instead.
+    """
+
+    def __init__(self, name_map):
+        self.names = [] # unique names, in first-appearance order
+        self.lowered = []
+        self.seen = set()
+        for person_name in name_map.values():
+            if person_name in self.seen:
+                continue
+            self.seen.add(person_name)
+            self.names.append(person_name)
+            self.lowered.append(person_name.lower())
+
+        postings = defaultdict(list)
+        for position, name in enumerate(self.lowered):
+            for trigram in _trigrams(name):
+                postings[trigram].append(position)
+        self.postings = {t: np.array(p, dtype=np.int64) for t, p in postings.items()}
+        self.lengths = np.array([len(name) for name in self.lowered], dtype=np.int64)
+        self.char_counts = _char_count_matrix(self.lowered)
+
+    def extend(self, person_names):
+        """
+        Adds newly enrolled names in place, without re-indexing the others.
+        Lookups running on other threads stay valid: the per-name arrays
+        grow before the postings can point at the new positions.
+        """
+        new_names = []
+        for person_name in person_names:
+            if person_name not in self.seen:
+                self.seen.add(person_name)
+                new_names.append(person_name)
+        if not new_names:
+            return
+
+        start = len(self.names)
+        lowered = [name.lower() for name in new_names]
+        self.names.extend(new_names)
+        self.lowered.extend(lowered)
+        self.lengths = np.concatenate([self.lengths, [len(name) for name in lowered]])
+        self.char_counts = np.concatenate([self.char_counts, _char_count_matrix(lowered)])
+
+        additions = defaultdict(list)
+        for position, name in enumerate(lowered, start=start):
+            for trigram in _trigrams(name):
+                additions[trigram].append(position)
+        postings = dict(self.postings)
+        for trigram, positions in additions.items():
+            if trigram in postings:
+                postings[trigram] = np.concatenate([postings[trigram], positions])
+            else:
+                postings[trigram] = np.array(positions, dtype=np.int64)
+        self.postings = postings
+
+    def __len__(self):
+        return len(self.names)
+
+    def candidates(self, text_clean):
+        """
+        (positions, bounds) of the names sharing a trigram with the text whose
+        length / character-overlap bound reaches the threshold, highest bound
+        first (then most shared trigrams, then earliest enrolled).
+        """
+        # Read in the reverse order of extend(), so no posting points past the arrays
+        postings = self.postings
+        hits = [postings[t] for t in _trigrams(text_clean) if t in postings]
+        if not hits:
+            return [], []
+        positions, shared = np.unique(np.concatenate(hits), return_counts=True)
+
+        # Length and character-overlap bounds (like SequenceMatcher's
+        # real_quick_ratio / quick_ratio), for all candidates at once
+        lengths = self.lengths[positions]
+        overlap = np.minimum(self.char_counts[positions], _char_counts(text_clean)).sum(axis=1)
+        bound = 2.0 * np.minimum(overlap, np.minimum(lengths, len(text_clean))) / np.maximum(lengths + len(text_clean), 1)
+        keep = bound >= OCR_MATCH_THRESHOLD
+        positions, shared, bound = positions[keep], shared[keep], bound[keep]
+
+        order = np.lexsort((positions, -shared, -bound))
+        return positions[order].tolist(), bound[order].tolist()
+
+    def best_match(self, text_clean):
+        """
+        Best (name, ratio) for already lower-cased OCR text, or (None, 0).
+        Names whose ratio is below the threshold are never returned.
+
+        Candidates are visited by decreasing bound, so the visit ends at the
+        first bound below the best score; a tie goes to the earlier enrolled
+        name, like the original linear scan.
+        """
+        matcher = difflib.SequenceMatcher(None, b=text_clean) # b is analysed once
+        best_match = None
+        best_score = 0
+        best_position = -1
+
+        def cannot_win(bound, position):
+            return (bound < OCR_MATCH_THRESHOLD or bound < best_score
+                    or (bound == best_score and position > best_position))
+
+        positions, bounds = self.candidates(text_clean)
+        for position, bound in zip(positions, bounds):
+            if bound < best_score:
+                break # every later bound is lower still
+            if cannot_win(bound, position):
+                continue
+            matcher.set_seq1(self.lowered[position])
+
+            # Cheap upper bounds first, the full ratio only when they pass
+            if cannot_win(matcher.quick_ratio(), position):
+                continue
+
+            score = matcher.ratio()
+            if score > best_score or (score == best_score and position < best_position):
+                best_score = score
+                best_match = self.names[position]
+                best_position = position
+
+        return best_match, best_score
+
+
+def _read_name_log(log_path, offset):
+    # Complete {"filename", "name"} lines from offset on, and the offset
+    # after the last complete line (a line still being written is left
+    # for the next call)
+    try:
+        with open(log_path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+    except FileNotFoundError:
+        return [], 0
+    end = data.rfind(b"\n") + 1
+    records = [json.loads(line) for line in data[:end].decode("utf-8").splitlines() if line.strip()]
+    return records, offset + end
+
+
+_cached = {} # name map path -> [mtime, log offset, name_map, NameIndex]
+_cached_lock = threading.Lock()
+
+def load_names(mapping_path=NAME_MAP_FILE):
+    """
+    Returns (name_map, NameIndex) for the mapping file, read and indexed
+    once and reloaded only when the file changes.
+
+    Names appended to the mapping's log (see append_names) are added to
+    both in place, so an enrollment does not reload the whole file.
+    """
+    mtime = os.stat(mapping_path).st_mtime_ns
+    log_path = mapping_path + NAME_LOG_SUFFIX
+    with _cached_lock:
+        cached = _cached.get(mapping_path)
+        if cached is None or cached[0] != mtime:
+            with profiling.stage("load_names_json"), open(mapping_path, "r", encoding="utf-8") as f:
+                name_map = json.load(f)
+            with profiling.stage("index_names"):
+                cached = [mtime, 0, name_map, NameIndex(name_map)]
+            _cached[mapping_path] = cached
+
+        log_size = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+        if log_size < cached[1]:
+            # The log was folded into the JSON file (see compact_names) and
+            # restarted; its entries are all in the file by now
+            cached[1] = 0
+        if log_size > cached[1]:
+            with profiling.stage("load_names_log"):
+                records, cached[1] = _read_name_log(log_path, cached[1])
+                cached[2].update({r["filename"]: r["name"] for r in records})
+                cached[3].extend(r["name"] for r in records)
+    return cached[2], cached[3]
+
+
+def append_names(entries, mapping_path=NAME_MAP_FILE):
+    """
+    Appends {filename: name} entries to the mapping's log, as one write of
+    complete lines; readers never see a partial entry (see load_names).
+    """
+    data = "".join(json.dumps({"filename": f, "name": n}, ensure_ascii=False) + "\n" for f, n in entries.items())
+    fd = os.open(mapping_path + NAME_LOG_SUFFIX, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, data.encode("utf-8"))
+    finally:
+        os.close(fd)
+
+
+def compact_names(mapping_path=NAME_MAP_FILE):
+    """
+    Folds the log into the JSON file (rewritten atomically) and empties
+    the log. Returns the number of entries moved. Only the process that
+    appends to the log (the enrollment daemon) may call it.
+    """
+    log_path = mapping_path + NAME_LOG_SUFFIX
+    records, _ = _read_name_log(log_path, 0)
+    if not records:
+        return 0
+
+    with open(mapping_path, "r", encoding="utf-8") as f:
+        name_map = json.load(f)
+    name_map.update({r["filename"]: r["name"] for r in records})
+
+    tmp_path = mapping_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(name_map, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, mapping_path)
+    os.truncate(log_path, 0)
+    return len(records)
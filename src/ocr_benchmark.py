@@ -0,0 +1,52 @@
+# Import libraries
+import os # For file handling
+import time # For latency measurements
+import argparse # For the command line
+import cv2 # For loading the probe images
+
+from signature_utils import preprocess_for_ocr
+from ocr_engines import ENGINES
+
+# Define constants
+QUERY_DIR = "../signatures_to_test" # Images used for the benchmark
+
+
+def benchmark_engine(engine, images, repeats=3):
+    """Mean per-image latency (ms) of one-at-a-time and batched recognition."""
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for img in images:
+            engine.recognize(img)
+    single_ms = 1000 * (time.perf_counter() - start) / (repeats * len(images))
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        engine.recognize_batch(images)
+    batch_ms = 1000 * (time.perf_counter() - start) / (repeats * len(images))
+
+    return single_ms, batch_ms
+
+
+# Run the benchmark when this script is executed directly
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-image OCR latency of every available engine.")
+    parser.add_argument("--images", default=QUERY_DIR, help="directory of images to recognize")
+    parser.add_argument("--repeats", type=int, default=3, help="passes over the images")
+    args = parser.parse_args()
+
+    images = [
+        preprocess_for_ocr(cv2.imread(os.path.join(args.images, f)))
+        for f in sorted(os.listdir(args.images))
+        if f.lower().endswith((".png", ".jpg", ".jpeg"))
+    ]
+
+    for name, engine_class in ENGINES.items():
+        try:
+            engine = engine_class()
+            engine.recognize(images[0]) # Warm-up, also checks the engine works
+        except Exception as e:
+            print(f"{name:>10}: unavailable ({e})")
+            continue
+
+        single_ms, batch_ms = benchmark_engine(engine, images, args.repeats)
+        print(f"{name:>10}: {single_ms:7.1f} ms/image one at a time | {batch_ms:7.1f} ms/image batched")
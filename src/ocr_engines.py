@@ -0,0 +1,212 @@
+# Import libraries
+import os # For environment configuration and temporary files
+import shutil # For finding the tesseract executable
+import queue # Pool of warm tesserocr API objects
+import tempfile # For the batched command-line engine
+import argparse # For the engine check command line
+import threading # Engines are created from worker threads (batch prefetch, Streamlit, web servers)
+import subprocess # For the batched command-line engine
+import cv2 # For writing images handed to the command-line engine
+import pytesseract # Default engine: one tesseract process per image
+
+# Define constants
+OCR_LANG = "eng" # Tesseract language model
+OCR_PSM = 7 # Page segmentation mode 7 = single text line
+WINDOWS_TESSERACT = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
+
+# tesserocr installs signal handlers when first imported, which only works
+# on the main thread: import it here when possible, so engines can later be
+# created from any thread
+if threading.current_thread() is threading.main_thread():
+    try:
+        import tesserocr # Optional dependency
+    except Exception:
+        pass
+
+
+def find_tesseract():
+    """
+    Locates the tesseract executable:
+    1. the TESSERACT_CMD environment variable
+    2. 'tesseract' on the PATH (Linux / macOS packages)
+    3. the default Windows install location
+    """
+    configured = os.getenv("TESSERACT_CMD")
+    if configured:
+        return configured
+
+    on_path = shutil.which("tesseract")
+    if on_path:
+        return on_path
+
+    if os.path.exists(WINDOWS_TESSERACT):
+        return WINDOWS_TESSERACT
+
+    return "tesseract"
+
+
+class SubprocessOCR:
+    """
+    pytesseract engine: spawns one tesseract process (and writes temporary
+    files) per image. Always available when tesseract is installed.
+    """
+
+    name = "subprocess"
+
+    def __init__(self, tesseract_cmd=None, lang=OCR_LANG, psm=OCR_PSM):
+        pytesseract.pytesseract.tesseract_cmd = tesseract_cmd or find_tesseract()
+        self.config = f"--psm {psm} -l {lang}"
+
+    def recognize(self, img):
+        """Text of one binarized uint8 image."""
+        return pytesseract.image_to_string(img, config=self.config)
+
+    def recognize_batch(self, images):
+        return [self.recognize(img) for img in images]
+
+
+class BatchCLIOCR(SubprocessOCR):
+    """
+    Command-line engine that runs many images through a single tesseract
+    process (the language model is loaded once per batch): the images are
+    written to a temporary folder and passed as a list file, and tesseract
+    separates the pages of its output with form feeds.
+    """
+
+    name = "batch-cli"
+
+    def __init__(self, tesseract_cmd=None, lang=OCR_LANG, psm=OCR_PSM):
+        self.tesseract_cmd = tesseract_cmd or find_tesseract()
+        self.lang = lang
+        self.psm = psm
+        self.config = f"--psm {psm} -l {lang}"
+
+    def recognize(self, img):
+        return self.recognize_batch([img])[0]
+
+    def recognize_batch(self, images):
+        if not images:
+            return []
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = []
+            for i, img in enumerate(images):
+                path = os.path.join(tmp_dir, f"{i}.png")
+                cv2.imwrite(path, img)
+                paths.append(path)
+
+            list_file = os.path.join(tmp_dir, "images.txt")
+            with open(list_file, "w", encoding="utf-8") as f:
+                f.write("\n".join(paths) + "\n")
+
+            output = subprocess.run(
+                [self.tesseract_cmd, list_file, "stdout", "--psm", str(self.psm), "-l", self.lang],
+                capture_output=True, check=True, text=True, encoding="utf-8",
+            ).stdout
+
+        pages = output.split("\f")
+        return [(pages[i] if i < len(pages) else "") for i in range(len(images))]
+
+
+class TesserocrOCR:
+    """
+    In-process engine on the tesserocr bindings: the language model is
+    loaded once per API object and images are passed as in-memory arrays,
+    no process or temporary file per call. A small pool of API objects
+    lets several threads recognize at the same time.
+    """
+
+    name = "tesserocr"
+
+    def __init__(self, lang=OCR_LANG, psm=OCR_PSM, pool_size=2, tessdata_path=None):
+        from tesserocr import PyTessBaseAPI # Optional dependency
+
+        tessdata_path = tessdata_path or os.getenv("TESSDATA_PREFIX")
+        self._apis = queue.Queue()
+        for _ in range(pool_size):
+            if tessdata_path:
+                api = PyTessBaseAPI(path=tessdata_path, lang=lang, psm=psm)
+            else:
+                api = PyTessBaseAPI(lang=lang, psm=psm)
+            self._apis.put(api)
+
+    def recognize(self, img):
+        api = self._apis.get()
+        try:
+            height, width = img.shape[:2]
+            channels = 1 if img.ndim == 2 else img.shape[2]
+            api.SetImageBytes(img.tobytes(), width, height, channels, width * channels)
+            return api.GetUTF8Text()
+        finally:
+            self._apis.put(api)
+
+    def recognize_batch(self, images):
+        return [self.recognize(img) for img in images]
+
+
+ENGINES = {
+    SubprocessOCR.name: SubprocessOCR,
+    BatchCLIOCR.name: BatchCLIOCR,
+    TesserocrOCR.name: TesserocrOCR,
+}
+
+_engine = None # Engine used by signature_utils.extract_text_from_image
+
+
+def create_ocr_engine(name=None):
+    """
+    Creates the OCR engine called name ('subprocess', 'batch-cli' or
+    'tesserocr'), by default the OCR_ENGINE environment variable. Without
+    a name, tesserocr is used when it is installed and can load its model
+    (and, if it was not imported yet, when called from the main thread),
+    otherwise the subprocess engine.
+    """
+    name = name or os.getenv("OCR_ENGINE")
+    if name:
+        return ENGINES[name]()
+
+    try:
+        return TesserocrOCR()
+    except Exception: # ImportError, RuntimeError (no model), ValueError (import off the main thread)
+        return SubprocessOCR()
+
+
+_engine_lock = threading.Lock()
+
+def get_ocr_engine():
+    """Returns the process-wide OCR engine, created on first use."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = create_ocr_engine()
+    return _engine
+
+
+def set_ocr_engine(engine):
+    """Replaces the process-wide OCR engine (e.g. create_ocr_engine('batch-cli'))."""
+    global _engine
+    _engine = engine
+
+
+# Check which engine is created, on the main thread and on a worker thread,
+# when this script is executed directly
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that the OCR engine can be created from the main and a worker thread.")
+    parser.add_argument("--engine", default=None, choices=sorted(ENGINES), help="engine name (default: OCR_ENGINE or auto)")
+    args = parser.parse_args()
+
+    created = {}
+    def create(label):
+        try:
+            created[label] = type(create_ocr_engine(args.engine)).__name__
+        except Exception as e:
+            created[label] = f"failed: {type(e).__name__}: {e}"
+
+    create("main thread")
+    worker = threading.Thread(target=create, args=("worker thread",))
+    worker.start()
+    worker.join()
+    for label, engine in created.items():
+        print(f"{label}: {engine}")
+    if any(engine.startswith("failed") for engine in created.values()):
+        raise SystemExit(1)
@@ -0,0 +1,223 @@
+# Import libraries
+import os # For file handling
+import pickle # For saving the index to disk
+import argparse # For the build command line
+import numpy as np # For hashing and vote counting
+
+from signature_utils import orb_features, compare_orb
+
+# Define constants
+ORB_INDEX_FILE = "../orb_index.pkl" # File where the built LSH tables are stored
+DELTA_MIN = 4096 # Inserted descriptors kept aside before merging into the main tables...
+DELTA_FRACTION = 0.1 # ...or this fraction of the main tables, whichever is larger
+
+
+class DescriptorLSH:
+    """
+    Multi-table locality-sensitive hashing over 256-bit ORB descriptors.
+
+    Each table hashes a descriptor by sampling key_bits fixed random bit
+    positions (bit-sampling LSH for Hamming distance), so descriptors a few
+    bits apart land in the same bucket in at least one table with high
+    probability. Buckets are stored as sorted hash arrays, so a lookup is a
+    vectorized searchsorted instead of a Python dict walk.
+
+    A query's descriptors vote for the signatures owning the descriptors
+    found in their buckets; the most voted signatures are the candidates.
+
+    insert() adds signatures without re-hashing the indexed ones: their
+    hashes go to a small sorted delta run per table, merged into the main
+    tables once it outgrows DELTA_FRACTION of them (amortized O(1) hashing
+    per inserted descriptor).
+    """
+
+    def __init__(self, n_tables=8, key_bits=16, seed=0):
+        rng = np.random.default_rng(seed)
+        self.n_tables = n_tables
+        self.key_bits = key_bits
+        self.bit_positions = [np.sort(rng.choice(256, size=key_bits, replace=False)) for _ in range(n_tables)]
+        self.keys = [] # signature number -> key (e.g. gallery filename)
+        self.descriptors = [] # signature number -> its ORB descriptors
+        # Per table: (sorted hashes, owning signature numbers), for the main
+        # tables and the delta runs, replaced as one so searches never see a
+        # half-merged state
+        self._runs = self._empty_runs(), self._empty_runs()
+
+    def __setstate__(self, state):
+        # Indexes pickled before the delta runs only have main tables
+        if "tables" in state:
+            state["_runs"] = state.pop("tables"), None
+        self.__dict__.update(state)
+        if self._runs[1] is None:
+            self._runs = self._runs[0], self._empty_runs()
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def tables(self):
+        return self._runs[0]
+
+    def _empty_runs(self):
+        return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)) for _ in range(self.n_tables)]
+
+    @staticmethod
+    def _stack(descriptor_lists, first):
+        # All descriptors in one array, with the signature number owning each
+        owners = np.concatenate([
+            np.full(len(d), first + i, dtype=np.int64) for i, d in enumerate(descriptor_lists)
+        ]) if descriptor_lists else np.empty(0, dtype=np.int64)
+        stacked = np.concatenate(descriptor_lists) if descriptor_lists else np.empty((0, 32), dtype=np.uint8)
+        return stacked, owners
+
+    def _hashes(self, descriptors):
+        # One integer per descriptor and table, from its sampled bits
+        bits = np.unpackbits(np.asarray(descriptors, dtype=np.uint8), axis=1)
+        weights = 1 << np.arange(self.key_bits, dtype=np.int64)
+        return [bits[:, positions].astype(np.int64) @ weights for positions in self.bit_positions]
+
+    def build(self, keys, descriptor_lists):
+        """Indexes every signature's descriptors (replaces any previous content)."""
+        self.keys = list(keys)
+        self.descriptors = [np.asarray(d, dtype=np.uint8).reshape(-1, 32) for d in descriptor_lists]
+        stacked, owners = self._stack(self.descriptors, 0)
+
+        tables = []
+        for hashes in self._hashes(stacked):
+            order = np.argsort(hashes, kind="stable")
+            tables.append((hashes[order], owners[order]))
+        self._runs = tables, self._empty_runs()
+
+    def insert(self, keys, descriptor_lists):
+        """
+        Appends signatures to the index (keys must not be indexed yet), only
+        hashing their descriptors. Safe to run while other threads search.
+        """
+        new_descriptors = [np.asarray(d, dtype=np.uint8).reshape(-1, 32) for d in descriptor_lists]
+        if not new_descriptors:
+            return
+        stacked, owners = self._stack(new_descriptors, len(self.keys))
+
+        # Keys first: owners in the runs always point at a known signature
+        self.descriptors.extend(new_descriptors)
+        self.keys.extend(keys)
+
+        tables, deltas = self._runs
+        merged = []
+        for (delta_hashes, delta_owners), hashes in zip(deltas, self._hashes(stacked)):
+            hashes = np.concatenate([delta_hashes, hashes])
+            run_owners = np.concatenate([delta_owners, owners])
+            order = np.argsort(hashes, kind="stable")
+            merged.append((hashes[order], run_owners[order]))
+
+        if len(merged[0][0]) > max(DELTA_MIN, DELTA_FRACTION * len(tables[0][0])):
+            deltas, merged = merged, []
+            for (table_hashes, table_owners), (delta_hashes, delta_owners) in zip(tables, deltas):
+                hashes = np.concatenate([table_hashes, delta_hashes])
+                run_owners = np.concatenate([table_owners, delta_owners])
+                order = np.argsort(hashes, kind="stable")
+                merged.append((hashes[order], run_owners[order]))
+            self._runs = merged, self._empty_runs()
+        else:
+            self._runs = tables, merged
+
+    def votes(self, descriptors):
+        """
+        Weighted bucket hits per signature, over all tables. A hit counts
+        1 / bucket size, so crowded buckets (descriptors common to many
+        signatures, e.g. plain stroke ends) say little about identity.
+        """
+        tables, deltas = self._runs
+        n_signatures = len(self.keys) # Read after the runs: covers every owner in them
+        counts = np.zeros(n_signatures, dtype=np.float64)
+        if len(descriptors) == 0 or n_signatures == 0:
+            return counts
+
+        for table, delta, hashes in zip(tables, deltas, self._hashes(descriptors)):
+            # A bucket is split between the main table and the delta run
+            ranges = []
+            for sorted_hashes, owners in (table, delta):
+                lo = np.searchsorted(sorted_hashes, hashes, side="left")
+                hi = np.searchsorted(sorted_hashes, hashes, side="right")
+                ranges.append((owners, lo, hi - lo))
+            bucket_sizes = ranges[0][2] + ranges[1][2]
+            if bucket_sizes.sum() == 0:
+                continue
+
+            for owners, lo, lengths in ranges:
+                if lengths.sum() == 0:
+                    continue
+                # Expand every [lo, lo + length) range into positions, without a Python loop
+                starts = np.repeat(lo - np.cumsum(lengths) + lengths, lengths)
+                positions = starts + np.arange(lengths.sum())
+                weights = np.repeat(1.0 / np.maximum(bucket_sizes, 1), lengths)
+                counts += np.bincount(owners[positions], weights=weights, minlength=n_signatures)
+
+        return counts
+
+    def candidates(self, descriptors, n_candidates=20):
+        """Signature numbers with the most votes (and at least one), best first."""
+        counts = self.votes(descriptors)
+        n_candidates = min(n_candidates, int((counts > 0).sum()))
+        if n_candidates == 0:
+            return []
+
+        top = np.argpartition(-counts, n_candidates - 1)[:n_candidates]
+        return top[np.argsort(-counts[top], kind="stable")].tolist()
+
+    def search(self, query_img, k=3, n_candidates=20):
+        """
+        Finds the k best signatures for a normalized query canvas: LSH votes
+        pick n_candidates signatures, then only those are matched with the
+        Hamming matcher. Returns (key, similarity) pairs, best first.
+        """
+        _, query_descriptors = orb_features(query_img)
+
+        results = [
+            (self.keys[i], compare_orb(query_descriptors, self.descriptors[i]))
+            for i in self.candidates(query_descriptors, n_candidates)
+        ]
+        results.sort(key=lambda x: x[1], reverse=True)
+
+        return results[:k]
+
+    def save(self, index_path=ORB_INDEX_FILE):
+        """Writes the index to disk (atomically, through a temporary file)."""
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, index_path)
+
+    @staticmethod
+    def load(index_path=ORB_INDEX_FILE):
+        """Reads an index written by save()."""
+        with open(index_path, "rb") as f:
+            return pickle.load(f)
+
+
+def build_orb_index(gallery, n_tables=8, key_bits=16):
+    """Builds the LSH tables from the ORB descriptors stored in a gallery index."""
+    index = DescriptorLSH(n_tables, key_bits)
+    index.build(
+        [e["filename"] for e in gallery.entries],
+        [e["orb_descriptors"] for e in gallery.entries],
+    )
+    return index
+
+
+# Build the LSH tables when this script is executed directly
+if __name__ == "__main__":
+    from gallery_index import load_gallery_index, DATABASE_DIR, INDEX_FILE
+
+    parser = argparse.ArgumentParser(description="Build the ORB descriptor LSH index.")
+    parser.add_argument("--database", default=DATABASE_DIR, help="gallery image directory")
+    parser.add_argument("--index", default=INDEX_FILE, help="gallery index file")
+    parser.add_argument("--output", default=ORB_INDEX_FILE, help="output LSH index file")
+    parser.add_argument("--tables", type=int, default=8, help="number of hash tables")
+    parser.add_argument("--bits", type=int, default=16, help="sampled bits per hash key")
+    args = parser.parse_args()
+
+    gallery = load_gallery_index(args.database, args.index)
+    index = build_orb_index(gallery, args.tables, args.bits)
+    index.save(args.output)
+    print(f"Indexed ORB descriptors of {len(index)} signatures into {args.output}")
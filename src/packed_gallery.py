@@ -0,0 +1,467 @@
+# Import libraries
+import os # For file handling
+import json # For the file header and the name mapping
+import struct # For the fixed part of the header
+import argparse # For the converter command line
+from concurrent.futures import ProcessPoolExecutor # For pack_directory's feature extraction
+import numpy as np # For the memory-mapped arrays
+
+from signature_utils import letter_boxes, template_norms, pack_canvas, prepare_signature, chamfer_distance_maps, LetterMatrix
+from gallery_index import load_gallery_index, DATABASE_DIR, INDEX_FILE, IMAGE_EXTENSIONS
+from name_index import load_names, NAME_MAP_FILE
+
+# Define constants
+PACK_FILE = "../gallery.sigpack" # File where the packed gallery is stored
+PACK_MAGIC = b"SIGPACK\0"
+PACK_VERSION = 1
+ALIGNMENT = 64 # Every section starts on a 64-byte boundary
+WRITE_BLOCK_ROWS = 1024 # Rows of a section written at a time (large sections are memory-mapped spill files)
+PACK_CHUNK_SIZE = 256 # Images prepared per worker and round by pack_directory
+
+# Per-entry metadata, one fixed-size record per signature
+META_DTYPE = np.dtype([
+    ("quality", np.uint8),
+    ("is_cursive", np.uint8),
+    ("ink", np.uint32), # ink pixels of the canvas
+    ("aspect", np.float32), # width / height of the inked area
+    ("letter_start", np.int64), # first row of the entry in the letters / letter_boxes sections
+    ("letter_count", np.int32),
+])
+
+
+# ---------------------------------------------------------
+# File layout
+# ---------------------------------------------------------
+# 8 bytes   magic "SIGPACK\0"
+# 4 bytes   little-endian length of the JSON header
+# JSON      version, count, canvas format / shape, and for every section
+#           its offset, dtype and shape
+# sections  raw little-endian arrays, each aligned to 64 bytes:
+#   filenames, filename_offsets   UTF-8 blob + N+1 offsets
+#   names, name_offsets           person names (from signature_names.json)
+#   meta                          N x META_DTYPE
+#   letter_boxes                  L x 4 int16 (x, y, w, h on the canvas)
+#   letters                       L x 60 x 40 uint8 letter crops
+#   canvases                      N x 180 x 600 uint8, or N x 180 x 75
+#                                 bit-packed ink masks (format "bits")
+#   norms                         N float64 canvas norms, for batch_template_scores
+#   descriptors                   N x D float32 global descriptors
+#   chamfer_distances             (optional) N x 180 x 600 uint8 truncated
+#                                 distance maps of the ink masks, for the
+#                                 chamfer metric
+
+def _string_table(strings):
+    blobs = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in blobs])
+    return np.frombuffer(b"".join(blobs), dtype=np.uint8), offsets
+
+
+def write_pack(gallery, name_map, pack_path=PACK_FILE, canvas_format="uint8", chamfer=False):
+    """
+    Writes a gallery index (see gallery_index.py) as a packed gallery file.
+    canvas_format is "uint8" (grayscale canvases, same scores as the index)
+    or "bits" (bit-packed ink masks, 8x smaller, template scores then
+    compare the binarized canvases). chamfer=True also stores the chamfer
+    distance maps (108 KB per entry), shared by the processes opening the
+    pack instead of computed by each.
+    """
+    if canvas_format not in ("uint8", "bits"):
+        raise ValueError(f"Unknown canvas format: {canvas_format}")
+    entries = gallery.entries
+    n = len(entries)
+
+    meta = np.zeros(n, dtype=META_DTYPE)
+    boxes, letters = [], []
+    for i, entry in enumerate(entries):
+        entry_boxes = letter_boxes(entry["canvas"])
+        meta[i] = (entry["quality"], entry["is_cursive"], entry["ink"], entry["aspect"], len(letters), len(entry["letters"]))
+        boxes.extend(entry_boxes)
+        letters.extend(entry["letters"])
+
+    if canvas_format == "bits":
+        canvases = gallery.packed_masks()
+        norms = template_norms(255 * (1 - np.unpackbits(canvases, axis=2)))
+    else:
+        canvases = gallery.canvas_stack()
+        norms = gallery.canvas_norms()
+
+    filenames, filename_offsets = _string_table([e["filename"] for e in entries])
+    names, name_offsets = _string_table([name_map.get(e["filename"], "Unknown") for e in entries])
+
+    sections = {
+        "filenames": filenames,
+        "filename_offsets": filename_offsets,
+        "names": names,
+        "name_offsets": name_offsets,
+        "meta": meta,
+        "letter_boxes": np.array(boxes, dtype=np.int16).reshape(-1, 4),
+        "letters": np.array(letters, dtype=np.uint8).reshape(-1, 60, 40),
+        "canvases": np.ascontiguousarray(canvases, dtype=np.uint8),
+        "norms": np.asarray(norms, dtype=np.float64),
+        "descriptors": gallery.descriptor_matrix(),
+    }
+    if chamfer:
+        sections["chamfer_distances"] = gallery.chamfer_distance_maps()
+    _write_sections(pack_path, n, canvas_format, sections)
+
+
+def _write_sections(pack_path, n, canvas_format, sections):
+    # Lays the sections out after the header and writes the file atomically,
+    # through a temporary file; sections are written WRITE_BLOCK_ROWS rows
+    # at a time, so memory-mapped spill files are never read whole
+
+    # Offsets depend on the header length, which depends on the offsets:
+    # lay the sections out after a generously sized header
+    header = {
+        "version": PACK_VERSION,
+        "count": n,
+        "canvas_format": canvas_format,
+        "canvas_shape": [180, 600],
+        "sections": {},
+    }
+    sizes = {name: array.nbytes for name, array in sections.items()}
+    header_size = len(json.dumps(header)) + 200 * len(sections) + 16
+    offset = -(-(len(PACK_MAGIC) + 4 + header_size) // ALIGNMENT) * ALIGNMENT
+    for name, array in sections.items():
+        header["sections"][name] = {"offset": offset, "dtype": array.dtype.descr if array.dtype.names else array.dtype.str,
+                                    "shape": list(array.shape)}
+        offset += -(-sizes[name] // ALIGNMENT) * ALIGNMENT
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    if len(header_bytes) > header_size:
+        raise RuntimeError("Packed gallery header larger than reserved")
+
+    tmp_path = pack_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(PACK_MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes)
+        for name, array in sections.items():
+            f.seek(header["sections"][name]["offset"])
+            for start in range(0, max(len(array), 1), WRITE_BLOCK_ROWS):
+                f.write(np.ascontiguousarray(array[start:start + WRITE_BLOCK_ROWS]).tobytes())
+        f.truncate(offset)
+    os.replace(tmp_path, pack_path)
+
+
+def _prepare_for_pack(file_path):
+    # Worker side of pack_directory: the fields a pack stores, or the error
+    # message of an unreadable image
+    try:
+        entry = prepare_signature(file_path)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    entry.pop("orb_descriptors") # Not stored in packs
+    entry["letter_boxes"] = letter_boxes(entry["canvas"])
+    return entry
+
+
+def _spill_array(path, dtype, shape):
+    # Read-only view of a spill file (an empty array when nothing was written)
+    if 0 in shape:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+
+def pack_directory(database_path=DATABASE_DIR, name_map=None, pack_path=PACK_FILE, canvas_format="uint8",
+                   workers=1, chunk_size=PACK_CHUNK_SIZE, chamfer=False):
+    """
+    Writes a packed gallery straight from the image directory, without a
+    gallery index: images are prepared chunk by chunk (in workers
+    processes) and their canvases and letter crops spilled to temporary
+    files next to the pack, so memory stays bounded whatever the gallery
+    size. Unreadable images are reported and skipped. chamfer as for
+    write_pack. Returns the number of signatures written.
+    """
+    if canvas_format not in ("uint8", "bits"):
+        raise ValueError(f"Unknown canvas format: {canvas_format}")
+    name_map = name_map or {}
+    filenames = sorted(f for f in os.listdir(database_path) if f.lower().endswith(IMAGE_EXTENSIONS))
+
+    canvas_spill, letter_spill = pack_path + ".canvases.tmp", pack_path + ".letters.tmp"
+    chamfer_spill = pack_path + ".chamfer.tmp"
+    kept, meta, boxes, norms, descriptors = [], [], [], [], []
+    n_letters = 0
+    try:
+        with open(canvas_spill, "wb") as canvas_file, open(letter_spill, "wb") as letter_file, \
+                open(chamfer_spill, "wb") as chamfer_file, ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+            round_size = chunk_size * max(1, workers)
+            for start in range(0, len(filenames), round_size):
+                chunk = filenames[start:start + round_size]
+                paths = [os.path.join(database_path, f) for f in chunk]
+                canvases = []
+                for filename, entry in zip(chunk, executor.map(_prepare_for_pack, paths, chunksize=chunk_size)):
+                    if isinstance(entry, str):
+                        print(f"Skipped {filename}: {entry}")
+                        continue
+                    kept.append(filename)
+                    meta.append((entry["quality"], entry["is_cursive"], entry["ink"], entry["aspect"],
+                                 n_letters, len(entry["letters"])))
+                    boxes.extend(entry["letter_boxes"])
+                    descriptors.append(entry["descriptor"])
+                    canvases.append(entry["canvas"])
+                    for letter in entry["letters"]:
+                        letter_file.write(np.ascontiguousarray(letter, dtype=np.uint8).tobytes())
+                    n_letters += len(entry["letters"])
+                if not canvases:
+                    continue
+
+                canvases = np.array(canvases, dtype=np.uint8)
+                if canvas_format == "bits" or chamfer:
+                    packed = np.array([pack_canvas(c) for c in canvases], dtype=np.uint8)
+                if chamfer:
+                    chamfer_file.write(chamfer_distance_maps(packed).tobytes())
+                if canvas_format == "bits":
+                    canvas_file.write(packed.tobytes())
+                    # Norms of the binarized canvases, which the bits format scores
+                    norms.append(template_norms(255 * (1 - np.unpackbits(packed, axis=2, count=600))))
+                else:
+                    canvas_file.write(canvases.tobytes())
+                    norms.append(template_norms(canvases))
+
+        n = len(kept)
+        filename_blob, filename_offsets = _string_table(kept)
+        name_blob, name_offsets = _string_table([name_map.get(f, "Unknown") for f in kept])
+        canvas_shape = (n, 180, 75) if canvas_format == "bits" else (n, 180, 600)
+        sections = {
+            "filenames": filename_blob,
+            "filename_offsets": filename_offsets,
+            "names": name_blob,
+            "name_offsets": name_offsets,
+            "meta": np.array(meta, dtype=META_DTYPE).reshape(n),
+            "letter_boxes": np.array(boxes, dtype=np.int16).reshape(-1, 4),
+            "letters": _spill_array(letter_spill, np.uint8, (n_letters, 60, 40)),
+            "canvases": _spill_array(canvas_spill, np.uint8, canvas_shape),
+            "norms": np.concatenate(norms) if norms else np.zeros(0, dtype=np.float64),
+            "descriptors": np.array(descriptors, dtype=np.float32),
+        }
+        if chamfer:
+            sections["chamfer_distances"] = _spill_array(chamfer_spill, np.uint8, (n, 180, 600))
+        _write_sections(pack_path, n, canvas_format, sections)
+    finally:
+        for path in (canvas_spill, letter_spill, chamfer_spill):
+            if os.path.exists(path):
+                os.remove(path)
+    return n
+
+
+class _UnpackedCanvases:
+    # Array-like view of bit-packed canvases as 180 x 600 uint8 canvases
+    # (ink = 0, paper = 255): only the rows read are unpacked, so scans
+    # reading it in chunks keep sharing the memory-mapped pack
+    def __init__(self, packed, width):
+        self.packed = packed
+        self.width = width
+        self.shape = (len(packed), packed.shape[1], width)
+        self.dtype = np.dtype(np.uint8)
+
+    def __len__(self):
+        return len(self.packed)
+
+    def __getitem__(self, key):
+        block = np.asarray(self.packed[key])
+        masks = np.unpackbits(block, axis=block.ndim - 1, count=self.width)
+        return (255 * (1 - masks)).astype(np.uint8)
+
+
+class _PackedEntries:
+    # Read-only sequence of entry dicts built on access, so opening a pack
+    # does not create one Python object per signature
+    def __init__(self, pack):
+        self.pack = pack
+
+    def __len__(self):
+        return len(self.pack)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self.pack.entry(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.pack.entry(i)
+
+
+class PackedGallery:
+    """
+    Read-only gallery opened from a packed gallery file.
+
+    Every array is a numpy.memmap of the file, so opening is near-instant
+    and worker processes opening the same file share its pages through the
+    OS cache. It offers the same interface as GalleryIndex for the visual
+    matching (entries, canvas_stack, canvas_norms, letter_matrix,
+    descriptor_matrix, rows_of, entry_columns, filename, entry_letters), so
+    it can be passed as gallery= to compare_all_signatures; scans use the
+    columnar accessors and only build entry dicts when asked for one.
+    ORB descriptors are not stored.
+    """
+
+    def __init__(self, pack_path=PACK_FILE):
+        self.path = pack_path
+        with open(pack_path, "rb") as f:
+            if f.read(len(PACK_MAGIC)) != PACK_MAGIC:
+                raise ValueError(f"Not a packed gallery file: {pack_path}")
+            (header_length,) = struct.unpack("<I", f.read(4))
+            self.header = json.loads(f.read(header_length).decode("utf-8"))
+        if self.header["version"] != PACK_VERSION:
+            raise ValueError(f"Unsupported packed gallery version {self.header['version']}")
+
+        self.count = self.header["count"]
+        self.canvas_format = self.header["canvas_format"]
+        for name, section in self.header["sections"].items():
+            setattr(self, name, self._map(section))
+
+        self.entries = _PackedEntries(self)
+        self._rows = None
+        self._packed = None
+        self._chamfer = None
+        self._letter_matrix = None
+        self._columns = None
+
+    def _map(self, section):
+        dtype = section["dtype"]
+        dtype = np.dtype([tuple(field) for field in dtype]) if isinstance(dtype, list) else np.dtype(dtype)
+        shape = tuple(section["shape"])
+        if 0 in shape:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(self.path, dtype=dtype, mode="r", offset=section["offset"], shape=shape)
+
+    def __len__(self):
+        return self.count
+
+    def filename(self, i):
+        return bytes(self.filenames[self.filename_offsets[i]:self.filename_offsets[i + 1]]).decode("utf-8")
+
+    def name(self, i):
+        """Person name stored for entry i."""
+        return bytes(self.names[self.name_offsets[i]:self.name_offsets[i + 1]]).decode("utf-8")
+
+    def canvas(self, i):
+        """The 180 x 600 uint8 canvas of entry i (ink = 0, paper = 255 for bit-packed canvases)."""
+        if self.canvas_format == "bits":
+            mask = np.unpackbits(self.canvases[i], axis=1, count=self.header["canvas_shape"][1])
+            return (255 * (1 - mask)).astype(np.uint8)
+        return self.canvases[i]
+
+    def entry(self, i):
+        """Entry i as a dict with the GalleryIndex entry fields used for matching."""
+        meta = self.meta[i]
+        start, count = int(meta["letter_start"]), int(meta["letter_count"])
+        return {
+            "filename": self.filename(i),
+            "name": self.name(i),
+            "quality": bool(meta["quality"]),
+            "is_cursive": bool(meta["is_cursive"]),
+            "ink": int(meta["ink"]),
+            "aspect": float(meta["aspect"]),
+            "letters": list(self.letters[start:start + count]),
+            "letter_boxes": [tuple(box) for box in self.letter_boxes[start:start + count].tolist()],
+            "canvas": self.canvas(i),
+            "descriptor": self.descriptors[i],
+        }
+
+    def canvas_stack(self):
+        """
+        All canvases as N x 180 x 600 uint8: the memory-mapped section, or for
+        bit-packed canvases a view unpacking only the rows read (so template
+        scans, which read in chunks, still share the pack between processes).
+        """
+        if self.canvas_format != "bits":
+            return self.canvases
+        return _UnpackedCanvases(self.canvases, self.header["canvas_shape"][1])
+
+    def packed_masks(self):
+        """Bit-packed ink masks (N x 180 x 75), the canvases themselves in the "bits" format."""
+        if self.canvas_format == "bits":
+            return self.canvases
+        if self._packed is None:
+            self._packed = np.array([pack_canvas(c) for c in self.canvases], dtype=np.uint8).reshape(-1, 180, 75)
+        return self._packed
+
+    def chamfer_distance_maps(self):
+        """
+        Truncated distance maps of the ink masks, for the chamfer metric:
+        the memory-mapped section if the pack stores it (--chamfer),
+        otherwise computed once in this process.
+        """
+        if "chamfer_distances" in self.header["sections"]:
+            return self.chamfer_distances
+        if self._chamfer is None:
+            self._chamfer = chamfer_distance_maps(self.packed_masks())
+        return self._chamfer
+
+    def entry_columns(self):
+        """Per-entry is_cursive, ink, aspect and letter_count arrays, from the meta section."""
+        if self._columns is None:
+            self._columns = {
+                "is_cursive": self.meta["is_cursive"].astype(bool),
+                "ink": self.meta["ink"].astype(np.int64),
+                "aspect": self.meta["aspect"].astype(np.float64),
+                "letter_count": self.meta["letter_count"].astype(np.int64),
+            }
+        return self._columns
+
+    def entry_letters(self, i):
+        """Letter crops of entry i (views of the letters section)."""
+        meta = self.meta[i]
+        start = int(meta["letter_start"])
+        return list(self.letters[start:start + int(meta["letter_count"])])
+
+    def letter_matrix(self):
+        """All letters as one LetterMatrix (built from the contiguous letters section)."""
+        if self._letter_matrix is None:
+            self._letter_matrix = LetterMatrix(self.letters, self.meta["letter_count"])
+        return self._letter_matrix
+
+    def canvas_norms(self):
+        """Centered L2 norms of the canvases, stored at conversion time."""
+        return self.norms
+
+    def descriptor_matrix(self):
+        return self.descriptors
+
+    def rows_of(self, filenames):
+        """Row numbers of the given filenames (unknown ones skipped), in index order."""
+        if self._rows is None:
+            self._rows = {self.filename(i): i for i in range(self.count)}
+        return sorted(self._rows[f] for f in filenames if f in self._rows)
+
+
+def open_packed_gallery(pack_path=PACK_FILE):
+    """Opens a packed gallery file (see PackedGallery)."""
+    return PackedGallery(pack_path)
+
+
+def convert_directory(database_path=DATABASE_DIR, pack_path=PACK_FILE, names_path=NAME_MAP_FILE,
+                      index_path=INDEX_FILE, canvas_format="uint8", chamfer=False):
+    """
+    Converts the gallery directory (through its gallery index, built or
+    refreshed as needed) and the name mapping into a packed gallery file.
+    Returns the number of signatures written.
+    """
+    gallery = load_gallery_index(database_path, index_path)
+    name_map, _ = load_names(names_path) # Including names enrolled since the file was written
+    write_pack(gallery, name_map, pack_path, canvas_format, chamfer)
+    return len(gallery)
+
+
+# Convert the gallery directory when this script is executed directly
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the gallery directory into a packed gallery file.")
+    parser.add_argument("--database", default=DATABASE_DIR, help="gallery image directory")
+    parser.add_argument("--names", default=NAME_MAP_FILE, help="filename -> name mapping")
+    parser.add_argument("--index", default=INDEX_FILE, help="gallery index file (built if missing)")
+    parser.add_argument("--output", default=PACK_FILE, help="output packed gallery file")
+    parser.add_argument("--bits", action="store_true", help="store bit-packed ink masks instead of grayscale canvases")
+    parser.add_argument("--from-images", action="store_true", help="pack straight from the images, without a gallery index (large galleries)")
+    parser.add_argument("--chamfer", action="store_true", help="also store the chamfer distance maps (108 KB per signature)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="feature extraction processes (--from-images)")
+    args = parser.parse_args()
+
+    canvas_format = "bits" if args.bits else "uint8"
+    if args.from_images:
+        name_map, _ = load_names(args.names)
+        count = pack_directory(args.database, name_map, args.output, canvas_format, args.workers, chamfer=args.chamfer)
+    else:
+        count = convert_directory(args.database, args.output, args.names, args.index, canvas_format, args.chamfer)
+    print(f"Packed {count} signatures into {args.output} ({os.path.getsize(args.output) / 1e6:.1f} MB)")
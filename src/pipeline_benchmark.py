@@ -0,0 +1,383 @@
+# Import libraries
+import os # For file handling
+import sys # For the environment description
+import json # For the manifests and the machine-readable output
+import time # For build and query timings
+import platform # For the environment description
+import argparse # For the command line
+import subprocess # For the current git commit
+import multiprocessing # Every mode runs in a fresh process, for its own peak memory
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np # For the latency percentiles
+
+from create_signatures import generate_gallery, person_name, find_font
+
+# Define constants
+DATA_DIR = "../benchmark_data" # Generated galleries and probes, one folder per size / seed
+DEFAULT_SIZES = (1000,)
+MODES = ("scan", "index", "binary", "letters", "dtw", "shortlist", "ann", "orb", "packed", "packed_bits", "shards")
+ALL_MODES = MODES + ("db",) # db needs a PostgreSQL database (see db_utils.py), preferably a scratch one
+PACK_MODES = ("binary", "letters", "dtw", "shortlist") # Index modes that run on the packed gallery above MAX_INDEX_SIZE
+MAX_SCAN_SIZE = 5000 # The directory scan mode is skipped above this gallery size
+MAX_INDEX_SIZE = 20000 # The pickled gallery index (~160 KB per entry) is not built above this size
+N_SHARDS = 4 # Local shard workers of the shards mode
+DB_BATCH_SIZE = 500 # Rows per INSERT when loading a dataset for the db mode
+
+
+def prepare_dataset(size, n_probes, seed=0, font_path=None, workers=1, data_dir=DATA_DIR):
+    """
+    Generates (once) a gallery of size signatures and n_probes distorted
+    probes of randomly chosen gallery people, with their ground truth.
+    The same size / seed / font always gives the same files, so a dataset
+    is reused by later runs. Returns the dataset description.
+    """
+    font_path = find_font(font_path)
+    dataset_dir = os.path.abspath(os.path.join(data_dir, f"seed{seed}_n{size}"))
+    manifest_path = os.path.join(dataset_dir, "manifest.json")
+    params = {"size": size, "n_probes": n_probes, "seed": seed, "font": font_path and os.path.basename(font_path)}
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest["params"] == params:
+            return manifest
+
+    gallery_dir = os.path.join(dataset_dir, "gallery")
+    probe_dir = os.path.join(dataset_dir, "probes")
+
+    start = time.perf_counter()
+    name_map = generate_gallery(gallery_dir, range(size), seed, font_path, workers)
+    names_path = os.path.join(dataset_dir, "names.json")
+    with open(names_path, "w", encoding="utf-8") as f:
+        json.dump(name_map, f, ensure_ascii=False)
+
+    # Held-out probes: new renderings (other size, position, slant, noise)
+    # of gallery people, never part of the gallery itself
+    people = np.random.default_rng([seed, size]).choice(size, size=min(n_probes, size), replace=False)
+    probe_names = generate_gallery(probe_dir, people.tolist(), seed, font_path, workers, variant=1)
+    truth = {
+        os.path.join(probe_dir, f"probe_{i + 1}_1.png"): {"name": person_name(seed, i), "filename": f"signature_{i + 1}.png"}
+        for i in sorted(people.tolist())
+    }
+    if len(truth) != len(probe_names):
+        raise ValueError(f"Generated {len(probe_names)} probes for {len(truth)} people in {probe_dir}")
+
+    manifest = {
+        "params": params,
+        "dir": dataset_dir,
+        "gallery_dir": gallery_dir,
+        "names_path": names_path,
+        "truth": truth,
+        "generate_s": round(time.perf_counter() - start, 3),
+    }
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    return manifest
+
+
+def peak_memory_mb():
+    """Peak resident memory of this process, in MB (None where unsupported)."""
+    try:
+        import resource # Unix only
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1) # bytes on macOS, KB on Linux
+
+
+def _pack_path(dataset, canvas_format):
+    return os.path.join(dataset["dir"], f"gallery_{canvas_format}.sigpack")
+
+
+def build_index(dataset):
+    """Builds the dataset's gallery index from the images. Returns the build time in seconds."""
+    from gallery_index import build_gallery_index
+
+    start = time.perf_counter()
+    build_gallery_index(dataset["gallery_dir"], os.path.join(dataset["dir"], "gallery_index.pkl"))
+    return time.perf_counter() - start
+
+
+def build_pack(dataset, canvas_format="uint8", workers=1):
+    """
+    Packs the dataset's gallery straight from the images (no gallery index,
+    see packed_gallery.pack_directory). Returns the build time in seconds.
+    """
+    from packed_gallery import pack_directory
+
+    start = time.perf_counter()
+    with open(dataset["names_path"], "r", encoding="utf-8") as f:
+        name_map = json.load(f)
+    pack_directory(dataset["gallery_dir"], name_map, _pack_path(dataset, canvas_format), canvas_format, workers)
+    return time.perf_counter() - start
+
+
+def build_dataset_shards(dataset, n_shards=N_SHARDS):
+    """Splits the dataset's gallery index into n_shards shard files. Returns the build time in seconds."""
+    from gallery_index import load_gallery_index
+    from sharded_search import write_shards
+
+    start = time.perf_counter()
+    gallery = load_gallery_index(dataset["gallery_dir"], os.path.join(dataset["dir"], "gallery_index.pkl"))
+    write_shards(gallery.entries, n_shards, os.path.join(dataset["dir"], "shards"), dataset["gallery_dir"])
+    return time.perf_counter() - start
+
+
+def load_dataset_into_db(dataset, batch_size=DB_BATCH_SIZE):
+    """
+    Inserts the dataset's gallery into the signatures table of the
+    configured database (see db_utils.py), skipping images already there.
+    Rows of other galleries in the table also take part in the db mode's
+    search, so a scratch database is preferable. Returns the load time in seconds.
+    """
+    import psycopg2 # For the descriptor blobs
+    from psycopg2.extras import execute_values # For the batched INSERTs
+    from db_utils import get_connection
+    from signature_utils import extract_orb_features
+
+    start = time.perf_counter()
+    with open(dataset["names_path"], "r", encoding="utf-8") as f:
+        name_map = json.load(f)
+
+    connection = get_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SELECT image_path FROM signatures")
+        loaded = {row[0] for row in cursor.fetchall()}
+
+        filenames = [f for f in sorted(os.listdir(dataset["gallery_dir"])) if f.lower().endswith(".png")]
+        for batch_start in range(0, len(filenames), batch_size):
+            rows = []
+            for filename in filenames[batch_start:batch_start + batch_size]:
+                image_path = os.path.join(dataset["gallery_dir"], filename)
+                if image_path in loaded:
+                    continue
+                _, descriptors, quality = extract_orb_features(image_path)
+                rows.append((name_map.get(filename, "Unknown"), image_path, psycopg2.Binary(descriptors.tobytes()), quality))
+            if rows:
+                execute_values(cursor, "INSERT INTO signatures (person_name, image_path, descriptors, quality) VALUES %s",
+                               rows, page_size=len(rows))
+                connection.commit()
+        cursor.close()
+    finally:
+        connection.close()
+    return time.perf_counter() - start
+
+
+def run_mode(mode, dataset, shortlist_k=None, workers=1, on_pack=False):
+    """
+    Runs every probe of the dataset through compare_all_signatures in one
+    matching mode (visual only, no OCR) and measures it. Meant to run in a
+    fresh process, so that the peak memory belongs to this mode. With
+    on_pack, the index modes read the packed gallery instead of the index.
+    """
+    from signature_utils import compare_all_signatures, shutdown_scan_pools
+    from gallery_index import load_gallery_index
+    from packed_gallery import open_packed_gallery
+    from ann_index import build_ann_index
+    from orb_index import build_orb_index
+
+    options = {"use_ocr": False, "names_path": dataset["names_path"], "database_path": dataset["gallery_dir"]}
+    shard_processes = []
+
+    # 1. Load the gallery (index, pack, shards or DB rows) and build the mode's own structures
+    start = time.perf_counter()
+    if mode == "scan":
+        options["workers"] = workers
+    elif mode == "db":
+        from db_gallery import DBGallery
+        options["db_gallery"] = DBGallery()
+        options["db_gallery"].reload()
+    elif mode == "shards":
+        from sharded_search import start_local_shards, ShardCoordinator
+        addresses, shard_processes = start_local_shards(os.path.join(dataset["dir"], "shards"))
+        options["shards"] = ShardCoordinator(addresses, timeout=60) # Whole answers, however slow
+    elif mode == "packed_bits":
+        options["gallery"] = open_packed_gallery(_pack_path(dataset, "bits"))
+    elif mode == "packed" or on_pack:
+        options["gallery"] = open_packed_gallery(_pack_path(dataset, "uint8"))
+    else:
+        options["gallery"] = load_gallery_index(dataset["gallery_dir"], os.path.join(dataset["dir"], "gallery_index.pkl"))
+    load_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if mode == "binary":
+        options["gallery"].packed_masks()
+        options["binary_metric"] = "iou"
+    elif mode in ("letters", "dtw"):
+        options["gallery"].letter_matrix()
+        options["letter_mode"] = "batch" if mode == "letters" else "dtw"
+    elif mode == "shortlist":
+        options["shortlist_k"] = shortlist_k
+    elif mode == "ann":
+        options["ann_index"] = build_ann_index(options["gallery"])
+        options["shortlist_k"] = shortlist_k
+    elif mode == "orb":
+        options["orb_index"] = build_orb_index(options["gallery"])
+        options["shortlist_k"] = shortlist_k
+    build_s = time.perf_counter() - start
+
+    # 2. Queries
+    latencies, top_1, top_3, errors = [], 0, 0, 0
+    try:
+        for probe, expected in dataset["truth"].items():
+            start = time.perf_counter()
+            result = compare_all_signatures(probe, **options)
+            latencies.append(1000 * (time.perf_counter() - start))
+
+            names = [name for name, _ in result.get("top_3_matches", [])]
+            if not names:
+                errors += 1
+            top_1 += names[:1] == [expected["name"]]
+            top_3 += expected["name"] in names[:3]
+    finally:
+        shutdown_scan_pools() # Otherwise the mode process never exits
+        for process in shard_processes:
+            process.terminate()
+
+    n = len(dataset["truth"])
+    return {
+        "mode": mode,
+        "size": dataset["params"]["size"],
+        "probes": n,
+        "load_s": round(load_s, 3),
+        "build_s": round(build_s, 3),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 2),
+        "p90_ms": round(float(np.percentile(latencies, 90)), 2),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 2),
+        "mean_ms": round(float(np.mean(latencies)), 2),
+        "top1": round(top_1 / n, 4),
+        "top3": round(top_3 / n, 4),
+        "errors": errors,
+        "peak_rss_mb": peak_memory_mb(),
+    }
+
+
+def _in_fresh_process(function, *args):
+    # Spawned (not forked) so nothing loaded by earlier modes is shared
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(function, *args).result()
+
+
+def git_commit():
+    """Current commit of the repository, or None outside a git checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _gallery_kind(mode, size, max_scan_size, max_index_size):
+    # Stored gallery a mode reads at this size (None: the mode is skipped)
+    if mode == "scan":
+        return "images" if size <= max_scan_size else None
+    if mode in ("packed", "packed_bits", "db"):
+        return mode
+    if size <= max_index_size:
+        return "shards" if mode == "shards" else "index"
+    return "packed" if mode in PACK_MODES else None # index, ann, orb and shards need the gallery index
+
+
+def run_benchmark(sizes=DEFAULT_SIZES, modes=MODES, n_probes=100, seed=0, font_path=None, workers=1,
+                  shortlist_k=20, max_scan_size=MAX_SCAN_SIZE, data_dir=DATA_DIR, max_index_size=MAX_INDEX_SIZE):
+    """
+    Benchmarks every mode on every gallery size. Returns the report:
+    environment, parameters and one result row per (size, mode).
+
+    Above max_index_size the gallery index is not built: the PACK_MODES
+    run on the packed gallery (built straight from the images) and the
+    modes needing the index are skipped.
+    """
+    builders = {
+        "index": lambda dataset: _in_fresh_process(build_index, dataset),
+        "packed": lambda dataset: _in_fresh_process(build_pack, dataset, "uint8", workers),
+        "packed_bits": lambda dataset: _in_fresh_process(build_pack, dataset, "bits", workers),
+        "shards": lambda dataset: _in_fresh_process(build_dataset_shards, dataset),
+        "db": lambda dataset: _in_fresh_process(load_dataset_into_db, dataset),
+    }
+
+    rows = []
+    for size in sizes:
+        dataset = prepare_dataset(size, n_probes, seed, font_path, workers, data_dir)
+        kinds = {mode: _gallery_kind(mode, size, max_scan_size, max_index_size) for mode in modes}
+
+        # Every stored gallery needed at this size, built once (shards from the index)
+        needed = set(kinds.values()) - {None, "images"}
+        if "shards" in needed:
+            needed.add("index")
+        build_s = {}
+        for kind in ("index", "packed", "packed_bits", "shards", "db"):
+            if kind in needed:
+                build_s[kind] = builders[kind](dataset)
+        print(f"N={size}: generated in {dataset['generate_s']:.1f} s, built "
+              + ", ".join(f"{kind} in {seconds:.1f} s" for kind, seconds in build_s.items()), file=sys.stderr)
+
+        for mode in modes:
+            kind = kinds[mode]
+            if kind is None:
+                continue
+            row = _in_fresh_process(run_mode, mode, dataset, shortlist_k, workers, kind == "packed" and mode != "packed")
+            row["backend"] = kind
+            row["gallery_build_s"] = round(build_s[kind], 3) if kind in build_s else None
+            rows.append(row)
+            print(f"N={size:>8} | {mode:<11} | p50 {row['p50_ms']:8.1f} ms | p99 {row['p99_ms']:8.1f} ms | "
+                  f"top-1 {row['top1']:.3f} | top-3 {row['top3']:.3f} | {row['peak_rss_mb']} MB", file=sys.stderr)
+
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "params": {"n_probes": n_probes, "seed": seed, "font": font_path and os.path.basename(font_path),
+                   "workers": workers, "shortlist_k": shortlist_k, "max_index_size": max_index_size},
+        "results": rows,
+    }
+
+
+def compare_reports(report, baseline):
+    """Lines comparing p50 latency and top-1 accuracy with a baseline report, per (size, mode)."""
+    previous = {(r["size"], r["mode"]): r for r in baseline["results"]}
+    lines = []
+    for row in report["results"]:
+        old = previous.get((row["size"], row["mode"]))
+        if old is None:
+            continue
+        lines.append(
+            f"N={row['size']:>8} | {row['mode']:<11} | p50 {old['p50_ms']:.1f} -> {row['p50_ms']:.1f} ms "
+            f"({(row['p50_ms'] / max(old['p50_ms'], 1e-9) - 1) * 100:+.1f}%) | "
+            f"top-1 {old['top1']:.3f} -> {row['top1']:.3f}"
+        )
+    return lines
+
+
+# Run the benchmark when this script is executed directly
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latency, memory and accuracy of every matching mode versus gallery size.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="gallery sizes (e.g. 1000 10000 100000 1000000)")
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=ALL_MODES, help="matching modes (db: add it explicitly)")
+    parser.add_argument("--probes", type=int, default=100, help="held-out probes per size")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the synthetic data")
+    parser.add_argument("--font", default=None, help="font for the synthetic signatures (default: SIGNATURE_FONT or a known system font)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="processes for generation and the directory scan")
+    parser.add_argument("--shortlist", type=int, default=20, help="candidates re-ranked by the shortlist, ANN and ORB modes")
+    parser.add_argument("--max-scan", type=int, default=MAX_SCAN_SIZE, help="largest gallery for the directory scan mode")
+    parser.add_argument("--max-index", type=int, default=MAX_INDEX_SIZE, help="largest gallery for which the gallery index is built")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="where generated datasets are kept")
+    parser.add_argument("--json", default=None, help="write the report to this file")
+    parser.add_argument("--baseline", default=None, help="earlier report to compare with")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.sizes, args.modes, args.probes, args.seed, args.font, args.workers,
+                           args.shortlist, args.max_scan, args.data_dir, args.max_index)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            for line in compare_reports(report, json.load(f)):
+                print(line)
@@ -0,0 +1,219 @@
+# Import libraries
+import os # For enabling the profiler from the environment
+import time # For the stage timers
+import functools # For the timed decorator
+import threading # Per-thread query traces, shared process-wide totals
+
+# Define constants
+PROFILE_ENV = "SIGNATURE_PROFILE" # Set to 1 to collect process-wide stage metrics
+METRIC_PREFIX = "signature"
+
+
+class Stats:
+    """
+    Stage timings (calls, total and max seconds), event counters and
+    gauges (current values, e.g. a queue depth).
+    Stages may nest (e.g. 'decode' inside 'normalize'), so stage times
+    are inclusive and do not add up to the query time.
+    """
+
+    def __init__(self):
+        self.stages = {} # stage -> [calls, total seconds, max seconds]
+        self.counters = {} # event -> count
+        self.gauges = {} # name -> latest value
+        self._lock = threading.Lock()
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                self.stages[stage] = [1, seconds, seconds]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+                entry[2] = max(entry[2], seconds)
+
+    def add_count(self, event, n=1):
+        with self._lock:
+            self.counters[event] = self.counters.get(event, 0) + n
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def merge(self, other):
+        """Adds a Stats object or an as_dict() snapshot (e.g. from a worker process)."""
+        snapshot = other.as_dict() if isinstance(other, Stats) else other
+        with self._lock:
+            for stage, values in snapshot["stages"].items():
+                entry = self.stages.setdefault(stage, [0, 0.0, 0.0])
+                entry[0] += values["calls"]
+                entry[1] += values["total_ms"] / 1000
+                entry[2] = max(entry[2], values["max_ms"] / 1000)
+            for event, n in snapshot["counters"].items():
+                self.counters[event] = self.counters.get(event, 0) + n
+            self.gauges.update(snapshot.get("gauges", {}))
+
+    def reset(self):
+        with self._lock:
+            self.stages.clear()
+            self.counters.clear()
+            self.gauges.clear()
+
+    def as_dict(self):
+        """JSON-friendly snapshot: per-stage calls / total_ms / max_ms, counters and gauges."""
+        with self._lock:
+            return {
+                "stages": {
+                    stage: {"calls": calls, "total_ms": round(total * 1000, 3), "max_ms": round(longest * 1000, 3)}
+                    for stage, (calls, total, longest) in self.stages.items()
+                },
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+            }
+
+    def prometheus_text(self, prefix=METRIC_PREFIX):
+        """The metrics in the Prometheus text exposition format."""
+        snapshot = self.as_dict()
+        lines = [
+            f"# HELP {prefix}_stage_seconds_total Time spent in each pipeline stage.",
+            f"# TYPE {prefix}_stage_seconds_total counter",
+        ]
+        lines += [f'{prefix}_stage_seconds_total{{stage="{stage}"}} {v["total_ms"] / 1000:.6f}'
+                  for stage, v in sorted(snapshot["stages"].items())]
+        lines += [
+            f"# HELP {prefix}_stage_calls_total Number of times each pipeline stage ran.",
+            f"# TYPE {prefix}_stage_calls_total counter",
+        ]
+        lines += [f'{prefix}_stage_calls_total{{stage="{stage}"}} {v["calls"]}'
+                  for stage, v in sorted(snapshot["stages"].items())]
+        lines += [
+            f"# HELP {prefix}_events_total Pipeline events (images scanned, paths taken, cache hits, ...).",
+            f"# TYPE {prefix}_events_total counter",
+        ]
+        lines += [f'{prefix}_events_total{{event="{event}"}} {n}'
+                  for event, n in sorted(snapshot["counters"].items())]
+        for gauge, value in sorted(snapshot["gauges"].items()):
+            lines += [f"# TYPE {prefix}_{gauge} gauge", f"{prefix}_{gauge} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+# ---------------------------------------------------------
+# Process-wide metrics and per-query traces
+# ---------------------------------------------------------
+metrics = Stats() # Totals for the whole process, filled while enabled
+_enabled = os.getenv(PROFILE_ENV) == "1"
+_local = threading.local() # .trace = Stats of the query running on this thread
+
+
+def enable(on=True):
+    """Turns the process-wide metrics on or off."""
+    global _enabled
+    _enabled = on
+
+def is_enabled():
+    return _enabled
+
+
+class _Timer:
+    __slots__ = ("name", "trace", "start")
+
+    def __init__(self, name, trace):
+        self.name = name
+        self.trace = trace
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        if _enabled:
+            metrics.add_time(self.name, elapsed)
+        if self.trace is not None:
+            self.trace.add_time(self.name, elapsed)
+        return False
+
+class _NoTimer:
+    # Returned when nothing is being recorded, so a disabled stage costs
+    # one function call
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_TIMER = _NoTimer()
+
+
+def stage(name):
+    """Context manager timing a pipeline stage: with stage('normalize'): ..."""
+    trace = getattr(_local, "trace", None)
+    if not _enabled and trace is None:
+        return _NO_TIMER
+    return _Timer(name, trace)
+
+def timed(name):
+    """Decorator timing every call of a function as the stage name."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def record(name, seconds):
+    """Records a duration measured by the caller (e.g. across await points) as the stage name."""
+    trace = getattr(_local, "trace", None)
+    if _enabled:
+        metrics.add_time(name, seconds)
+    if trace is not None:
+        trace.add_time(name, seconds)
+
+def gauge(name, value):
+    """Sets a process-wide gauge (e.g. 'enroll_queue_depth'), while enabled."""
+    if _enabled:
+        metrics.set_gauge(name, value)
+
+def count(event, n=1):
+    """Counts a pipeline event (e.g. 'ocr_cache_hit')."""
+    trace = getattr(_local, "trace", None)
+    if not _enabled and trace is None:
+        return
+    if _enabled:
+        metrics.add_count(event, n)
+    if trace is not None:
+        trace.add_count(event, n)
+
+
+class tracing:
+    """
+    Records the stages and events of the code run inside the block on this
+    thread, into a fresh Stats yielded by the block (None when on is False):
+
+        with tracing() as trace:
+            compare_all_signatures(...)
+        trace.as_dict()
+
+    Work done in other processes (e.g. scan_gallery with workers > 1) is
+    not included.
+    """
+
+    def __init__(self, on=True):
+        self.on = on
+        self.previous = None
+
+    def __enter__(self):
+        if not self.on:
+            return None
+        self.previous = getattr(_local, "trace", None)
+        _local.trace = Stats()
+        return _local.trace
+
+    def __exit__(self, *exc):
+        if self.on:
+            _local.trace = self.previous
+        return False
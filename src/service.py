@@ -0,0 +1,265 @@
+# Import libraries
+import os # For configuration
+import sys # For startup warnings
+import time # For request latency
+import asyncio # For async request handling and micro-batching
+import threading # The metrics are updated from the event loop and read by /metrics
+from collections import deque # Recent latencies for the percentiles
+from concurrent.futures import ProcessPoolExecutor # CPU work outside the event loop
+import numpy as np # For the latency percentiles
+from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi.responses import PlainTextResponse
+
+import profiling # SIGNATURE_PROFILE=1 enables the stage metrics
+
+import signature_utils
+from gallery_index import load_gallery_index, DATABASE_DIR, INDEX_FILE
+from packed_gallery import open_packed_gallery
+from enrollment import EnrollmentJournal, apply_enrollments, JOURNAL_FILE
+
+# Define constants (overridable through environment variables)
+CPU_WORKERS = int(os.getenv("SERVICE_WORKERS", os.cpu_count() or 1)) # Matching processes
+BATCH_WINDOW_MS = float(os.getenv("SERVICE_BATCH_WINDOW_MS", 5)) # Wait for more requests this long
+MAX_BATCH_SIZE = int(os.getenv("SERVICE_MAX_BATCH", 16)) # Requests collected in one batching window
+LATENCY_WINDOW = 10000 # Requests kept per endpoint for the percentiles
+
+
+# ---------------------------------------------------------
+# Worker processes: each loads the gallery once and keeps it warm
+# ---------------------------------------------------------
+_gallery = None
+_journal = None # New enrollments, replayed into the gallery index before each call
+
+def _init_worker(database_path, index_path, pack_path=None, journal_path=None):
+    global _gallery, _journal
+    signature_utils.cv2.setNumThreads(1) # The pool already uses every core
+    if pack_path:
+        # Memory-mapped, pages shared by all workers; read-only, so enrollments
+        # are only served after the pack is rebuilt (see startup)
+        _gallery = open_packed_gallery(pack_path)
+    else:
+        _gallery = load_gallery_index(database_path, index_path)
+        if journal_path:
+            _journal = EnrollmentJournal(journal_path)
+            apply_enrollments(_gallery, _journal)
+
+def _apply_enrollments():
+    if _journal is not None:
+        apply_enrollments(_gallery, _journal)
+
+def _warm_up():
+    return len(_gallery)
+
+def _identify_batch(images):
+    _apply_enrollments()
+
+    # Decode every upload once; a broken one only fails its own request
+    decoded = []
+    for image in images:
+        try:
+            decoded.append(signature_utils.to_grayscale(image))
+        except ValueError as e:
+            decoded.append({"status": "invalid", "message": str(e)})
+
+    # OCR for the whole batch at once, then each image hits the OCR cache
+    # (if the batch fails, each image runs its own OCR below)
+    try:
+        signature_utils.extract_texts_from_images([img for img in decoded if not isinstance(img, dict)])
+    except Exception:
+        pass
+    return [img if isinstance(img, dict) else _identify_one(img) for img in decoded]
+
+def _identify_one(img):
+    # Any failure only fails its own request
+    try:
+        return _to_json(signature_utils.compare_all_signatures(img, gallery=_gallery, trace=profiling.is_enabled(), use_cache=True))
+    except Exception as e:
+        return {"status": "failed", "message": f"{type(e).__name__}: {e}"}
+
+def _verify(image, person_name, threshold):
+    _apply_enrollments()
+    return signature_utils.verify_signature(image, person_name, _gallery, threshold)
+
+def _to_json(result):
+    if "top_3_matches" in result:
+        result = dict(result, top_3_matches=[(name, float(score)) for name, score in result["top_3_matches"]])
+    return result
+
+
+# ---------------------------------------------------------
+# Micro-batching: concurrent /identify requests share worker calls
+# ---------------------------------------------------------
+class MicroBatcher:
+    """
+    Collects requests for up to BATCH_WINDOW_MS (or MAX_BATCH_SIZE requests)
+    and splits them into one sub-batch per worker process, so a burst is
+    matched by every worker in parallel; each sub-batch still runs its OCR
+    as one batch.
+    """
+
+    def __init__(self, executor, workers=CPU_WORKERS, window_ms=BATCH_WINDOW_MS, max_batch=MAX_BATCH_SIZE):
+        self.executor = executor
+        self.workers = max(1, workers)
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.pending = asyncio.Queue()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def submit(self, image):
+        future = asyncio.get_running_loop().create_future()
+        await self.pending.put((image, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.pending.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.pending.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Near-equal sub-batches, at most one per worker
+            n_parts = min(self.workers, len(batch))
+            bounds = [len(batch) * i // n_parts for i in range(n_parts + 1)]
+            for start, end in zip(bounds, bounds[1:]):
+                asyncio.create_task(self._dispatch(batch[start:end]))
+
+    async def _dispatch(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self.executor, _identify_batch, [image for image, _ in batch])
+            for (_, future), result in zip(batch, results):
+                # Stage traces come back from the workers and are summed here
+                if "trace" in result:
+                    profiling.metrics.merge(result.pop("trace"))
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+# ---------------------------------------------------------
+# Latency metrics
+# ---------------------------------------------------------
+class LatencyMetrics:
+    """Request counts and p50 / p99 latency over the most recent requests."""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self.latencies = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, seconds):
+        with self.lock:
+            self.latencies.setdefault(endpoint, deque(maxlen=self.window)).append(seconds * 1000)
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+
+    def summary(self):
+        with self.lock:
+            return {
+                endpoint: {
+                    "requests": self.counts[endpoint],
+                    "p50_ms": round(float(np.percentile(values, 50)), 2),
+                    "p99_ms": round(float(np.percentile(values, 99)), 2),
+                }
+                for endpoint, values in self.latencies.items()
+            }
+
+
+# ---------------------------------------------------------
+# HTTP API
+# ---------------------------------------------------------
+app = FastAPI(title="Signature Recognition Service")
+metrics = LatencyMetrics()
+state = {}
+
+@app.on_event("startup")
+async def startup():
+    pack_path = os.getenv("GALLERY_PACK")
+    journal_path = os.getenv("ENROLL_JOURNAL", JOURNAL_FILE)
+    if pack_path:
+        # A packed gallery cannot take enrollments without a restart
+        if os.getenv("ENROLL_JOURNAL"):
+            raise RuntimeError("ENROLL_JOURNAL cannot be used with GALLERY_PACK: the packed gallery is read-only, "
+                               "rebuild it (packed_gallery.py) and restart to serve new enrollments")
+        if os.path.exists(journal_path):
+            print(f"Warning: {journal_path} is ignored with GALLERY_PACK; enrollments are served once the pack "
+                  "is rebuilt and the service restarted", file=sys.stderr)
+        journal_path = None
+    else:
+        # Refresh and save a stale gallery index once here, so the workers only load it
+        load_gallery_index(os.getenv("GALLERY_DIR", DATABASE_DIR), os.getenv("GALLERY_INDEX", INDEX_FILE))
+
+    executor = ProcessPoolExecutor(
+        max_workers=CPU_WORKERS,
+        initializer=_init_worker,
+        initargs=(os.getenv("GALLERY_DIR", DATABASE_DIR), os.getenv("GALLERY_INDEX", INDEX_FILE), pack_path, journal_path),
+    )
+    # Start every worker now, so the gallery is loaded before the first request
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*[loop.run_in_executor(executor, _warm_up) for _ in range(CPU_WORKERS)])
+
+    state["executor"] = executor
+    state["batcher"] = MicroBatcher(executor, CPU_WORKERS)
+    state["batcher"].start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    state["executor"].shutdown(cancel_futures=True)
+
+@app.post("/identify")
+async def identify(file: UploadFile = File(...)):
+    """1:N identification of an uploaded signature image."""
+    start = time.perf_counter()
+    image = await file.read()
+    try:
+        result = await state["batcher"].submit(image)
+    finally:
+        metrics.record("identify", time.perf_counter() - start)
+    if result.get("status") == "invalid":
+        raise HTTPException(status_code=400, detail=result["message"])
+    if result.get("status") == "failed":
+        raise HTTPException(status_code=500, detail=result["message"])
+    return result
+
+@app.post("/verify")
+async def verify(file: UploadFile = File(...), person_name: str = Form(...),
+                 threshold: float = Form(signature_utils.VERIFY_THRESHOLD)):
+    """1:1 verification of an uploaded signature against one enrolled person."""
+    start = time.perf_counter()
+    image = await file.read()
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(state["executor"], _verify, image, person_name, threshold)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        metrics.record("verify", time.perf_counter() - start)
+
+@app.get("/metrics")
+async def get_metrics():
+    """Request counts and p50 / p99 latency per endpoint."""
+    return metrics.summary()
+
+@app.get("/metrics/prometheus", response_class=PlainTextResponse)
+async def get_prometheus_metrics():
+    """Pipeline stage timings and event counts (SIGNATURE_PROFILE=1), Prometheus text format."""
+    return profiling.metrics.prometheus_text()
+
+
+# Run the service locally when this script is executed directly
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host=os.getenv("SERVICE_HOST", "127.0.0.1"), port=int(os.getenv("SERVICE_PORT", 8000)))
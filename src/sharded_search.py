@@ -0,0 +1,461 @@
+# Import libraries
+import os # For file handling
+import sys # For the command line output
+import json # For the shard manifest and the message headers
+import time # For the per-shard timings
+import pickle # Entries are spilled to per-shard files while rebalancing
+import socket # Coordinator side of the shard protocol
+import struct # For the message lengths
+import asyncio # Shard worker server
+import hashlib # For the shard assignment
+import argparse # For the command line
+import multiprocessing # For the local shard workers
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np # For the probe canvases
+
+import profiling # Shard timeouts and errors are counted
+from signature_utils import top_k_gallery_index, shortlist_candidates, global_descriptor
+from gallery_index import GalleryIndex, load_gallery_index, DATABASE_DIR, INDEX_FILE
+
+# Define constants
+SHARD_DIR = "../shards" # Shard index files and their manifest
+MANIFEST_FILE = "manifest.json"
+BASE_PORT = 7100 # Local shard i listens on BASE_PORT + i
+SHARD_TIMEOUT = 2.0 # Seconds a shard has to answer before the query goes on without it
+LOCAL_K = 3 # Matches returned by every shard
+SHARD_KEYS = ("filename", "id") # What shard_of hashes: the image filename, or the signatures.id of its PostgreSQL row
+
+SELECT_IDS = "SELECT id, image_path FROM signatures ORDER BY id"
+
+
+# ---------------------------------------------------------
+# Shard assignment
+# ---------------------------------------------------------
+def shard_of(key, n_shards):
+    """
+    Shard of a filename (or a signatures.id) among n_shards, by rendezvous
+    hashing: the shard with the highest hash of (key, shard) wins. The
+    same key always lands on the same shard, and going from N to N + 1
+    shards moves only about 1 / (N + 1) of the entries.
+    """
+    key = str(key).encode("utf-8")
+    scores = [hashlib.sha1(key + b"/" + str(shard).encode()).digest()[:8] for shard in range(n_shards)]
+    return max(range(n_shards), key=scores.__getitem__)
+
+
+def _shard_path(shard_dir, shard, n_shards):
+    return os.path.join(shard_dir, f"shard_{shard}_of_{n_shards}.pkl")
+
+
+def read_manifest(shard_dir=SHARD_DIR):
+    """The shard manifest: number of shards, shard files and entry counts."""
+    with open(os.path.join(shard_dir, MANIFEST_FILE), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def signature_ids():
+    """
+    filename -> signatures.id of the images loaded into PostgreSQL (see
+    db_utils.py), matched on the file name of image_path; the smallest id
+    wins if an image was loaded twice.
+    """
+    from db_utils import get_connection # Only needed for key="id"
+
+    connection = get_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(SELECT_IDS)
+        ids = {}
+        for row_id, image_path in cursor:
+            ids.setdefault(os.path.basename(image_path), row_id)
+        cursor.close()
+    finally:
+        connection.close()
+    return ids
+
+
+def _write_manifest(shard_dir, manifest):
+    tmp_path = os.path.join(shard_dir, MANIFEST_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_path, os.path.join(shard_dir, MANIFEST_FILE))
+
+
+def _write_shard(shard_dir, shard, n_shards, entries, database_path):
+    # One shard index file, holding only its entries
+    index = GalleryIndex(database_path)
+    index.add_entries(entries)
+    path = _shard_path(shard_dir, shard, n_shards)
+    index.save(path)
+    return {"file": os.path.basename(path), "entries": len(index)}
+
+
+def write_shards(entries, n_shards, shard_dir=SHARD_DIR, database_path=DATABASE_DIR, key="filename"):
+    """
+    Partitions gallery entries into n_shards shard index files (gallery
+    indexes holding only their shard's entries) and writes the manifest
+    last, atomically. key is the entry field hashed by shard_of (see
+    SHARD_KEYS; with "id" every entry must carry its signatures.id, as
+    build_shards adds it). Returns the manifest.
+    """
+    if key not in SHARD_KEYS:
+        raise ValueError(f"Unknown shard key: {key}")
+    os.makedirs(shard_dir, exist_ok=True)
+    groups = [[] for _ in range(n_shards)]
+    for entry in entries:
+        groups[shard_of(entry[key], n_shards)].append(entry)
+
+    manifest = {"n_shards": n_shards, "key": key, "database_path": os.path.abspath(database_path), "shards": []}
+    for shard, group in enumerate(groups):
+        manifest["shards"].append(_write_shard(shard_dir, shard, n_shards, group, database_path))
+    _write_manifest(shard_dir, manifest)
+    return manifest
+
+
+def build_shards(n_shards, shard_dir=SHARD_DIR, database_path=DATABASE_DIR, index_path=INDEX_FILE, key="filename"):
+    """
+    Splits the gallery index (built or refreshed as needed) into n_shards
+    shards. With key="id", entries are assigned by the signatures.id of
+    their PostgreSQL row (see signature_ids), so the gallery directory and
+    the database agree on the shard of every signature.
+    """
+    gallery = load_gallery_index(database_path, index_path)
+    entries = gallery.entries
+    if key == "id":
+        ids = signature_ids()
+        missing = [e["filename"] for e in entries if e["filename"] not in ids]
+        if missing:
+            raise ValueError(f"{len(missing)} gallery images have no signatures row (e.g. {missing[0]})")
+        entries = [dict(e, id=ids[e["filename"]]) for e in entries]
+    return write_shards(entries, n_shards, shard_dir, database_path, key)
+
+
+def _read_spill(path):
+    # Entries spilled by rebalance: length-prefixed pickles
+    entries = []
+    with open(path, "rb") as f:
+        while True:
+            length = f.read(8)
+            if not length:
+                return entries
+            entries.append(pickle.loads(f.read(struct.unpack("<Q", length)[0])))
+
+
+def rebalance(n_shards, shard_dir=SHARD_DIR):
+    """
+    Re-partitions the current shards into n_shards shards (e.g. after
+    adding a worker node) without going back to the images, with the key
+    they were built with. Streamed: the old shards are read one at a time,
+    each entry appended to the spill file of its new shard, then the new
+    shards are written one at a time, so only one shard is in memory. Every
+    shard file is rewritten, though only about 1 / n_shards of the entries
+    change shard when adding one. Old shard files are removed once the new
+    manifest is written; workers must then be restarted (or sent a
+    reload). Returns (manifest, entries moved).
+    """
+    old = read_manifest(shard_dir)
+    key = old.get("key", "filename")
+    spill_paths = [_shard_path(shard_dir, shard, n_shards) + ".spill" for shard in range(n_shards)]
+    moved = 0
+    try:
+        spills = [open(path, "wb") for path in spill_paths]
+        try:
+            for shard, info in enumerate(old["shards"]):
+                for entry in GalleryIndex.load(os.path.join(shard_dir, info["file"])).entries:
+                    target = shard_of(entry[key], n_shards)
+                    moved += target != shard
+                    record = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+                    spills[target].write(struct.pack("<Q", len(record)) + record)
+        finally:
+            for spill in spills:
+                spill.close()
+
+        manifest = {"n_shards": n_shards, "key": key, "database_path": old["database_path"], "shards": []}
+        for shard, path in enumerate(spill_paths):
+            manifest["shards"].append(_write_shard(shard_dir, shard, n_shards, _read_spill(path), old["database_path"]))
+            os.remove(path)
+        _write_manifest(shard_dir, manifest)
+    finally:
+        for path in spill_paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    current = {info["file"] for info in manifest["shards"]}
+    for info in old["shards"]:
+        if info["file"] not in current:
+            os.remove(os.path.join(shard_dir, info["file"]))
+    return manifest, moved
+
+
+# ---------------------------------------------------------
+# Wire format
+# ---------------------------------------------------------
+# Every message: 8 bytes (header length, payload length, little-endian
+# uint32), a JSON header, and a raw payload (the probe canvas for a
+# search). No pickle crosses the socket.
+
+def _pack_message(header, payload=b""):
+    data = json.dumps(header).encode("utf-8")
+    return struct.pack("<II", len(data), len(payload)) + data + payload
+
+
+def _recv_exact(sock, n):
+    chunks = []
+    while n:
+        chunk = sock.recv(min(n, 1 << 20))
+        if not chunk:
+            raise ConnectionError("Shard closed the connection")
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b"".join(chunks)
+
+
+def _request(address, header, payload=b"", timeout=SHARD_TIMEOUT):
+    # One request / response on a fresh connection; the timeout applies to
+    # connecting and to every read
+    with socket.create_connection(address, timeout=timeout) as sock:
+        sock.sendall(_pack_message(header, payload))
+        header_length, payload_length = struct.unpack("<II", _recv_exact(sock, 8))
+        response = json.loads(_recv_exact(sock, header_length))
+        _recv_exact(sock, payload_length)
+    if "error" in response:
+        raise RuntimeError(response["error"])
+    return response
+
+
+# ---------------------------------------------------------
+# Shard worker
+# ---------------------------------------------------------
+class ShardWorker:
+    """Serves the local top K of one shard index over TCP."""
+
+    def __init__(self, shard_path, shard=None):
+        self.shard_path = shard_path
+        self.shard = shard
+        self.gallery = None
+        self.load()
+
+    def load(self):
+        # Loaded as saved: no directory refresh, the shard holds only its entries
+        gallery = GalleryIndex.load(self.shard_path)
+        gallery.canvas_stack()
+        gallery.canvas_norms()
+        self.gallery = gallery
+
+    def search(self, header, payload):
+        start = time.perf_counter()
+        query_img = np.frombuffer(payload, dtype=np.uint8).reshape(header["shape"])
+        rows = None
+        if header.get("shortlist_k"):
+            rows = shortlist_candidates(global_descriptor(query_img), self.gallery.descriptor_matrix(),
+                                        header["shortlist_k"])
+        matches = top_k_gallery_index(
+            query_img, header["is_cursive"], self.gallery, rows, header.get("k", LOCAL_K),
+            header.get("rejection_bounds"), None, header.get("binary_metric"), header.get("letter_mode", "pairwise"))
+        return {
+            "shard": self.shard,
+            "matches": [(filename, float(score)) for filename, score in matches],
+            "elapsed_ms": round(1000 * (time.perf_counter() - start), 2),
+        }
+
+    def handle(self, header, payload):
+        op = header.get("op")
+        if op == "search":
+            return self.search(header, payload)
+        if op == "info":
+            return {"shard": self.shard, "entries": len(self.gallery), "file": self.shard_path}
+        if op == "reload":
+            self.load()
+            return {"shard": self.shard, "entries": len(self.gallery)}
+        return {"error": f"Unknown op: {op}"}
+
+    async def _serve_client(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            header_length, payload_length = struct.unpack("<II", await reader.readexactly(8))
+            header = json.loads(await reader.readexactly(header_length))
+            payload = await reader.readexactly(payload_length)
+            try:
+                response = await loop.run_in_executor(None, self.handle, header, payload)
+            except Exception as e:
+                response = {"error": f"{type(e).__name__}: {e}"}
+            writer.write(_pack_message(response))
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self._serve_client, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+def serve_shard(shard_path, host="127.0.0.1", port=BASE_PORT, shard=None):
+    """Runs a shard worker until interrupted."""
+    worker = ShardWorker(shard_path, shard)
+    print(f"Shard {shard} ({len(worker.gallery)} entries) listening on {host}:{port}", file=sys.stderr)
+    asyncio.run(worker.serve(host, port))
+
+
+def start_local_shards(shard_dir=SHARD_DIR, host="127.0.0.1", base_port=BASE_PORT, timeout=60):
+    """
+    Starts one worker process per shard of the manifest, on consecutive
+    ports, and waits until all answer. Returns (addresses, processes).
+    """
+    manifest = read_manifest(shard_dir)
+    context = multiprocessing.get_context("spawn")
+    addresses, processes = [], []
+    for shard, info in enumerate(manifest["shards"]):
+        address = (host, base_port + shard)
+        process = context.Process(target=serve_shard, args=(os.path.join(shard_dir, info["file"]), host, address[1], shard),
+                                  daemon=True)
+        process.start()
+        addresses.append(address)
+        processes.append(process)
+
+    deadline = time.monotonic() + timeout
+    for address, process in zip(addresses, processes):
+        while True:
+            try:
+                _request(address, {"op": "info"}, timeout=1.0)
+                break
+            except OSError:
+                if not process.is_alive():
+                    raise RuntimeError(f"Shard worker for {address} exited with code {process.exitcode}")
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Shard at {address} did not start")
+                time.sleep(0.1)
+    return addresses, processes
+
+
+# ---------------------------------------------------------
+# Coordinator
+# ---------------------------------------------------------
+class ShardCoordinator:
+    """
+    Scatter-gather over shard workers: the probe canvas (normalized once,
+    by the caller) is sent to every shard, each returns its local top k,
+    and the merged global top k is the same as searching one gallery
+    holding every shard (ties go to the smaller filename).
+
+    Shards that fail or do not answer within timeout seconds are left out;
+    the report then lists them under "missing" and the result is partial.
+    """
+
+    def __init__(self, addresses, timeout=SHARD_TIMEOUT):
+        self.addresses = [tuple(address) for address in addresses]
+        self.timeout = timeout
+        # A few threads per shard, so a hung shard does not hold up the next queries
+        self.executor = ThreadPoolExecutor(max_workers=max(1, 4 * len(self.addresses)))
+
+    def search(self, query_img, query_is_cursive, k=3, shortlist_k=None, rejection_bounds=None,
+               binary_metric=None, letter_mode="pairwise"):
+        """Global top k (filename, similarity) pairs, and the per-shard report."""
+        query_img = np.ascontiguousarray(query_img, dtype=np.uint8)
+        header = {
+            "op": "search", "k": k, "shape": list(query_img.shape), "is_cursive": bool(query_is_cursive),
+            "shortlist_k": shortlist_k, "rejection_bounds": rejection_bounds,
+            "binary_metric": binary_metric, "letter_mode": letter_mode,
+        }
+        payload = query_img.tobytes()
+        futures = {
+            self.executor.submit(_request, address, header, payload, self.timeout): shard
+            for shard, address in enumerate(self.addresses)
+        }
+        done, not_done = wait(futures, timeout=self.timeout)
+
+        matches, answered, missing = [], {}, {}
+        for future in not_done:
+            missing[futures[future]] = "timeout"
+            profiling.count("shard_timeout")
+        for future in done:
+            shard = futures[future]
+            try:
+                response = future.result()
+            except socket.timeout:
+                missing[shard] = "timeout"
+                profiling.count("shard_timeout")
+                continue
+            except Exception as e:
+                missing[shard] = f"{type(e).__name__}: {e}"
+                profiling.count("shard_error")
+                continue
+            answered[shard] = response["elapsed_ms"]
+            matches.extend((filename, score) for filename, score in response["matches"])
+
+        matches.sort(key=lambda match: (-match[1], match[0]))
+        report = {"answered": dict(sorted(answered.items())), "missing": dict(sorted(missing.items()))}
+        return matches[:k], report
+
+    def info(self):
+        """Entries per shard (None for shards that do not answer)."""
+        sizes = []
+        for address in self.addresses:
+            try:
+                sizes.append(_request(address, {"op": "info"}, timeout=self.timeout)["entries"])
+            except OSError:
+                sizes.append(None)
+        return sizes
+
+    def reload(self):
+        """Asks every shard to reload its shard file (e.g. after a rebalance with the same count)."""
+        return [_request(address, {"op": "reload"}, timeout=max(self.timeout, 60))["entries"] for address in self.addresses]
+
+
+def _parse_addresses(values):
+    return [(host, int(port)) for host, port in (value.rsplit(":", 1) for value in values)]
+
+
+# Build, serve, query or rebalance the shards when this script is executed directly
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sharded scatter-gather signature search.")
+    parser.add_argument("command", choices=["build", "serve", "local", "query", "rebalance"],
+                        help="build: split the gallery index into shards; serve: run one shard worker; "
+                             "local: run a worker per shard on this machine; query: identify an image "
+                             "through the shards; rebalance: change the number of shards")
+    parser.add_argument("image", nargs="?", help="probe image (query)")
+    parser.add_argument("--shards", type=int, default=4, help="number of shards (build, rebalance)")
+    parser.add_argument("--key", choices=SHARD_KEYS, default="filename",
+                        help="shard assignment by image filename or by signatures.id (build; rebalance keeps it)")
+    parser.add_argument("--shard", type=int, default=0, help="shard served (serve)")
+    parser.add_argument("--shard-dir", default=SHARD_DIR, help="shard files and manifest")
+    parser.add_argument("--database", default=DATABASE_DIR, help="gallery image directory (build)")
+    parser.add_argument("--index", default=INDEX_FILE, help="gallery index file (build)")
+    parser.add_argument("--host", default="127.0.0.1", help="listening address (serve, local)")
+    parser.add_argument("--port", type=int, default=BASE_PORT, help="port (serve) or first port (local)")
+    parser.add_argument("--addresses", nargs="+", default=None, help="host:port of every shard (query; default: local ports)")
+    parser.add_argument("--timeout", type=float, default=SHARD_TIMEOUT, help="seconds per shard (query)")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        manifest = build_shards(args.shards, args.shard_dir, args.database, args.index, args.key)
+        print(f"{args.shards} shards: {[s['entries'] for s in manifest['shards']]} entries")
+
+    elif args.command == "rebalance":
+        manifest, moved = rebalance(args.shards, args.shard_dir)
+        print(f"{args.shards} shards: {[s['entries'] for s in manifest['shards']]} entries, {moved} moved")
+
+    elif args.command == "serve":
+        manifest = read_manifest(args.shard_dir)
+        serve_shard(os.path.join(args.shard_dir, manifest["shards"][args.shard]["file"]), args.host, args.port, args.shard)
+
+    elif args.command == "local":
+        addresses, processes = start_local_shards(args.shard_dir, args.host, args.port)
+        print(f"{len(addresses)} shards running: {' '.join(f'{h}:{p}' for h, p in addresses)}")
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            pass
+
+    elif args.command == "query":
+        from signature_utils import compare_all_signatures
+
+        if args.addresses:
+            addresses = _parse_addresses(args.addresses)
+        else:
+            addresses = [(args.host, args.port + i) for i in range(read_manifest(args.shard_dir)["n_shards"])]
+        result = compare_all_signatures(args.image, shards=ShardCoordinator(addresses, args.timeout))
+        print(json.dumps(result, ensure_ascii=False, indent=2, default=float))
@@ -0,0 +1,93 @@
+# Import libraries
+import os # For file handling
+import time # For timing the two search modes
+import argparse # For the command line
+
+from signature_utils import (
+    extract_features, is_cursive, global_descriptor,
+    shortlist_candidates, score_gallery_index,
+)
+from gallery_index import load_gallery_index, DATABASE_DIR, INDEX_FILE
+
+# Define constants
+QUERY_DIR = "../signatures_to_test" # Probe images used for the report
+DEFAULT_KS = (5, 10, 20, 50)
+
+
+def top_filenames(results, n=3):
+    """Filenames of the n best results."""
+    results = sorted(results, key=lambda x: x[1], reverse=True)
+    return [f for f, _ in results[:n]]
+
+
+def shortlist_report(gallery, query_paths, ks=DEFAULT_KS):
+    """
+    Compares the coarse-to-fine search against the full scan.
+
+    For every K:
+    - recall@K: fraction of the full scan's top 3 found in the K shortlist
+    - top-1 kept: fraction of queries whose full-scan best match survives
+    - mean query time of the re-ranking step, next to the full scan's
+    """
+    full_time = 0.0
+    stats = {k: {"recall": 0.0, "top1": 0, "time": 0.0} for k in ks}
+    queries = 0
+
+    for path in query_paths:
+        query_img, quality = extract_features(path)
+        if not quality:
+            continue
+        query_is_cursive = is_cursive(query_img)
+        queries += 1
+
+        start = time.perf_counter()
+        reference = top_filenames(score_gallery_index(query_img, query_is_cursive, gallery))
+        full_time += time.perf_counter() - start
+
+        for k in ks:
+            start = time.perf_counter()
+            rows = shortlist_candidates(global_descriptor(query_img), gallery.descriptor_matrix(), k)
+            shortlisted = top_filenames(score_gallery_index(query_img, query_is_cursive, gallery, rows))
+            stats[k]["time"] += time.perf_counter() - start
+
+            found = set(gallery.filename(i) for i in rows)
+            stats[k]["recall"] += sum(f in found for f in reference) / max(len(reference), 1)
+            stats[k]["top1"] += int(bool(reference) and shortlisted[:1] == reference[:1])
+
+    return {
+        "queries": queries,
+        "gallery_size": len(gallery),
+        "full_scan_ms": 1000 * full_time / max(queries, 1),
+        "by_k": {
+            k: {
+                "recall_at_k": s["recall"] / max(queries, 1),
+                "top1_kept": s["top1"] / max(queries, 1),
+                "query_ms": 1000 * s["time"] / max(queries, 1),
+            }
+            for k, s in stats.items()
+        },
+    }
+
+
+# Print the report when this script is executed directly
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recall@K of the shortlist search against the full scan.")
+    parser.add_argument("--database", default=DATABASE_DIR, help="gallery image directory")
+    parser.add_argument("--index", default=INDEX_FILE, help="gallery index file")
+    parser.add_argument("--queries", default=QUERY_DIR, help="directory of probe images")
+    parser.add_argument("--k", type=int, nargs="+", default=list(DEFAULT_KS), help="shortlist sizes")
+    args = parser.parse_args()
+
+    gallery = load_gallery_index(args.database, args.index)
+    query_paths = [
+        os.path.join(args.queries, f) for f in sorted(os.listdir(args.queries))
+        if f.lower().endswith((".png", ".jpg", ".jpeg"))
+    ]
+
+    report = shortlist_report(gallery, query_paths, args.k)
+
+    print(f"Gallery: {report['gallery_size']} signatures, {report['queries']} queries")
+    print(f"Full scan: {report['full_scan_ms']:.1f} ms/query")
+    for k, row in report["by_k"].items():
+        print(f"K={k:>4}: recall@K = {row['recall_at_k']:.2f} | "
+              f"top-1 kept = {row['top1_kept']:.2f} | {row['query_ms']:.1f} ms/query")
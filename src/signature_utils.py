@@ -1,16 +1,57 @@
 import cv2
 import numpy as np
 import os
-import json
-
-from skimage.metrics import structural_similarity as ssim
-import pytesseract
-
-pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
+import time # For the directory gallery refresh interval
+import heapq # For the streaming top-K selection
+import threading # Directory galleries of cached queries are shared by every thread
+from contextlib import nullcontext
+import io # For reading image headers from bytes
+import weakref # Result cache groups refer to galleries without keeping them alive
+import atexit # Scan pools are shut down when the interpreter exits
+import multiprocessing # Scan workers are spawned, not forked from a process running OpenCV threads
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool # A scan worker died (crash, OOM kill)
+
+import profiling # Stage timers and counters (off unless enabled or traced)
+from cache_utils import LRUCache, NearDuplicateCache, content_hash
+from ocr_engines import get_ocr_engine # OCR backend (tesserocr, pytesseract, ...)
+
+from name_index import NameIndex, load_names, OCR_MATCH_THRESHOLD, NAME_MAP_FILE, NAME_LOG_SUFFIX # Indexed name lookup
+
+# 0. LOAD IMAGE
+# ---------------------------------------------------------
+def to_grayscale(image):
+    """
+    Grayscale uint8 image from any supported input:
+    - a file path
+    - the raw bytes of an encoded image (e.g. an upload)
+    - a NumPy image, BGR / BGRA (as from cv2.imdecode) or already grayscale
+    Grayscale arrays are returned as they are, without a copy, so decoding
+    once and passing the array around shares the conversion.
+    """
+    if isinstance(image, np.ndarray):
+        if image.ndim == 2:
+            return image
+        if image.shape[2] == 4:
+            return cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY)
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        with profiling.stage("decode"):
+            img = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            raise ValueError("Could not decode image bytes")
+        return img
+
+    with profiling.stage("decode"):
+        img = cv2.imread(image, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise FileNotFoundError(f"Could not load image: {image}")
+    return img
 
-import difflib # para comparação de strings
 
 # 1. NORMALIZE SIGNATURE
+@profiling.timed("normalize")
 def normalize_signature(image_path):
     """
     Loads and normalizes a signature:
@@ -20,11 +61,11 @@ def normalize_signature(image_path):
     - crop to content
     - center on a fixed canvas
     - resize to consistent size
+
+    Accepts a path, raw image bytes or a NumPy image (see to_grayscale).
     """
 
-    img = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-    if img is None:
-        raise FileNotFoundError(f"Could not load image: {image_path}")
+    img = to_grayscale(image_path)
 
     # 1. Binarize (invert so ink = white)
     _, th = cv2.threshold(
@@ -61,20 +102,144 @@ def normalize_signature(image_path):
 
     return canvas
 
+# Fast preprocessing, for large scans (e.g. 300 dpi documents)
+FAST_DECODE_MIN_SIDE = 1200 # Reduced decoding keeps at least this many pixels on the long side
+FAST_ANALYSIS_SIDE = 1000 # Max long side of the downscaled copy used to find the bounding box
+_REDUCED_DECODE = ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                   (2, cv2.IMREAD_REDUCED_GRAYSCALE_2))
+
+def image_size(image):
+    """(width, height) of an image file or encoded bytes, from its header only (None if unknown)."""
+    try:
+        from PIL import Image # Header parsing without decoding the pixels
+        source = io.BytesIO(image) if isinstance(image, (bytes, bytearray, memoryview)) else image
+        with Image.open(source) as img:
+            return img.size
+    except Exception:
+        return None
+
+def decode_reduced(image, min_side=FAST_DECODE_MIN_SIDE):
+    """
+    Like to_grayscale, but a file or encoded image whose long side is at
+    least 2 x min_side is decoded at 1/2, 1/4 or 1/8 size (JPEG decoders
+    do this while decoding, much faster than a full decode). The long side
+    of the result stays >= min_side. Arrays are returned as to_grayscale.
+    """
+    if isinstance(image, np.ndarray):
+        return to_grayscale(image)
+
+    size = image_size(image)
+    flag = None
+    if size is not None:
+        flag = next((f for factor, f in _REDUCED_DECODE if max(size) // factor >= min_side), None)
+    if flag is None:
+        return to_grayscale(image)
+
+    with profiling.stage("decode"):
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            img = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), flag)
+        else:
+            img = cv2.imread(image, flag)
+    if img is None:
+        return to_grayscale(image)
+    return img
+
+@profiling.timed("normalize")
+def normalize_signature_fast(image_path, out=None):
+    """
+    Faster normalize_signature for large inputs, giving the same crop
+    within a pixel or two of the original resolution:
+    - reduced-resolution decoding (see decode_reduced)
+    - Otsu threshold on a copy downscaled by a power of two to at most
+      FAST_ANALYSIS_SIDE (integer factors take OpenCV's fast INTER_AREA path)
+    - bounding box straight from the mask (the morphological close is
+      skipped: closing never grows a mask past its bounding box)
+    - the result is written into out (a 180 x 600 uint8 array) if given,
+      so a caller can reuse one buffer
+    """
+    img = decode_reduced(image_path)
+    target_w, target_h = 600, 180
+    if out is None:
+        out = np.empty((target_h, target_w), dtype=np.uint8)
+
+    # 1. Binarize a downscaled copy (invert so ink = white)
+    height, width = img.shape
+    factor = 1
+    while max(height, width) > factor * FAST_ANALYSIS_SIDE:
+        factor *= 2
+    small = img
+    if factor > 1:
+        small = cv2.resize(img, (max(1, width // factor), max(1, height // factor)), interpolation=cv2.INTER_AREA)
+    _, th = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+
+    # 2. Bounding box of the ink, mapped back to the decoded image
+    if cv2.countNonZero(th) == 0:
+        cv2.resize(img, (target_w, target_h), dst=out, interpolation=cv2.INTER_AREA)
+        return out
+    x, y, w, h = cv2.boundingRect(th)
+    sx, sy = width / th.shape[1], height / th.shape[0]
+    x0, y0 = int(x * sx), int(y * sy)
+    x1, y1 = min(width, int(np.ceil((x + w) * sx))), min(height, int(np.ceil((y + h) * sy)))
+    cropped = img[y0:y1, x0:x1]
+    w, h = x1 - x0, y1 - y0
+
+    # 3. Resize (preserving aspect ratio) and center in the output buffer
+    scale = min(target_w / w, target_h / h)
+    new_w, new_h = int(w * scale), int(h * scale)
+    y_offset = (target_h - new_h) // 2
+    x_offset = (target_w - new_w) // 2
+    out.fill(255)
+    cv2.resize(cropped, (new_w, new_h), dst=out[y_offset:y_offset+new_h, x_offset:x_offset+new_w],
+               interpolation=cv2.INTER_AREA)
+    return out
+
+def normalize_signatures(images, workers=4, fast=True, out=None):
+    """
+    Normalizes many signatures (paths, bytes or arrays) into one
+    N x 180 x 600 uint8 array, in a thread pool (OpenCV releases the GIL
+    while decoding and resizing). out, if given, is reused as the result.
+    """
+    images = list(images)
+    if out is None:
+        out = np.empty((len(images), 180, 600), dtype=np.uint8)
+
+    def normalize_one(i):
+        if fast:
+            normalize_signature_fast(images[i], out[i])
+        else:
+            out[i] = normalize_signature(images[i])
+
+    if workers <= 1:
+        for i in range(len(images)):
+            normalize_one(i)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(normalize_one, range(len(images))))
+    return out
+
 
 # 2. SEGMENT LETTERS
 # ---------------------------------------------------------
+@profiling.timed("segment_letters")
 def segment_letters(img):
     """
     Splits a normalized signature into individual letters.
     Returns a list of letter images ordered left-to-right.
     """
 
+    return [img[y:y+h, x:x+w] for x, y, w, h in letter_boxes(img)]
+
+def letter_boxes(img):
+    """
+    Bounding boxes (x, y, w, h) of the letters found by segment_letters,
+    ordered left-to-right.
+    """
+
     _, th = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
 
     contours, _ = cv2.findContours(th, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
-    letters = []
+    boxes = []
     for c in contours:
         x, y, w, h = cv2.boundingRect(c)
 
@@ -82,16 +247,16 @@ def segment_letters(img):
         if w < 5 or h < 20:
             continue
 
-        letter = img[y:y+h, x:x+w]
-        letters.append((x, letter))
+        boxes.append((x, y, w, h))
 
     # Sort by x position (left to right)
-    letters.sort(key=lambda x: x[0])
+    boxes.sort(key=lambda box: box[0])
 
-    return [l for _, l in letters]
+    return boxes
 
 # 3. COMPARE LETTERS
 # ---------------------------------------------------------
+@profiling.timed("match_letters")
 def compare_letters(letters1, letters2):
     """
     Compares two lists of letters using template matching.
@@ -113,6 +278,198 @@ def compare_letters(letters1, letters2):
 
     return round(sum(scores) / len(scores) * 100, 2)
 
+@profiling.timed("match_letters")
+def compare_letters_bounded(letters1, letters2, can_enter):
+    """
+    Same score as compare_letters, but gives up (returns None) as soon as
+    can_enter(upper_bound) is False, the upper bound being the score
+    reached if every remaining letter matched perfectly.
+    """
+
+    if len(letters1) == 0 or len(letters2) == 0:
+        return 0
+
+    n = min(len(letters1), len(letters2))
+    total = 0
+
+    for i in range(n):
+        l1 = cv2.resize(letters1[i], (40, 60))
+        l2 = cv2.resize(letters2[i], (40, 60))
+
+        res = cv2.matchTemplate(l1, l2, cv2.TM_CCOEFF_NORMED)
+        total += res.max()
+
+        # Small margin: normalized correlations can exceed 1 by rounding
+        upper_bound = (total + (n - i - 1) * 1.0001) / n * 100 + 0.01
+        if not can_enter(upper_bound):
+            return None
+
+    return round(total / n * 100, 2)
+
+LETTER_SIZE = 40 * 60 # Pixels of a resized letter crop
+GROWTH_FACTOR = 1.25 # Room added when an append overflows a buffer (see append_rows)
+LETTER_MODES = ("pairwise", "batch", "dtw")
+
+def letter_vectors(letters):
+    """
+    40x60 letter crops as zero-mean, unit-norm float32 rows (L x 2400), so
+    that TM_CCOEFF_NORMED between two same-size crops is a dot product.
+    Also returns which rows were flat (constant), which OpenCV treats
+    specially.
+    """
+    if len(letters) == 0:
+        return np.zeros((0, LETTER_SIZE), dtype=np.float32), np.zeros(0, dtype=bool)
+
+    vectors = np.asarray(letters, dtype=np.float32).reshape(len(letters), LETTER_SIZE)
+    vectors = vectors - vectors.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(vectors, axis=1)
+    flat = norms < 1e-6
+    vectors[~flat] /= norms[~flat, None]
+    vectors[flat] = 0
+    return vectors, flat
+
+_BUFFERS = {} # id -> weak reference of the buffers made by append_rows
+
+def append_rows(array, rows):
+    """
+    array with rows appended along the first axis. The result is a prefix
+    view of a buffer with spare room (grown by GROWTH_FACTOR when full), so
+    repeated appends copy only the new rows, not the whole array each time.
+    The array passed in must be the last one returned for that buffer.
+    """
+    rows = np.asarray(rows, dtype=array.dtype).reshape((-1,) + array.shape[1:])
+    n, end = len(array), len(array) + len(rows)
+    buffer = array.base
+    reference = _BUFFERS.get(id(buffer))
+    if not (reference is not None and reference() is buffer and len(buffer) >= end
+            and buffer.ctypes.data == array.ctypes.data and buffer.shape[1:] == array.shape[1:]):
+        buffer = np.empty((max(end, int(n * GROWTH_FACTOR)),) + array.shape[1:], dtype=array.dtype)
+        buffer[:n] = array
+        key = id(buffer)
+        _BUFFERS[key] = weakref.ref(buffer, lambda _, key=key: _BUFFERS.pop(key, None))
+    buffer[n:end] = rows
+    return buffer[:end]
+
+class LetterMatrix:
+    """
+    Letter-matching engine over a whole gallery: every gallery letter is a
+    pre-normalized 2400-d row of one contiguous array, and signature j owns
+    rows offsets[j] to offsets[j + 1].
+
+    A probe is scored against many signatures at once:
+    - scores(): the same pairing as compare_letters (i-th letter with i-th
+      letter), as one gathered row-dot product and a segmented sum
+    - dtw_scores(): letters aligned by dynamic time warping over the letter
+      sequences instead, which tolerates a letter split in two or merged
+      with its neighbour
+    """
+
+    def __init__(self, letters, counts):
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.offsets = np.zeros(len(self.counts) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(self.counts)
+        self.vectors, self.flat = letter_vectors(letters)
+
+    @classmethod
+    def from_letter_lists(cls, letter_lists):
+        """Builds the matrix from one list of 40x60 letter crops per signature."""
+        letters = [letter for letter_list in letter_lists for letter in letter_list]
+        return cls(letters, [len(letter_list) for letter_list in letter_lists])
+
+    def append(self, letter_lists):
+        """Adds signatures at the end (one list of letter crops each), without rebuilding the rows already there."""
+        counts = np.array([len(letter_list) for letter_list in letter_lists], dtype=np.int64)
+        vectors, flat = letter_vectors([letter for letter_list in letter_lists for letter in letter_list])
+        # Rows first, counts last: len(self) only grows once the new signatures are complete
+        self.vectors = append_rows(self.vectors, vectors)
+        self.flat = append_rows(self.flat, flat)
+        self.offsets = append_rows(self.offsets, self.offsets[-1] + np.cumsum(counts))
+        self.counts = append_rows(self.counts, counts)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def _correlations(self, gallery_rows, query_vectors, query_flat, query_rows):
+        # TM_CCOEFF_NORMED of each (gallery letter, query letter) pair, with
+        # OpenCV's special cases: flat gallery letter -> 1, flat query -> 0
+        values = np.einsum("ij,ij->i", self.vectors[gallery_rows], query_vectors[query_rows])
+        values = np.clip(values, -1.0, 1.0)
+        values[query_flat[query_rows]] = 0.0
+        values[self.flat[gallery_rows]] = 1.0
+        return values
+
+    @profiling.timed("match_letters")
+    def scores(self, query_letters, rows=None):
+        """
+        compare_letters(query_letters, letters of signature j) for every
+        signature j (or only the given rows), as an array of 0-100 scores.
+        """
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows, dtype=np.int64)
+        query_vectors, query_flat = letter_vectors(resize_letters(query_letters))
+        if len(query_vectors) == 0 or len(rows) == 0:
+            return np.zeros(len(rows), dtype=np.float64)
+
+        # Letters paired by position: the first min(m, count) of each signature
+        pairs = np.minimum(self.counts[rows], len(query_vectors))
+        owner = np.repeat(np.arange(len(rows)), pairs)
+        position = np.arange(pairs.sum()) - np.repeat(np.cumsum(pairs) - pairs, pairs)
+        gallery_rows = self.offsets[rows][owner] + position
+
+        values = self._correlations(gallery_rows, query_vectors, query_flat, position)
+        sums = np.bincount(owner, weights=values, minlength=len(rows))
+
+        scores = np.zeros(len(rows), dtype=np.float64)
+        valid = pairs > 0
+        scores[valid] = np.round(sums[valid] / pairs[valid] * 100, 2)
+        return scores
+
+    @profiling.timed("match_letters_dtw")
+    def dtw_scores(self, query_letters, rows=None):
+        """
+        Like scores(), but the letter sequences are aligned with dynamic
+        time warping (cost 1 - correlation, steps right / down / diagonal);
+        the score is the mean correlation along the best path.
+        """
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows, dtype=np.int64)
+        query_vectors, query_flat = letter_vectors(resize_letters(query_letters))
+        scores = np.zeros(len(rows), dtype=np.float64)
+        m = len(query_vectors)
+        if m == 0:
+            return scores
+
+        # All gallery letters of the rows against all query letters, one matmul
+        starts, counts = self.offsets[rows], self.counts[rows]
+        letter_rows = np.concatenate([np.arange(a, a + c) for a, c in zip(starts.tolist(), counts.tolist())] or [np.zeros(0, np.int64)])
+        similarity = np.clip(self.vectors[letter_rows] @ query_vectors.T, -1.0, 1.0)
+        similarity[:, query_flat] = 0.0
+        similarity[self.flat[letter_rows]] = 1.0
+
+        block_start = 0
+        for j, count in enumerate(counts.tolist()):
+            if count:
+                scores[j] = round(_dtw_mean(similarity[block_start:block_start + count]) * 100, 2)
+            block_start += count
+        return scores
+
+def _dtw_mean(similarity):
+    # Mean similarity along the minimum-cost DTW path of a c x m similarity block
+    cost = 1.0 - similarity
+    c, m = cost.shape
+    total = np.full((c + 1, m + 1), np.inf)
+    length = np.zeros((c + 1, m + 1))
+    total[0, 0] = 0.0
+    for i in range(1, c + 1):
+        for j in range(1, m + 1):
+            # Previous cell with the lowest accumulated cost
+            best_total, best_length = total[i - 1, j - 1], length[i - 1, j - 1]
+            if total[i - 1, j] < best_total:
+                best_total, best_length = total[i - 1, j], length[i - 1, j]
+            if total[i, j - 1] < best_total:
+                best_total, best_length = total[i, j - 1], length[i, j - 1]
+            total[i, j] = best_total + cost[i - 1, j - 1]
+            length[i, j] = best_length + 1
+    return 1.0 - total[c, m] / length[c, m]
+
 
 # 4. MAIN COMPARISON FUNCTION
 # ---------------------------------------------------------
@@ -126,10 +483,18 @@ def compare_signatures_letters(img1, img2):
 
     return compare_letters(letters1, letters2)
 
+
+def resize_letters(letters):
+    """
+    Resizes letter crops to the 40x60 template size used by compare_letters,
+    so they can be stored once and compared without resizing again.
+    """
+    return [cv2.resize(l, (40, 60)) for l in letters]
+
 # 5. EXTRACT FEATURES (wrapper)
 # ---------------------------------------------------------
-def extract_features(image_path):
-    img = normalize_signature(image_path)
+def extract_features(image_path, fast=False):
+    img = normalize_signature_fast(image_path) if fast else normalize_signature(image_path)
 
     # Quality check: enough ink pixels
     non_white = cv2.countNonZero(255 - img)
@@ -137,18 +502,83 @@ def extract_features(image_path):
 
     return img, quality_good
 
+# SSIM with the same settings as skimage's structural_similarity on uint8
+# images (7x7 uniform window, sample covariance, K1 = 0.01, K2 = 0.03),
+# computed with OpenCV box filters on float32 and without the full SSIM map
+SSIM_WINDOW = 7
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+SSIM_COV_NORM = SSIM_WINDOW ** 2 / (SSIM_WINDOW ** 2 - 1)
+SSIM_STATS_CACHE_SIZE = 512
+ssim_stats_cache = LRUCache(SSIM_STATS_CACHE_SIZE)
+
+def _box(img):
+    # 7x7 local mean; works on stacked images too, since the rows where
+    # two stacked images mix are in the border that SSIM leaves out
+    return cv2.boxFilter(img, -1, (SSIM_WINDOW, SSIM_WINDOW), borderType=cv2.BORDER_REFLECT)
+
+def ssim_stats(images, size=(400, 120)):
+    """
+    The per-image half of SSIM for one image or a list / stack of images,
+    resized to size: pixels, local means and local variances, as float32
+    arrays of shape N x H x W. Depends only on the images, so gallery
+    statistics can be computed once and reused for every probe.
+    """
+    if isinstance(images, np.ndarray) and images.ndim == 2:
+        images = [images]
+    width, height = size
+    x = np.stack([cv2.resize(img, size) for img in images]).astype(np.float32)
+
+    flat = x.reshape(-1, width)
+    mean = _box(flat)
+    var = SSIM_COV_NORM * (_box(flat * flat) - mean * mean)
+    return x, mean.reshape(x.shape), var.reshape(x.shape)
+
+def _cached_ssim_stats(img, size):
+    # Statistics of one image, cached by content (gallery images come back
+    # for every probe)
+    img = np.ascontiguousarray(img)
+    key = (size, img.shape, content_hash(img.tobytes()))
+    stats = ssim_stats_cache.get(key)
+    if stats is None:
+        stats = ssim_stats(img, size)
+        ssim_stats_cache.put(key, stats)
+    return stats
+
+@profiling.timed("ssim")
+def batch_ssim_scores(query_img, gallery_stats, size=(400, 120), chunk_size=64):
+    """
+    Mean SSIM (x100) of one query against every image of gallery_stats
+    (from ssim_stats with the same size), in chunks of chunk_size images.
+    Matches skimage's structural_similarity to float32 precision.
+    """
+    qx, qmean, qvar = ssim_stats(query_img, size)
+    gx, gmean, gvar = gallery_stats
+    width, height = size
+    pad = (SSIM_WINDOW - 1) // 2
+    inner = (slice(None), slice(pad, height - pad), slice(pad, width - pad))
+
+    scores = np.empty(len(gx), dtype=np.float64)
+    for start in range(0, len(gx), chunk_size):
+        x = gx[start:start + chunk_size]
+        mean, var = gmean[start:start + chunk_size], gvar[start:start + chunk_size]
+
+        cross = _box((x * qx).reshape(-1, width)).reshape(x.shape)
+        covar = SSIM_COV_NORM * (cross - mean * qmean)
+
+        ssim_map = ((2 * mean * qmean + SSIM_C1) * (2 * covar + SSIM_C2)) / (
+            (mean * mean + qmean * qmean + SSIM_C1) * (var + qvar + SSIM_C2))
+        scores[start:start + len(x)] = ssim_map[inner].mean(axis=(1, 2), dtype=np.float64)
+
+    return scores * 100
+
 def compare_ssim(img1, img2):
-    img1 = cv2.resize(img1, (400, 120))
-    img2 = cv2.resize(img2, (400, 120))
-    score, _ = ssim(img1, img2, full=True)
-    return score * 100
+    return float(batch_ssim_scores(img1, _cached_ssim_stats(img2, (400, 120)), (400, 120))[0])
 
 def compare_ssim_full(img1, img2):
-    img1 = cv2.resize(img1, (600, 180))
-    img2 = cv2.resize(img2, (600, 180))
-    score, _ = ssim(img1, img2, full=True)
-    return score * 100
+    return float(batch_ssim_scores(img1, _cached_ssim_stats(img2, (600, 180)), (600, 180))[0])
 
+@profiling.timed("match_template")
 def compare_template_full(img1, img2):
     img1 = cv2.resize(img1, (600, 180))
     img2 = cv2.resize(img2, (600, 180))
@@ -156,6 +586,111 @@ def compare_template_full(img1, img2):
     res = cv2.matchTemplate(img1, img2, cv2.TM_CCOEFF_NORMED)
     return float(res.max() * 100)
 
+def prepare_signature(image_path, fast=False):
+    """
+    Runs all per-image preprocessing needed by the visual comparison once:
+    normalized canvas, quality flag, cursive flag, 40x60 letter crops,
+    ink statistics, global descriptor and ORB descriptors.
+    fast=True normalizes with normalize_signature_fast (large scans).
+    """
+    img, quality = extract_features(image_path, fast)
+    letters = resize_letters(segment_letters(img))
+    ink, aspect = ink_stats(img)
+
+    return {
+        "canvas": img,
+        "quality": quality,
+        "is_cursive": is_cursive(img),
+        "letters": letters,
+        "ink": ink,
+        "aspect": aspect,
+        "descriptor": global_descriptor(img, letters),
+        "orb_descriptors": orb_features(img)[1],
+    }
+
+def ink_stats(img):
+    """
+    Cheap shape evidence of a normalized canvas: number of ink pixels and
+    width / height ratio of the inked area.
+    """
+    mask = img < 128
+    ink = int(np.count_nonzero(mask))
+    if ink == 0:
+        return 0, 0.0
+
+    cols = np.flatnonzero(mask.any(axis=0))
+    rows = np.flatnonzero(mask.any(axis=1))
+    return ink, float(cols[-1] - cols[0] + 1) / float(rows[-1] - rows[0] + 1)
+
+def ink_mask(img):
+    """Binarized canvas: 1 for ink, 0 for paper (Otsu, like segment_letters)."""
+    _, th = cv2.threshold(img, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    return th
+
+def template_norms(gallery_stack, chunk_size=64):
+    """
+    L2 norm of every mean-centered gallery canvas (N x 180 x 600).
+    Depends only on the gallery, so it can be computed once and reused.
+    """
+    n = len(gallery_stack)
+    norms = np.empty(n, dtype=np.float64)
+
+    for start in range(0, n, chunk_size):
+        block = np.asarray(gallery_stack[start:start + chunk_size], dtype=np.float64)
+        flat = block.reshape(len(block), -1)
+        flat -= flat.mean(axis=1, keepdims=True)
+        norms[start:start + len(block)] = np.sqrt(np.einsum("ij,ij->i", flat, flat))
+
+    return norms
+
+@profiling.timed("match_template")
+def batch_template_scores(query_img, gallery_stack, gallery_norms=None, chunk_size=1024, rows=None):
+    """
+    Scores one query against a stacked N x 180 x 600 gallery in one pass.
+    Gives the same values as compare_template_full for every pair.
+
+    For same-size images TM_CCOEFF_NORMED is a single normalized correlation:
+        sum((q - mean(q)) * (g - mean(g))) / (|q - mean(q)| * |g - mean(g)|)
+    and since the centered query sums to zero, the numerator is just the
+    gallery rows times the centered query, i.e. a matrix-vector product.
+
+    gallery_stack can be any array-like of uint8 canvases, including a
+    memory-mapped .npy file (np.load(path, mmap_mode="r")); it is read in
+    chunks so memory stays bounded. With rows, only those canvases are
+    scored (in that order), still read chunk by chunk rather than copied out.
+    """
+    q = cv2.resize(query_img, (600, 180)).astype(np.float64).ravel()
+    q -= q.mean()
+    query_norm = np.sqrt(q @ q)
+    q = q.astype(np.float32)
+
+    if gallery_norms is None:
+        gallery_norms = template_norms(gallery_stack)
+    gallery_norms = np.asarray(gallery_norms, dtype=np.float64)
+    if rows is not None:
+        rows = np.asarray(rows, dtype=np.int64)
+        gallery_norms = gallery_norms[rows]
+
+    n = len(gallery_norms)
+    numerators = np.empty(n, dtype=np.float64)
+
+    for start in range(0, n, chunk_size):
+        block = np.asarray(gallery_stack[start:start + chunk_size] if rows is None
+                           else gallery_stack[rows[start:start + chunk_size]])
+        flat = block.reshape(len(block), -1).astype(np.float32)
+        numerators[start:start + len(block)] = flat @ q
+
+    denominators = query_norm * gallery_norms
+
+    scores = np.zeros(n, dtype=np.float64)
+    valid = denominators > 0
+    scores[valid] = np.clip(numerators[valid] / denominators[valid], -1.0, 1.0)
+
+    # Like OpenCV, a flat (constant) template matches perfectly
+    scores[gallery_norms == 0] = 1.0
+
+    return scores * 100
+
 def is_cursive(img):
     _, th = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
     contours, _ = cv2.findContours(th, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
@@ -163,12 +698,51 @@ def is_cursive(img):
     # Assinaturas cursivas tendem a ter 1–3 contornos grandes
     return len(contours) <= 3
 
+# OCR results keyed by image content, shared by the app and the library
+# so the same image is only sent to tesseract once
+OCR_CACHE_SIZE = 256
+ocr_cache = LRUCache(OCR_CACHE_SIZE)
+
 def extract_text_from_image(image_path):
-    img = cv2.imread(image_path)
-    if img is None:
-        return ""
+    return extract_texts_from_images([image_path])[0]
 
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+def extract_texts_from_images(image_paths):
+    """
+    OCR text of several images (paths, raw bytes or NumPy images).
+    Results are cached by the hash of the grayscale pixels; the rest are
+    sent to the OCR engine as one batch (see ocr_engines.py).
+    """
+    engine = get_ocr_engine()
+    texts = [""] * len(image_paths)
+    missing = [] # (position, cache key, binarized image)
+
+    for i, image in enumerate(image_paths):
+        try:
+            gray = to_grayscale(image)
+        except (FileNotFoundError, ValueError):
+            continue
+
+        key = (engine.name, gray.shape, content_hash(np.ascontiguousarray(gray).tobytes()))
+        text = ocr_cache.get(key)
+        if text is not None:
+            profiling.count("ocr_cache_hit")
+            texts[i] = text
+            continue
+        profiling.count("ocr_cache_miss")
+        missing.append((i, key, preprocess_for_ocr(gray)))
+
+    if missing:
+        with profiling.stage("ocr"):
+            recognized = engine.recognize_batch([th for _, _, th in missing])
+        for (i, key, _), text in zip(missing, recognized):
+            texts[i] = text.strip()
+            ocr_cache.put(key, texts[i])
+
+    return texts
+
+def preprocess_for_ocr(img):
+    """Binarized image handed to the OCR engine (any to_grayscale input)."""
+    gray = to_grayscale(img)
 
     # aumentar contraste
     gray = cv2.normalize(gray, None, 0, 255, cv2.NORM_MINMAX)
@@ -183,16 +757,16 @@ def extract_text_from_image(image_path):
     kernel = np.ones((2, 2), np.uint8)
     th = cv2.dilate(th, kernel, iterations=1)
 
-    # OCR com modo de linha única
-    text = pytesseract.image_to_string(th, config="--psm 7 -l eng")
+    return th
 
-    return text.strip()
 
-
-def compare_by_ocr(query_signature_path, name_map):
+def compare_by_ocr(query_signature_path, name_map, name_index=None):
     """
     If the signature is typed text (like 'Mark Stevens'),
     OCR will detect the name and match directly.
+
+    Names are looked up through a NameIndex (see name_index.py), built here
+    from name_map unless a prebuilt one is given.
     """
 
     text = extract_text_from_image(query_signature_path)
@@ -202,86 +776,916 @@ def compare_by_ocr(query_signature_path, name_map):
     text_clean = text.lower().replace("\n", " ").strip()
 
     # Procurar nome correspondente na base de dados
-    best_match = None
-    best_score = 0
-
-    for filename, person_name in name_map.items():
-        score = difflib.SequenceMatcher(None, person_name.lower(), text_clean).ratio()
-        if score > best_score:
-            best_score = score
-            best_match = person_name
+    if name_index is None:
+        name_index = NameIndex(name_map)
+    best_match, best_score = name_index.best_match(text_clean)
 
-    # Se a similaridade for aceitável (>= 0.4), devolve o nome
-    if best_score >= 0.6: 
+    # Se a similaridade for aceitável (>= 0.6), devolve o nome
+    if best_score >= OCR_MATCH_THRESHOLD:
         return best_match, best_score * 100
 
     return None
 
 
-# 6. COMPARE ALL SIGNATURES IN DB
-def compare_all_signatures(query_signature_path, database_path="../generated_signatures"):
+# 6. GALLERY SCAN
+# ---------------------------------------------------------
+def score_gallery_file(query_img, query_is_cursive, file_path):
+    """
+    Visual similarity between the query and one gallery image on disk.
+    """
+    db_img, db_quality = extract_features(file_path)
+
+    db_is_cursive = is_cursive(db_img)
+
+    # --- Cursive signatures: global comparison ---
+    if query_is_cursive or db_is_cursive:
+        profiling.count("cursive_path")
+        return compare_template_full(query_img, db_img)
+
+    # --- Non-cursive: letter-based + SSIM ---
+    profiling.count("letter_path")
+    return compare_signatures_letters(query_img, db_img)
+
+def _init_scan_worker():
+    # The pool already keeps every core busy, so OpenCV must not start
+    # its own threads inside each worker
+    cv2.setNumThreads(1)
+
+def _score_gallery_chunk(query_img, query_is_cursive, database_path, filenames):
+    return [
+        (filename, score_gallery_file(query_img, query_is_cursive, os.path.join(database_path, filename)))
+        for filename in filenames
+    ]
+
+_scan_pools = {} # workers -> ProcessPoolExecutor, reused across queries
+
+def get_scan_pool(workers):
+    """
+    Returns a process pool with the given number of workers, created once.
+    Workers are spawned: forking a process whose OpenCV threads may hold
+    locks can leave the children blocked.
+    """
+    pool = _scan_pools.get(workers)
+    if pool is None:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_scan_worker,
+                                   mp_context=multiprocessing.get_context("spawn"))
+        _scan_pools[workers] = pool
+    return pool
+
+def _discard_scan_pool(workers):
+    # A broken pool is dropped, so the next scan starts a fresh one
+    pool = _scan_pools.pop(workers, None)
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+@atexit.register
+def shutdown_scan_pools():
+    """Shuts down the cached scan pools (also called at interpreter exit)."""
+    while _scan_pools:
+        _, pool = _scan_pools.popitem()
+        pool.shutdown(wait=True, cancel_futures=True)
+
+def scan_gallery(query_img, query_is_cursive, database_path, workers=1, chunk_size=16):
+    """
+    Scores the query against every image in database_path.
+    Returns (filename, similarity) pairs in directory listing order.
+
+    With workers > 1 the files are split in chunks of chunk_size and scored
+    in a process pool. Chunks are merged back in listing order, so the
+    result (and the ranking built from it) is the same as the serial scan.
+    If a pool worker dies, the scan is retried once on a new pool, then
+    run serially.
+    """
+    filenames = [
+        f for f in os.listdir(database_path)
+        if f.lower().endswith((".png", ".jpg", ".jpeg"))
+    ]
+    profiling.count("images_scanned", len(filenames))
+
+    if workers <= 1:
+        return _score_gallery_chunk(query_img, query_is_cursive, database_path, filenames)
+
+    chunks = [filenames[i:i + chunk_size] for i in range(0, len(filenames), chunk_size)]
+    for _ in range(2):
+        try:
+            pool = get_scan_pool(workers)
+            futures = [
+                pool.submit(_score_gallery_chunk, query_img, query_is_cursive, database_path, chunk)
+                for chunk in chunks
+            ]
+
+            results = []
+            for future in futures:
+                results.extend(future.result())
+            return results
+        except BrokenProcessPool:
+            profiling.count("scan_pool_broken")
+            _discard_scan_pool(workers)
+
+    return _score_gallery_chunk(query_img, query_is_cursive, database_path, filenames)
+
+def score_gallery_index(query_img, query_is_cursive, gallery, rows=None):
+    """
+    Scores the query against the entries of a prebuilt gallery index
+    (all of them, or only the given row numbers, kept in index order).
+    Returns (filename, similarity) pairs.
+    """
+    if rows is None:
+        rows = range(len(gallery.entries))
+    entries = [gallery.entries[i] for i in rows]
+    query_letters = None
+
+    # --- Cursive signatures: global comparison, all pairs in one batch ---
+    template_rows = [
+        i for i in rows
+        if query_is_cursive or gallery.entries[i]["is_cursive"]
+    ]
+    template_scores = {}
+    if template_rows:
+        template_scores = dict(zip(template_rows, batch_template_scores(
+            query_img, gallery.canvas_stack(), gallery.canvas_norms(), rows=template_rows)))
+
+    results = []
+    for i, entry in zip(rows, entries):
+        if i in template_scores:
+            similarity = float(template_scores[i])
+
+        # --- Non-cursive: letter-based, gallery letters are already cut ---
+        else:
+            if query_letters is None:
+                query_letters = resize_letters(segment_letters(query_img))
+            similarity = compare_letters(query_letters, entry["letters"])
+
+        results.append((entry["filename"], similarity))
+
+    return results
+
+
+class TopK:
+    """
+    Streaming top-k selection on a min-heap of the k best items seen so far.
+    Items are pushed with their position in the scan; on equal scores the
+    earlier one wins, so the result is the same as a stable sort + [:k].
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.heap = [] # (score, -order, item), worst kept item on top
+
+    def __len__(self):
+        return len(self.heap)
+
+    def can_enter(self, score, order=-1):
+        """True if an item with this score (or score bound) could still enter."""
+        if len(self.heap) < self.k:
+            return True
+        worst_score, worst_order, _ = self.heap[0]
+        return score > worst_score or (score == worst_score and -order > worst_order)
+
+    def push(self, score, order, item):
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, (score, -order, item))
+        elif self.can_enter(score, order):
+            heapq.heapreplace(self.heap, (score, -order, item))
+
+    def push_many(self, scores, orders, rows):
+        """
+        Pushes a batch of scores as (row, score) items; only the batch's k
+        best can enter, so only those are pushed.
+        """
+        scores = np.asarray(scores, dtype=np.float64)
+        orders = np.asarray(orders)
+        for j in np.lexsort((orders, -scores))[:self.k].tolist():
+            self.push(float(scores[j]), int(orders[j]), (int(rows[j]), float(scores[j])))
+
+    def items(self):
+        """Kept items, best first."""
+        return [item for _, _, item in sorted(self.heap, key=lambda x: (-x[0], -x[1]))]
+
+def select_top_k(results, k=3):
+    """Best k (filename, similarity) pairs, like sorting the list and slicing [:k]."""
+    top = TopK(k)
+    for order, (filename, similarity) in enumerate(results):
+        top.push(similarity, order, (filename, similarity))
+    return top.items()
+
+# Cheap rejection tests for top_k_gallery_index: a candidate is dropped when
+# it differs from the query by more than these factors / letters
+REJECTION_BOUNDS = {
+    "max_ink_ratio": 3.0, # ink pixel counts
+    "max_aspect_ratio": 2.0, # width / height of the inked area
+    "max_letter_diff": 6, # letters found by segment_letters (non-cursive pairs)
+}
+
+REJECTION_STAGES = ("rejected_ink", "rejected_aspect", "rejected_letters")
+
+def _ratios(value, values):
+    # How many times larger the larger of value and each element of values
+    # is (inf where the smaller is 0)
+    low, high = np.minimum(value, values), np.maximum(value, values)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(low > 0, high / np.where(low > 0, low, 1), np.inf)
+
+def _rejection_stages(query, columns, rows, pair_is_cursive, bounds):
+    # Per candidate, 1 + the index in REJECTION_STAGES of the first cascade
+    # stage that rules it out, or 0 (computed from the gallery's entry columns)
+    failed = [
+        _ratios(query["ink"], columns["ink"][rows]) > bounds.get("max_ink_ratio", float("inf")),
+        _ratios(query["aspect"], columns["aspect"][rows]) > bounds.get("max_aspect_ratio", float("inf")),
+        ~pair_is_cursive & (np.abs(len(query["letters"]) - columns["letter_count"][rows])
+                            > bounds.get("max_letter_diff", float("inf"))),
+    ]
+    stages = np.zeros(len(rows), dtype=np.int8)
+    for code, stage_failed in reversed(list(enumerate(failed, start=1))):
+        stages[stage_failed] = code # earlier stages overwrite later ones
+    return stages
+
+def top_k_gallery_index(query_img, query_is_cursive, gallery, rows=None, k=3, bounds=None, counters=None,
+                        binary_metric=None, letter_mode="pairwise"):
+    """
+    Best k (filename, similarity) pairs of the query against a gallery index,
+    the same as sorting score_gallery_index's output and keeping k, with less
+    work:
+    - with bounds (e.g. REJECTION_BOUNDS), candidates whose ink area, aspect
+      ratio or letter count are too far from the query's are rejected before
+      any comparison (only scored if fewer than k candidates remain)
+    - letter comparisons stop as soon as the candidate can no longer enter
+      the current top k (exact, does not change the result)
+
+    binary_metric ("iou", "dice" or "chamfer") scores the cursive pairs on
+    the gallery's bit-packed ink masks (see batch_binary_scores) instead of
+    the grayscale template correlation.
+
+    letter_mode selects how the non-cursive pairs are scored: "pairwise"
+    (compare_letters with early exit), "batch" (the same scores for all
+    candidates at once, from the gallery's LetterMatrix) or "dtw" (letters
+    aligned by dynamic time warping, see LetterMatrix.dtw_scores).
+
+    counters, if given, is a dict receiving how many candidates each stage
+    pruned ("rejected_ink", "rejected_aspect", "rejected_letters",
+    "early_exit") next to "candidates" and "scored".
+    """
+    if letter_mode not in LETTER_MODES:
+        raise ValueError(f"Unknown letter mode: {letter_mode}")
+    rows = np.arange(len(gallery)) if rows is None else np.asarray(list(rows), dtype=np.int64)
+    if counters is None:
+        counters = {}
+    for stage in ("candidates", "rejected_ink", "rejected_aspect", "rejected_letters", "early_exit", "scored"):
+        counters.setdefault(stage, 0)
+    counters["candidates"] += len(rows)
+
+    query = None
+    if bounds or not query_is_cursive:
+        query = {"letters": resize_letters(segment_letters(query_img))}
+        query["ink"], query["aspect"] = ink_stats(query_img)
+
+    # Candidates are handled as arrays of gallery columns (see entry_columns);
+    # entry dicts are only read for the pairwise letter matching
+    columns = gallery.entry_columns()
+    orders = np.arange(len(rows))
+    pair_is_cursive = columns["is_cursive"][rows] | bool(query_is_cursive)
+
+    # 1. Cheap rejection cascade
+    stages = np.zeros(len(rows), dtype=np.int8)
+    if bounds:
+        stages = _rejection_stages(query, columns, rows, pair_is_cursive, bounds)
+        for code, stage in enumerate(REJECTION_STAGES, start=1):
+            counters[stage] += int(np.count_nonzero(stages == code))
+    kept = stages == 0
+
+    top = TopK(k)
+
+    def score_candidates(selected):
+        candidate_orders, candidate_rows = orders[selected], rows[selected]
+        cursive = pair_is_cursive[selected]
+
+        # Cursive pairs: one batched template pass
+        if cursive.any():
+            template_rows = candidate_rows[cursive]
+            if binary_metric:
+                distance_maps = gallery.chamfer_distance_maps() if binary_metric == "chamfer" else None
+                template_scores = batch_binary_scores(query_img, gallery.packed_masks(), binary_metric,
+                                                      rows=template_rows, distance_maps=distance_maps)
+            else:
+                template_scores = batch_template_scores(query_img, gallery.canvas_stack(), gallery.canvas_norms(),
+                                                        rows=template_rows)
+            top.push_many(template_scores, candidate_orders[cursive], template_rows)
+            counters["scored"] += len(template_rows)
+            profiling.count("cursive_path", len(template_rows))
+
+        letter_orders, letter_rows = candidate_orders[~cursive], candidate_rows[~cursive]
+
+        # Non-cursive pairs, batched: one pass over the gallery's letter matrix
+        if letter_mode != "pairwise":
+            if len(letter_rows):
+                matrix = gallery.letter_matrix()
+                if letter_mode == "dtw":
+                    letter_scores = matrix.dtw_scores(query["letters"], letter_rows)
+                else:
+                    letter_scores = matrix.scores(query["letters"], letter_rows)
+                top.push_many(letter_scores, letter_orders, letter_rows)
+                counters["scored"] += len(letter_rows)
+                profiling.count("letter_path", len(letter_rows))
+            return
+
+        # Non-cursive pairs: letter matching with early exit
+        for order, i in zip(letter_orders.tolist(), letter_rows.tolist()):
+            profiling.count("letter_path")
+            similarity = compare_letters_bounded(
+                query["letters"], gallery.entry_letters(i), lambda bound: top.can_enter(bound, order))
+            if similarity is None:
+                counters["early_exit"] += 1
+                continue
+            top.push(similarity, order, (i, similarity))
+            counters["scored"] += 1
+
+    score_candidates(kept)
+    if len(top) < k and not kept.all():
+        score_candidates(~kept)
+
+    profiling.count("images_scanned", len(rows))
+    for stage in ("rejected_ink", "rejected_aspect", "rejected_letters", "early_exit"):
+        profiling.count(f"pruned_{stage}", counters[stage])
+
+    # Filenames only for the k results
+    return [(gallery.filename(i), similarity) for i, similarity in top.items()]
+
+
+# 7. COARSE SHORTLIST
+# ---------------------------------------------------------
+DEFAULT_SHORTLIST_K = 20 # Candidates re-ranked when an ANN index is used
+
+def _unit(vector):
+    # Centered, unit-length copy of a vector (left as is if it is flat)
+    vector = vector - vector.mean()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+def global_descriptor(img, letters=None):
+    """
+    Compact global descriptor of a normalized canvas, cheap to compare.
+
+    - layout part: 10x30 ink-density grid plus horizontal (60 bins) and
+      vertical (18 bins) ink projection profiles, for the cursive path
+    - letter part: the first 12 letters (from segment_letters, or the given
+      40x60 crops) as 10x15 thumbnails, for the letter-based path
+
+    Parts are centered and scaled to unit length and the layout part is
+    down-weighted, so a dot product between two descriptors approximates
+    the ranking of the precise comparators.
+    """
+    ink = (255 - cv2.resize(img, (600, 180))).astype(np.float32) / 255
+
+    grid = cv2.resize(ink, (30, 10), interpolation=cv2.INTER_AREA).ravel()
+    columns = cv2.resize(ink.sum(axis=0, keepdims=True), (60, 1), interpolation=cv2.INTER_AREA).ravel()
+    rows = cv2.resize(ink.sum(axis=1, keepdims=True), (1, 18), interpolation=cv2.INTER_AREA).ravel()
+    layout = _unit(np.concatenate([_unit(grid), _unit(columns), _unit(rows)]))
+
+    if letters is None:
+        letters = resize_letters(segment_letters(img))
+    thumbs = np.zeros((12, 150), dtype=np.float32)
+    for i, letter in enumerate(letters[:12]):
+        thumb = cv2.resize(letter, (10, 15), interpolation=cv2.INTER_AREA).astype(np.float32).ravel()
+        thumbs[i] = _unit(thumb)
+
+    return np.concatenate([0.3 * layout, thumbs.ravel() / np.sqrt(12)]).astype(np.float32)
+
+def shortlist_candidates(query_descriptor, gallery_descriptors, k):
+    """
+    Row numbers of the k gallery descriptors closest to the query
+    (highest dot product), returned in gallery order so the
+    re-ranking keeps the same tie order as a full scan.
+    """
+    n = len(gallery_descriptors)
+    if k >= n:
+        return list(range(n))
+
+    similarities = gallery_descriptors @ query_descriptor
+    top = np.argpartition(-similarities, k - 1)[:k]
+    return sorted(top.tolist())
+
+
+# 8. ORB FEATURES
+# ---------------------------------------------------------
+_orb_detectors = {} # nfeatures -> cv2.ORB, created once
+
+def orb_features(img, n_features=500):
+    """
+    ORB keypoints and 32-byte (256-bit) descriptors of a normalized canvas.
+    Descriptors are an N x 32 uint8 array (empty if nothing was detected).
+    """
+    orb = _orb_detectors.get(n_features)
+    if orb is None:
+        orb = cv2.ORB_create(nfeatures=n_features)
+        _orb_detectors[n_features] = orb
+
+    keypoints, descriptors = orb.detectAndCompute(img, None)
+    if descriptors is None:
+        descriptors = np.empty((0, 32), dtype=np.uint8)
+
+    return keypoints, descriptors
+
+def extract_orb_features(image_path):
+    """
+    Loads and normalizes a signature and returns (keypoints, descriptors, quality).
+    Signatures with fewer than 20 descriptors are marked as low quality.
+    """
+    img = normalize_signature(image_path)
+    keypoints, descriptors = orb_features(img)
+
+    return keypoints, descriptors, len(descriptors) >= 20
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def hamming_distances(des1, des2, chunk_size=256):
+    """
+    All pairwise Hamming distances between two sets of binary descriptors
+    (n x 32 and m x 32 uint8), as an n x m array: XOR of the packed bits
+    followed by a popcount, without unpacking to individual bits.
+    """
+    des1 = np.ascontiguousarray(des1, dtype=np.uint8)
+    des2 = np.ascontiguousarray(des2, dtype=np.uint8)
+    distances = np.empty((len(des1), len(des2)), dtype=np.uint16)
+
+    if hasattr(np, "bitwise_count") and des1.shape[1] % 8 == 0:
+        # NumPy >= 2.0: popcount on 64-bit words
+        words1, words2 = des1.view(np.uint64), des2.view(np.uint64)
+        for start in range(0, len(des1), chunk_size):
+            xor = words1[start:start + chunk_size, None, :] ^ words2[None, :, :]
+            distances[start:start + chunk_size] = np.bitwise_count(xor).sum(axis=2, dtype=np.uint16)
+    else:
+        for start in range(0, len(des1), chunk_size):
+            xor = des1[start:start + chunk_size, None, :] ^ des2[None, :, :]
+            distances[start:start + chunk_size] = _POPCOUNT[xor].sum(axis=2, dtype=np.uint16)
+
+    return distances
+
+def match_descriptors(des1, des2, max_distance=64, ratio=0.8):
+    """
+    Good matches from des1 to des2: the nearest neighbour must be within
+    max_distance bits and clearly better than the second one (ratio test).
+    Returns (index in des1, index in des2, distance) arrays.
+    """
+    empty = np.empty(0, dtype=np.int64)
+    if len(des1) == 0 or len(des2) == 0:
+        return empty, empty, empty
+
+    distances = hamming_distances(des1, des2)
+    rows = np.arange(len(des1))
+    best = np.argmin(distances, axis=1)
+    best_distance = distances[rows, best].astype(np.int64)
+
+    if len(des2) > 1:
+        second_distance = np.partition(distances, 1, axis=1)[:, 1].astype(np.int64)
+        good = (best_distance <= max_distance) & (best_distance < ratio * second_distance)
+    else:
+        good = best_distance <= max_distance
+
+    return rows[good], best[good], best_distance[good]
+
+def compare_orb(des1, des2):
+    """
+    ORB similarity 0–100: share of des1's descriptors with a good match in des2.
+    """
+    if len(des1) == 0:
+        return 0
+
+    good, _, _ = match_descriptors(des1, des2)
+    return round(len(good) / len(des1) * 100, 2)
+
+
+# 9. COMPARE ALL SIGNATURES IN DB
+# ---------------------------------------------------------
+# Query results of resubmitted images (re-scans, retries, Streamlit
+# reruns), keyed by the exact input content and, for near-duplicates, by
+# a perceptual hash of the normalized canvas
+RESULT_CACHE_SIZE = 256
+RESULT_CACHE_TTL = 600 # seconds
+RESULT_CACHE_MAX_DISTANCE = 8 # differing pHash bits still treated as the same image (of 127)
+PHASH_SIZE = (64, 32) # thumbnail transformed by the DCT
+PHASH_BLOCK = (16, 8) # low-frequency coefficients kept (width, height)
+result_cache = NearDuplicateCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL, RESULT_CACHE_MAX_DISTANCE)
+DIRECTORY_REFRESH_INTERVAL = 5 # seconds a directory gallery of cached queries is trusted before checking its files
+_directory_galleries = {} # absolute path -> [GalleryIndex, lock, last refresh time]
+_directory_lock = threading.Lock()
+
+def perceptual_hash(img):
+    """
+    pHash of a normalized canvas, as an int: signs of the low-frequency
+    DCT coefficients (DC excluded) relative to their median. Re-scans and
+    re-encodings of an image differ by a few bits, distinct signatures by
+    dozens.
+    """
+    small = cv2.resize(img, PHASH_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32)
+    coefficients = cv2.dct(small)[:PHASH_BLOCK[1], :PHASH_BLOCK[0]].ravel()[1:]
+    bits = coefficients > np.median(coefficients)
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def _input_hash(image):
+    # Exact content key: bytes of the encoded upload or file, or array pixels
+    if isinstance(image, np.ndarray):
+        return content_hash(str(image.shape).encode() + np.ascontiguousarray(image).tobytes())
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return content_hash(bytes(image))
+    with open(image, "rb") as f:
+        return content_hash(f.read())
+
+def _identity(obj):
+    # A weak reference, so a new object reusing a freed one's id is not mistaken for it
+    if obj is None:
+        return None
+    try:
+        return weakref.ref(obj)
+    except TypeError:
+        return id(obj)
+
+def _file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def _directory_gallery(database_path):
+    # In-memory gallery index of a directory, for cached queries given no
+    # gallery: built on first use, refreshed at most every
+    # DIRECTORY_REFRESH_INTERVAL seconds; its generation stamps the results.
+    # Searches hold the returned lock, refreshes change the index in place
+    from gallery_index import GalleryIndex # Local: gallery_index imports this module
+
+    path = os.path.abspath(database_path)
+    with _directory_lock:
+        item = _directory_galleries.setdefault(path, [GalleryIndex(path), threading.Lock(), None])
+    gallery, lock, refreshed_at = item
+    with lock:
+        if refreshed_at is None or time.monotonic() - refreshed_at >= DIRECTORY_REFRESH_INTERVAL:
+            gallery.refresh()
+            item[2] = time.monotonic()
+    return gallery, lock
+
+def _result_stamp(gallery, db_gallery, orb_index, names_path):
+    # Changes whenever the searched gallery or the name mapping changes
+    # (sharded galleries have no stamp, their entries only expire)
+    if gallery is not None:
+        gallery_stamp = (len(gallery), getattr(gallery, "generation", None))
+    elif db_gallery is not None:
+        gallery_stamp = (len(db_gallery), db_gallery.watermark)
+    elif orb_index is not None:
+        gallery_stamp = len(orb_index)
+    else:
+        gallery_stamp = None
+    return gallery_stamp, _file_stamp(names_path), _file_stamp(names_path + NAME_LOG_SUFFIX)
+
+def compare_all_signatures(query_signature_path, database_path="../generated_signatures", gallery=None,
+                           workers=1, chunk_size=16, shortlist_k=None, ann_index=None, orb_index=None,
+                           db_gallery=None, rejection_bounds=None, trace=False, use_ocr=True,
+                           names_path=NAME_MAP_FILE, binary_metric=None, letter_mode="pairwise", shards=None,
+                           use_cache=False):
     """
     Hybrid signature comparison:
     - First try OCR (for typed signatures)
     - If OCR fails, fallback to visual matching
-    """
 
-    # Load name mapping
-    mapping_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "signature_names.json"))
-    with open(mapping_path, "r", encoding="utf-8") as f:
-        name_map = json.load(f)
-
-    # 1. Tentar OCR primeiro
-    ocr_match = compare_by_ocr(query_signature_path, name_map)
+    The query can be a file path, the raw bytes of an encoded image or a
+    NumPy image; it is decoded to grayscale once and shared by the OCR and
+    visual steps.
+
+    If a prebuilt gallery index is given (see gallery_index.py), the visual
+    matching uses its stored canvases and letter crops, so only the query
+    image is processed. Otherwise the directory is scanned, in parallel
+    when workers > 1 (see scan_gallery).
+
+    With a gallery index, shortlist_k enables a coarse-to-fine search: only
+    the shortlist_k entries closest by global_descriptor get the precise
+    comparison (see shortlist_report.py for the accuracy trade-off).
+    An ann_index (see ann_index.py) replaces the exact shortlist scan with
+    an approximate search(probe, k), for very large galleries; it then
+    shortlists DEFAULT_SHORTLIST_K entries unless shortlist_k is given.
+
+    An orb_index (see orb_index.py) switches the visual matching to ORB
+    descriptors: LSH votes pick the candidates, which are then ranked with
+    the Hamming matcher. A db_gallery (see db_gallery.py) does the same with
+    the descriptors and names stored in PostgreSQL, without reading any
+    gallery image.
+
+    With a gallery index the top 3 is selected while scoring (see
+    top_k_gallery_index) and the result also carries its per-stage
+    "pruning" counters; rejection_bounds (e.g. REJECTION_BOUNDS) turns on
+    the cheap ink / aspect / letter-count rejection tests.
+
+    With trace=True the result carries a "trace": time per pipeline stage
+    and counts of the events of this query (see profiling.py).
+
+    use_ocr=False skips the OCR step (visual matching only), and names_path
+    selects another filename -> name mapping (e.g. a benchmark gallery).
+    binary_metric compares cursive signatures on bit-packed ink masks
+    (gallery index only, see batch_binary_scores), and letter_mode
+    ("pairwise", "batch" or "dtw") how non-cursive ones are compared
+    (gallery index only, see top_k_gallery_index).
+
+    shards (a ShardCoordinator, see sharded_search.py) searches a gallery
+    split across shard workers: the query is normalized here once and
+    every shard returns its local top 3. The result carries the per-shard
+    report, and "partial": True when a shard failed or timed out.
+
+    use_cache=True answers resubmitted images from result_cache: same
+    input bytes / pixels, or a normalized canvas within
+    RESULT_CACHE_MAX_DISTANCE pHash bits of a cached visual match, with
+    the same options; OCR only runs when neither is cached, and its
+    answers are only reused for the exact same input. Entries expire after
+    RESULT_CACHE_TTL seconds and are dropped when the gallery or the name
+    mapping changes (sharded galleries only expire); result_cache.stats()
+    gives the hit ratios. Given no gallery (nor db_gallery, orb_index or
+    shards), cached queries search an in-memory gallery index of
+    database_path instead of scanning it (see _directory_gallery).
+    """
+    options = dict(
+        database_path=database_path, gallery=gallery, workers=workers, chunk_size=chunk_size,
+        shortlist_k=shortlist_k, ann_index=ann_index, orb_index=orb_index, db_gallery=db_gallery,
+        rejection_bounds=rejection_bounds, use_ocr=use_ocr, names_path=names_path,
+        binary_metric=binary_metric, letter_mode=letter_mode, shards=shards,
+    )
+    with profiling.tracing(trace) as query_trace:
+        with profiling.stage("query"):
+            if use_cache:
+                result = _cached_compare_all_signatures(query_signature_path, options)
+            else:
+                result = _compare_all_signatures(query_signature_path, **options)
+
+    if query_trace is not None:
+        result["trace"] = query_trace.as_dict()
+    return result
+
+def _cached_compare_all_signatures(query, options):
+    lock = nullcontext()
+    if all(options[name] is None for name in ("gallery", "db_gallery", "orb_index", "shards")):
+        options["gallery"], lock = _directory_gallery(options["database_path"])
+
+    # Every option changing the result is part of the group
+    group = (
+        _identity(options["gallery"]), os.path.abspath(options["database_path"]), options["shortlist_k"],
+        _identity(options["ann_index"]), _identity(options["orb_index"]), _identity(options["db_gallery"]),
+        _identity(options["shards"]),
+        tuple(sorted(options["rejection_bounds"].items())) if options["rejection_bounds"] else None,
+        options["use_ocr"], options["names_path"], options["binary_metric"], options["letter_mode"],
+    )
+    stamp = _result_stamp(options["gallery"], options["db_gallery"], options["orb_index"], options["names_path"])
+    result_cache.validate(group, stamp)
+
+    # Decoded and normalized only when the exact key misses, and reused by
+    # the search. Only visual matches are stored with a pHash (typed names
+    # one letter apart are near duplicates), so a near hit needs no OCR
+    computed = {}
+    def fingerprint():
+        computed["gray"] = to_grayscale(query)
+        computed["features"] = extract_features(computed["gray"])
+        computed["phash"] = perceptual_hash(computed["features"][0])
+        return computed["phash"]
+
+    key = (group, _input_hash(query))
+    cached = result_cache.lookup(key, fingerprint)
+    if cached is not None:
+        profiling.count("result_cache_near_hit" if computed else "result_cache_hit")
+        return dict(cached)
+    profiling.count("result_cache_miss")
+
+    if options["use_ocr"]:
+        answer = _ocr_answer(computed["gray"], *load_names(options["names_path"]))
+        if answer:
+            profiling.count("queries")
+            result_cache.put(key, dict(answer), stamp=stamp)
+            return answer
+
+    with lock:
+        result = _compare_all_signatures(computed["gray"], **dict(options, use_ocr=False), # OCR already ran above
+                                         features=computed["features"])
+    if not result.get("partial"):
+        result_cache.put(key, dict(result), computed["phash"], stamp)
+    return result
+
+def _ocr_answer(query_gray, name_map, name_index):
+    # Result of the OCR path, or None when the visual method must be used
+    ocr_match = compare_by_ocr(query_gray, name_map, name_index)
     if ocr_match:
+        profiling.count("ocr_match")
         name, score = ocr_match
         return {"top_3_matches": [(name, score)]}
-    
+
     # Se o OCR devolveu texto mas não encontrou nome, não usar método visual
-    if text := extract_text_from_image(query_signature_path):
-        if any(c.isalpha() for c in text):
-            # É texto, mas não corresponde a ninguém
-            return {"top_3_matches": [("Texto detectado mas não corresponde a nenhum nome", 0)]}
+    if (text := extract_text_from_image(query_gray)) and any(c.isalpha() for c in text):
+        # É texto, mas não corresponde a ninguém
+        profiling.count("ocr_text_unmatched")
+        return {"top_3_matches": [("Texto detectado mas não corresponde a nenhum nome", 0)]}
+    return None
 
+def _compare_all_signatures(query_signature_path, database_path, gallery, workers, chunk_size,
+                            shortlist_k, ann_index, orb_index, db_gallery, rejection_bounds, use_ocr, names_path,
+                            binary_metric, letter_mode, shards, features=None):
+
+    # Load name mapping (read and indexed once, reloaded when the file changes)
+    name_map, name_index = load_names(names_path)
+    profiling.count("queries")
+
+    # 1. Tentar OCR primeiro
+    query_gray = to_grayscale(query_signature_path)
+
+    if use_ocr and (answer := _ocr_answer(query_gray, name_map, name_index)):
+        return answer
 
     # 2. Se OCR falhar, usar o método visual (o teu pipeline atual)
-    query_img, quality = extract_features(query_signature_path)
+    query_img, quality = features or extract_features(query_gray)
     if not quality:
+        profiling.count("low_quality")
         return {"status": "error", "message": "Signature quality too low."}
 
     query_is_cursive = is_cursive(query_img)
 
     results = []
 
-    for filename in os.listdir(database_path):
-        if not filename.lower().endswith((".png", ".jpg", ".jpeg")):
-            continue
+    if db_gallery is not None:
+        with profiling.stage("db_search"):
+            return {"top_3_matches": db_gallery.search(query_img, k=3, n_candidates=shortlist_k or DEFAULT_SHORTLIST_K)}
+
+    if shards is not None:
+        with profiling.stage("shard_search"):
+            top_3, report = shards.search(query_img, query_is_cursive, 3, shortlist_k, rejection_bounds,
+                                          binary_metric, letter_mode)
+        result = {"top_3_matches": [(name_map.get(f, "Unknown"), score) for f, score in top_3], "shards": report}
+        if report["missing"]:
+            result["partial"] = True
+        return result
+
+    if orb_index is not None:
+        with profiling.stage("orb_search"):
+            results = orb_index.search(query_img, k=3, n_candidates=shortlist_k or DEFAULT_SHORTLIST_K)
+
+    elif gallery is not None:
+        rows = None
+        with profiling.stage("shortlist"):
+            if ann_index is not None:
+                hits = ann_index.search(global_descriptor(query_img), shortlist_k or DEFAULT_SHORTLIST_K)
+                rows = gallery.rows_of([key for key, _ in hits])
+            elif shortlist_k:
+                rows = shortlist_candidates(global_descriptor(query_img), gallery.descriptor_matrix(), shortlist_k)
+
+        pruning = {}
+        top_3 = top_k_gallery_index(query_img, query_is_cursive, gallery, rows, 3, rejection_bounds, pruning,
+                                    binary_metric, letter_mode)
+        top_3_named = [(name_map.get(f, "Unknown"), score) for f, score in top_3]
+        return {"top_3_matches": top_3_named, "pruning": pruning}
+
+    else:
+        results = scan_gallery(query_img, query_is_cursive, database_path, workers, chunk_size)
+
+    # Best 3 by similarity
+    top_3 = select_top_k(results, 3)
 
-        file_path = os.path.join(database_path, filename)
-        db_img, db_quality = extract_features(file_path)
+    top_3_named = [(name_map.get(f, "Unknown"), score) for f, score in top_3]
 
-        db_is_cursive = is_cursive(db_img)
+    return {"top_3_matches": top_3_named}
 
-        # --- Cursive signatures: global comparison ---
-        if query_is_cursive or db_is_cursive:
-            similarity = compare_template_full(query_img, db_img)
 
-        # --- Non-cursive: letter-based + SSIM ---
-        else:
-            similarity = compare_signatures_letters(query_img, db_img)
 
-        results.append((filename, similarity))
+# 10. VERIFY AGAINST ONE PERSON (1:1)
+# ---------------------------------------------------------
+VERIFY_THRESHOLD = 60.0 # Minimum similarity (%) to accept a 1:1 verification
 
-    # Sort by similarity
-    results.sort(key=lambda x: x[1], reverse=True)
-    top_3 = results[:3]
+def verify_signature(query_signature, person_name, gallery, threshold=VERIFY_THRESHOLD):
+    """
+    1:1 verification: compares the query only with the gallery signatures
+    enrolled under person_name (case-insensitive) and accepts it if the
+    best visual similarity reaches the threshold.
+    """
+    name_map, _ = load_names()
+    wanted = person_name.strip().lower()
+    rows = [
+        i for i in range(len(gallery))
+        if name_map.get(gallery.filename(i), "").lower() == wanted
+    ]
+    if not rows:
+        return {"status": "error", "message": f"No enrolled signature for '{person_name}'."}
+
+    query_img, quality = extract_features(query_signature)
+    if not quality:
+        return {"status": "error", "message": "Signature quality too low."}
 
-    # Load name mapping
-    mapping_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "signature_names.json"))
-    with open(mapping_path, "r", encoding="utf-8") as f:
-        name_map = json.load(f)
+    results = score_gallery_index(query_img, is_cursive(query_img), gallery, rows)
+    best_file, best_score = max(results, key=lambda x: x[1])
 
-    top_3_named = [(name_map.get(f, "Unknown"), score) for f, score in top_3]
+    return {
+        "person_name": name_map[best_file],
+        "score": float(best_score),
+        "verified": bool(best_score >= threshold),
+        "threshold": threshold,
+    }
 
-    return {"top_3_matches": top_3_named}
 
+# 11. BIT-PACKED BINARY CANVASES
+# ---------------------------------------------------------
+BINARY_METRICS = ("iou", "dice", "chamfer")
+CHAMFER_MAX_DISTANCE = 20.0 # Mean distance (pixels) at which the chamfer score reaches 0, and the per-pixel truncation
+CHAMFER_CHUNK_SIZE = 64 # Masks unpacked at a time by the chamfer metric (64 x 108000 floats)
+CHAMFER_DISTANCE_SCALE = 255 / CHAMFER_MAX_DISTANCE # Distance map steps per pixel (uint8, truncated at the maximum)
+
+def pack_canvas(img):
+    """
+    Ink mask of a normalized canvas, 8 pixels per byte: a 180 x 75 uint8
+    array (13.5 KB instead of 108 KB for the grayscale canvas).
+    """
+    return np.packbits(ink_mask(cv2.resize(img, (600, 180))), axis=1)
+
+def unpack_canvas(packed):
+    """Back to a 180 x 600 mask of 0 / 1 from pack_canvas output."""
+    return np.unpackbits(packed, axis=-1)
+
+def popcount_rows(packed):
+    """Number of set bits in every row of a 2-D uint8 array."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(packed).sum(axis=1, dtype=np.int64)
+    return _POPCOUNT[packed].sum(axis=1, dtype=np.int64)
+
+@profiling.timed("match_binary")
+def _distance_map(mask):
+    # Distance of every pixel to the nearest ink pixel of a 0 / 1 mask,
+    # truncated at CHAMFER_MAX_DISTANCE, in uint8 steps of 1 / CHAMFER_DISTANCE_SCALE pixel
+    distances = cv2.distanceTransform(1 - mask, cv2.DIST_L2, 3)
+    return np.rint(np.minimum(distances, CHAMFER_MAX_DISTANCE) * CHAMFER_DISTANCE_SCALE).astype(np.uint8)
+
+def chamfer_distance_maps(packed_stack):
+    """
+    Truncated distance maps (N x 180 x 600 uint8, see _distance_map) of
+    packed ink masks (N x 180 x 75), for the chamfer metric of
+    batch_binary_scores. Depends only on the gallery, so it is computed
+    once and reused by every query instead of one distance transform per
+    gallery entry and query.
+    """
+    maps = np.empty((len(packed_stack), 180, 600), dtype=np.uint8)
+    for i in range(len(packed_stack)):
+        maps[i] = _distance_map(np.unpackbits(np.asarray(packed_stack[i]), axis=1))
+    return maps
+
+def batch_binary_scores(query_img, packed_stack, metric="iou", chunk_size=1024, rows=None, distance_maps=None):
+    """
+    Similarity 0–100 between one query and N packed canvases
+    (N x 180 x 75, see pack_canvas), working on the packed bits:
+    - "iou": |A and B| / |A or B|
+    - "dice": 2 |A and B| / (|A| + |B|)
+      both with AND + popcount only, no unpacking
+    - "chamfer": symmetric truncated chamfer distance, the average of the
+      mean distance from each gallery ink pixel to the nearest query ink
+      pixel and from each query ink pixel to the nearest gallery ink pixel,
+      each distance truncated at CHAMFER_MAX_DISTANCE: 100 at 0 pixels
+      down to 0 at CHAMFER_MAX_DISTANCE pixels; tolerant to small shifts of
+      thin strokes, which IoU / Dice are not, and an ink-heavy query does
+      not match every sparse entry. The gallery side reads distance_maps
+      (see chamfer_distance_maps, e.g. gallery.chamfer_distance_maps())
+      when given, otherwise each mask is transformed on the fly. Masks are
+      unpacked CHAMFER_CHUNK_SIZE at a time.
+
+    With rows, only those entries are scored (in that order), read chunk
+    by chunk.
+    """
+    if metric not in BINARY_METRICS:
+        raise ValueError(f"Unknown binary metric: {metric}")
+
+    query_mask = ink_mask(cv2.resize(query_img, (600, 180)))
+    query_bits = np.packbits(query_mask, axis=1).ravel()
+    query_ink = int(np.count_nonzero(query_mask))
+    if metric == "chamfer":
+        # Distance of every pixel to the nearest query ink pixel, in the distance map steps
+        query_distances = _distance_map(query_mask).ravel().astype(np.float32)
+        query_pixels = np.flatnonzero(query_mask.ravel())
+        chunk_size = min(chunk_size, CHAMFER_CHUNK_SIZE)
+
+    if rows is not None:
+        rows = np.asarray(rows, dtype=np.int64)
+    n = len(packed_stack) if rows is None else len(rows)
+    scores = np.zeros(n, dtype=np.float64)
+    if query_ink == 0:
+        return scores
+
+    for start in range(0, n, chunk_size):
+        chunk = slice(start, start + chunk_size) if rows is None else rows[start:start + chunk_size]
+        block = np.asarray(packed_stack[chunk]).reshape(-1, query_bits.size)
+        gallery_ink = popcount_rows(block)
+
+        if metric == "chamfer":
+            masks = np.unpackbits(block, axis=1)
+            to_query = (masks.astype(np.float32) @ query_distances) / np.maximum(gallery_ink, 1)
+            if distance_maps is not None:
+                maps = np.asarray(distance_maps[chunk]).reshape(len(block), -1)
+            else:
+                maps = np.array([_distance_map(mask.reshape(query_mask.shape)).ravel() for mask in masks])
+            to_gallery = maps[:, query_pixels].mean(axis=1, dtype=np.float64)
+            chunk_scores = np.clip(1 - (to_query + to_gallery) / (2 * 255), 0, 1)
+        else:
+            overlap = popcount_rows(block & query_bits)
+            if metric == "iou":
+                chunk_scores = overlap / np.maximum(query_ink + gallery_ink - overlap, 1)
+            else:
+                chunk_scores = 2 * overlap / (query_ink + gallery_ink)
+
+        chunk_scores[gallery_ink == 0] = 0
+        scores[start:start + len(block)] = chunk_scores
+
+    return scores * 100
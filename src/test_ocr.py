@@ -1,8 +1,10 @@
 import pytesseract
+from ocr_engines import find_tesseract, get_ocr_engine
 
-pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
+pytesseract.pytesseract.tesseract_cmd = find_tesseract()
 
 print(pytesseract.get_tesseract_version())
+print("OCR engine:", get_ocr_engine().name)
 
 from signature_utils import extract_text_from_image
 